@@ -112,23 +112,33 @@ else:
 
 batches = dataset.get_batch_generator(batch_size, total_step)
 if args.use_py_reader:
-    py_reader.decorate_tensor_provider(lambda :[ (yield b[1],b[2]) for b in batches])
+    def data_gen():
+        for b in batches:
+            yield b[0], b[1]
+    py_reader.decorate_tensor_provider(data_gen)
     py_reader.start()
 
 sum_iou = 0
 all_correct = np.array([0], dtype=np.int64)
 all_wrong = np.array([0], dtype=np.int64)
 
+# images that fail to load are skipped by the reader, which then runs out
+# of batches before total_step
 for i in range(total_step):
-    if not args.use_py_reader:
-        _, imgs, labels, names = next(batches)
-        result = exe.run(tp,
-                         feed={'img': imgs,
-                               'label': labels},
-                         fetch_list=[pred, miou, out_wrong, out_correct])
-    else:
-        result = exe.run(tp,
-                         fetch_list=[pred, miou, out_wrong, out_correct])
+    try:
+        if not args.use_py_reader:
+            imgs, labels, names = next(batches)
+            result = exe.run(tp,
+                             feed={'img': imgs,
+                                   'label': labels},
+                             fetch_list=[pred, miou, out_wrong, out_correct])
+        else:
+            result = exe.run(tp,
+                             fetch_list=[pred, miou, out_wrong, out_correct])
+    except (StopIteration, fluid.core.EOFException):
+        print('reader ran out of images after %d of %d steps' %
+              (i, total_step))
+        break
 
     wrong = result[2][:-1] + all_wrong
     right = result[3][:-1] + all_correct
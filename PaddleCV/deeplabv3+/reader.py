@@ -4,9 +4,11 @@ from __future__ import print_function
 import cv2
 import numpy as np
 import os
+import sys
 import six
-import time
-from data_utils import GeneratorEnqueuer
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from shm_utils.enqueuer import SharedMemoryEnqueuer
 
 default_config = {
     "shuffle": True,
@@ -38,7 +40,7 @@ def slice_with_pad(a, s, value=0):
             pads.append([pl, pr])
             slices.append([l, r])
     slices = list(map(lambda x: slice(x[0], x[1], 1), slices))
-    a = a[slices]
+    a = a[tuple(slices)]
     a = np.pad(a, pad_width=pads, mode='constant', constant_values=value)
     return a
 
@@ -75,23 +77,41 @@ class CityscapeDataset:
         if self.index >= len(self.label_files):
             self.reset()
 
+    def load_img(self, ln):
+        """
+        Load the BGR image and the label image of a label file, returns
+        (None, None) if the image cannot be read.
+        """
+        img_name = os.path.join(
+            self.dataset_dir,
+            'leftImg8bit/' + self.subset + ln[len(self.label_dirname):])
+        img_name = img_name.replace('gtFine_labelTrainIds', 'leftImg8bit')
+        img = cv2.imread(img_name)
+        if img is None:
+            print("load img failed:", img_name)
+            return None, None
+        label = cv2.imread(ln, cv2.IMREAD_GRAYSCALE)
+        return img, label
+
     def get_img(self):
-        shape = self.config["crop_size"]
         while True:
             ln = self.label_files[self.index]
-            img_name = os.path.join(
-                self.dataset_dir,
-                'leftImg8bit/' + self.subset + ln[len(self.label_dirname):])
-            img_name = img_name.replace('gtFine_labelTrainIds', 'leftImg8bit')
-            label = cv2.imread(ln)
-            img = cv2.imread(img_name)
+            img, label = self.load_img(ln)
             if img is None:
-                print("load img failed:", img_name)
                 self.next_img()
             else:
                 break
+        img, label, crop_info = self.process_img(img, label)
+        return img, label, ln + crop_info
+
+    def process_img(self, img, label):
+        """
+        Random scale, crop and channel flip of a training image and its
+        label, returns them as uint8 arrays of the crop size.
+        """
+        shape = self.config["crop_size"]
         if shape == -1:
-            return img, label, ln
+            return img, label, ''
 
         if np.random.rand() > 0.5:
             range_l = 1
@@ -101,18 +121,13 @@ class CityscapeDataset:
             range_r = 1
 
         if np.random.rand() > 0.5:
-            assert len(img.shape) == 3 and len(
-                label.shape) == 3, "{} {}".format(img.shape, label.shape)
+            assert len(img.shape) == 3, "{}".format(img.shape)
             img = img[:, :, ::-1]
-            label = label[:, :, ::-1]
 
-        random_scale = np.random.rand(1) * (range_r - range_l) + range_l
+        random_scale = np.random.rand() * (range_r - range_l) + range_l
         crop_size = int(shape / random_scale)
         bb = crop_size // 2
 
-        def _randint(low, high):
-            return int(np.random.rand(1) * (high - low) + low)
-
         offset_x = np.random.randint(bb, max(bb + 1, img.shape[0] -
                                              bb)) - crop_size // 2
         offset_y = np.random.randint(bb, max(bb + 1, img.shape[1] -
@@ -125,8 +140,7 @@ class CityscapeDataset:
                                     255)
         label = cv2.resize(
             label_crop, (shape, shape), interpolation=cv2.INTER_NEAREST)
-        return img, label, ln + str(
-            (offset_x, offset_y, crop_size, random_scale))
+        return img, label, str((offset_x, offset_y, crop_size, random_scale))
 
     def get_batch(self, batch_size=1):
         imgs = []
@@ -140,27 +154,71 @@ class CityscapeDataset:
             self.next_img()
         return np.array(imgs), np.array(labels), names
 
+    def read_shard(self, batch_size, shard_id, shard_num, shuffle_seed=None):
+        """
+        Generator of the uint8 (images, labels, file indexes) batches of
+        every shard_num-th label file from shard_id on. All shards shuffle
+        the label files with shuffle_seed, so that they stay disjoint, and
+        cycle over them when shuffle is on, otherwise they read them once.
+        """
+        order = np.arange(len(self.label_files))
+        rng = np.random.RandomState(shuffle_seed)
+        imgs, labels, indexes = [], [], []
+        while True:
+            if self.config["shuffle"]:
+                rng.shuffle(order)
+            for index in order[shard_id::shard_num]:
+                img, label = self.load_img(self.label_files[index])
+                if img is None:
+                    continue
+                img, label, _ = self.process_img(img, label)
+                imgs.append(img)
+                labels.append(label)
+                indexes.append(index)
+                if len(imgs) == batch_size:
+                    yield np.stack(imgs), np.stack(labels), np.array(indexes)
+                    imgs, labels, indexes = [], [], []
+            if not self.config["shuffle"]:
+                break
+        if imgs:
+            yield np.stack(imgs), np.stack(labels), np.array(indexes)
+
     def get_batch_generator(self,
                             batch_size,
                             total_step,
                             num_workers=8,
                             max_queue=32,
                             use_multiprocessing=True):
+        """
+        Generator of total_step (images, labels, names) batches, images are
+        normalized float32 NCHW arrays and labels int32 NHW arrays. Images
+        that fail to load are skipped, so without shuffle, when the label
+        files are read only once, there may be fewer batches.
+
+        With use_multiprocessing, num_workers processes read disjoint shards
+        of the data set and pass uint8 batches through shared memory, which
+        are normalized here. The workers are stopped once total_step batches
+        are read or the generator is closed.
+        """
+
+        def normalize(imgs, labels):
+            imgs = imgs[:, :, :, ::-1].transpose(0, 3, 1, 2).astype(
+                np.float32) / (255.0 / 2) - 1
+            return imgs, labels.astype(np.int32)
+
         def do_get_batch():
             iter_id = 0
             while True:
                 imgs, labels, names = self.get_batch(batch_size)
-                labels = labels.astype(np.int32)[:, :, :, 0]
-                imgs = imgs[:, :, :, ::-1].transpose(
-                    0, 3, 1, 2).astype(np.float32) / (255.0 / 2) - 1
+                imgs, labels = normalize(imgs, labels)
                 yield imgs, labels, names
                 if not use_multiprocessing:
                     iter_id += 1
                     if iter_id >= total_step:
                         break
 
-        batches = do_get_batch()
         if not use_multiprocessing:
+            batches = do_get_batch()
             try:
                 from prefetch_generator import BackgroundGenerator
                 batches = BackgroundGenerator(batches, 100)
@@ -170,25 +228,33 @@ class CityscapeDataset:
                 )
             return batches
 
+        shape = self.config["crop_size"]
+        if shape == -1:
+            # images are read as they are, assume they have the same size
+            img, _ = self.load_img(self.label_files[0])
+            img_bytes = img.size
+        else:
+            img_bytes = shape * shape * 3
+        # images, labels and file indexes of a batch
+        batch_bytes = batch_size * (img_bytes + img_bytes // 3 + 8) + 3 * 64
+        shuffle_seed = np.random.randint(0, 2**31 - 1)
+
+        def batch_generator(worker_id, num_workers):
+            return self.read_shard(batch_size, worker_id, num_workers,
+                                   shuffle_seed)
+
         def reader():
+            enqueuer = SharedMemoryEnqueuer(batch_generator, batch_bytes)
             try:
-                enqueuer = GeneratorEnqueuer(
-                    batches, use_multiprocessing=use_multiprocessing)
                 enqueuer.start(max_queue_size=max_queue, workers=num_workers)
-                generator_out = None
-                for i in range(total_step):
-                    while enqueuer.is_running():
-                        if not enqueuer.queue.empty():
-                            generator_out = enqueuer.queue.get()
-                            break
-                        else:
-                            time.sleep(0.02)
-                    yield generator_out
-                    generator_out = None
-                enqueuer.stop()
+                step = 0
+                for imgs, labels, indexes in enqueuer.get():
+                    if step >= total_step:
+                        break
+                    imgs, labels = normalize(imgs, labels)
+                    yield imgs, labels, [self.label_files[i] for i in indexes]
+                    step += 1
             finally:
-                if enqueuer is not None:
-                    enqueuer.stop()
+                enqueuer.stop()
 
-        data_gen = reader()
-        return data_gen
+        return reader()
@@ -244,6 +244,10 @@ with profile_context(args.profile):
         print("step {:d}, loss: {:.6f}, step_time_cost: {:.3f} s".format(
             i, train_loss, end_time - begin_time))
 
+if not args.use_py_reader:
+    # stop the reader processes
+    batches.close()
+
 print("Training done. Model is saved to", args.save_weights_path)
 save_model()
 
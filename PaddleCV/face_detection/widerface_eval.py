@@ -9,6 +9,7 @@ import argparse
 import functools
 from PIL import Image
 
+import paddle
 import paddle.fluid as fluid
 import reader
 from pyramidbox import PyramidBox
@@ -27,6 +28,7 @@ add_arg('file_list',       str,   'data/wider_face_split/wider_face_val_bbx_gt.t
 add_arg('infer',           bool,  False,                             "Whether do infer or eval.")
 add_arg('confs_threshold', float, 0.15,                              "Confidence threshold to draw bbox.")
 add_arg('image_path',      str,   '',                                "The image used to inference and visualize.")
+add_arg('num_workers',     int,   2,                                 "The number of threads preparing the inputs of the next images during evaluation.")
 # yapf: enable
 
 
@@ -40,33 +42,38 @@ def infer(args, config):
         image_path = args.image_path
         image = Image.open(image_path)
         if image.mode == 'L':
-            image = img.convert('RGB')
+            image = image.convert('RGB')
         shrink, max_shrink = get_shrink(image.size[1], image.size[0])
 
-        det0 = detect_face(image, shrink)
         if args.use_gpu:
-            det1 = flip_test(image, shrink)
-            [det2, det3] = multi_scale_test(image, max_shrink)
-            det4 = multi_scale_test_pyramid(image, max_shrink)
-            det = np.row_stack((det0, det1, det2, det3, det4))
+            det = detect_face_tta(
+                image.size, shrink, max_shrink,
+                prepare_inputs(image, shrink, max_shrink))
             dets = bbox_vote(det)
         else:
             # when infer on cpu, use a simple case
-            dets = det0
+            dets = detect_face(image, shrink)
 
         keep_index = np.where(dets[:, 4] >= args.confs_threshold)[0]
         dets = dets[keep_index, :]
         draw_bboxes(image_path, dets[:, 0:4])
     else:
-        test_reader = reader.test(config, args.file_list)
-        for image, image_path in test_reader():
-            shrink, max_shrink = get_shrink(image.size[1], image.size[0])
 
-            det0 = detect_face(image, shrink)
-            det1 = flip_test(image, shrink)
-            [det2, det3] = multi_scale_test(image, max_shrink)
-            det4 = multi_scale_test_pyramid(image, max_shrink)
-            det = np.row_stack((det0, det1, det2, det3, det4))
+        def prepare(sample):
+            image, image_path = sample
+            shrink, max_shrink = get_shrink(image.size[1], image.size[0])
+            inputs = prepare_inputs(image, shrink, max_shrink)
+            return image_path, image.size, shrink, max_shrink, inputs
+
+        # decode and resize the next images while the network runs
+        test_reader = paddle.reader.xmap_readers(
+            prepare,
+            reader.test(config, args.file_list),
+            args.num_workers,
+            args.num_workers,
+            order=True)
+        for image_path, image_size, shrink, max_shrink, inputs in test_reader():
+            det = detect_face_tta(image_size, shrink, max_shrink, inputs)
             dets = bbox_vote(det)
 
             save_widerface_bboxes(image_path, dets, pred_dir)
@@ -102,12 +109,14 @@ def save_widerface_bboxes(image_path, bboxes_scores, output_dir):
     print("The predicted result is saved as {}".format(ofname))
 
 
-def detect_face(image, shrink):
-    image_shape = [3, image.size[1], image.size[0]]
+def to_input(image, shrink):
+    """
+    Resize a PIL image by shrink and convert it to the normalized CHW input
+    of the network.
+    """
     if shrink != 1:
-        h, w = int(image_shape[1] * shrink), int(image_shape[2] * shrink)
+        h, w = int(image.size[1] * shrink), int(image.size[0] * shrink)
         image = image.resize((w, h), Image.ANTIALIAS)
-        image_shape = [3, h, w]
 
     img = np.array(image)
     img = reader.to_chw_bgr(img)
@@ -116,103 +125,195 @@ def detect_face(image, shrink):
     img = img.astype('float32')
     img -= np.array(mean)[:, np.newaxis, np.newaxis].astype('float32')
     img = img * scale
-    img = [img]
-    img = np.array(img)
+    return img
+
 
+def detect_batch(imgs, shrinks):
+    """
+    Run the network once on a batch of inputs of the same shape.
+    Args:
+        imgs (np.array): the (N, 3, H, W) inputs.
+        shrinks (list): the shrink of every input.
+    Returns:
+        list of the detections of every input, layout is
+        (xmin, ymin, xmax, ymax, score) in the original image.
+    """
     detection, = exe.run(infer_program,
-                         feed={'image': img},
+                         feed={'image': imgs},
                          fetch_list=fetches,
                          return_numpy=False)
+    offsets = detection.lod()[0] if detection.lod() else [0, len(imgs)]
     detection = np.array(detection)
-    # layout: xmin, ymin, xmax. ymax, score
     if np.prod(detection.shape) == 1:
-        print("No face detected")
-        return np.array([[0, 0, 0, 0, 0]])
-    det_conf = detection[:, 1]
-    det_xmin = image_shape[2] * detection[:, 2] / shrink
-    det_ymin = image_shape[1] * detection[:, 3] / shrink
-    det_xmax = image_shape[2] * detection[:, 4] / shrink
-    det_ymax = image_shape[1] * detection[:, 5] / shrink
+        # nothing detected in the whole batch
+        offsets = [0] * (len(imgs) + 1)
+    height, width = imgs.shape[2:]
+    dets = []
+    for i, shrink in enumerate(shrinks):
+        # layout: label, score, xmin, ymin, xmax. ymax
+        det = detection[offsets[i]:offsets[i + 1]]
+        if det.shape[0] == 0:
+            print("No face detected")
+            dets.append(np.array([[0, 0, 0, 0, 0]]))
+            continue
+        dets.append(
+            np.column_stack((width * det[:, 2] / shrink, height * det[:, 3] /
+                             shrink, width * det[:, 4] / shrink,
+                             height * det[:, 5] / shrink, det[:, 1])))
+    return dets
+
+
+def detect_face(image, shrink):
+    return detect_batch(to_input(image, shrink)[np.newaxis], [shrink])[0]
+
+
+def get_tta_shrinks(shrink, max_shrink):
+    """
+    Returns the (shrink, flip) inputs of test-time augmentation, recorded by
+    running it with empty detections, as the shrinks do not depend on them.
+    """
+    shrinks = []
+
+    def record(s, flip=False):
+        if (s, flip) not in shrinks:
+            shrinks.append((s, flip))
+        return np.zeros((0, 5))
+
+    test_time_augment(record, shrink, max_shrink, 0)
+    return shrinks
+
 
-    det = np.column_stack((det_xmin, det_ymin, det_xmax, det_ymax, det_conf))
-    return det
+def prepare_inputs(image, shrink, max_shrink):
+    """
+    Network inputs of all the shrinks of test-time augmentation, the flipped
+    input is made from the unflipped one.
+    """
+    inputs = {}
+    for s, flip in get_tta_shrinks(shrink, max_shrink):
+        if s not in inputs:
+            inputs[s] = to_input(image, s)
+    return inputs
+
+
+def detect_face_tta(image_size, shrink, max_shrink, inputs):
+    """
+    Test-time augmentation of an image, whose inputs are prepared by
+    prepare_inputs. Inputs of the same shape, at least the flipped and
+    unflipped ones, are detected in one batch.
+    """
+    groups = {}
+    for s, flip in get_tta_shrinks(shrink, max_shrink):
+        img = inputs[s][:, :, ::-1] if flip else inputs[s]
+        groups.setdefault(img.shape, []).append(((s, flip), img))
+    dets = {}
+    for group in groups.values():
+        keys = [key for key, _ in group]
+        batch = np.stack([img for _, img in group])
+        for key, det in zip(keys, detect_batch(batch, [s for s, _ in keys])):
+            dets[key] = det
 
+    def detect(s, flip=False):
+        return dets[(s, flip)]
 
-def bbox_vote(det):
+    return test_time_augment(detect, shrink, max_shrink, image_size[0])
+
+
+def test_time_augment(detect, shrink, max_shrink, width):
+    """
+    Detections of the image, flipped image, multi-scale and pyramid tests.
+    Args:
+        detect: function of (shrink, flip) returning the detections of the
+            image resized by shrink and horizontally flipped if flip.
+        width (int): width of the image.
+    """
+    det0 = detect(shrink)
+    det1 = flip_test(detect, shrink, width)
+    [det2, det3] = multi_scale_test(detect, max_shrink)
+    det4 = multi_scale_test_pyramid(detect, max_shrink)
+    return np.row_stack((det0, det1, det2, det3, det4))
+
+
+def bbox_vote(det, max_dets=750):
+    """
+    Box voting: boxes overlapping a box of higher score by IoU 0.3 are
+    merged into their score weighted average, boxes merged with no other box
+    are dropped unless they are the last ones. Returns at most max_dets
+    boxes, sorted by score.
+    """
     order = det[:, 4].ravel().argsort()[::-1]
     det = det[order, :]
     if det.shape[0] == 0:
-        dets = np.array([[10, 10, 20, 20, 0.002]])
-        det = np.empty(shape=[0, 5])
-    while det.shape[0] > 0:
+        return np.array([[10, 10, 20, 20, 0.002]])
+    area = (det[:, 2] - det[:, 0] + 1) * (det[:, 3] - det[:, 1] + 1)
+    alive = np.ones(det.shape[0], dtype=bool)
+    dets = []
+    for i in range(det.shape[0]):
+        if not alive[i]:
+            continue
+        # boxes before the pivot are all merged already
+        cand = i + np.nonzero(alive[i:])[0]
         # IOU
-        area = (det[:, 2] - det[:, 0] + 1) * (det[:, 3] - det[:, 1] + 1)
-        xx1 = np.maximum(det[0, 0], det[:, 0])
-        yy1 = np.maximum(det[0, 1], det[:, 1])
-        xx2 = np.minimum(det[0, 2], det[:, 2])
-        yy2 = np.minimum(det[0, 3], det[:, 3])
+        xx1 = np.maximum(det[i, 0], det[cand, 0])
+        yy1 = np.maximum(det[i, 1], det[cand, 1])
+        xx2 = np.minimum(det[i, 2], det[cand, 2])
+        yy2 = np.minimum(det[i, 3], det[cand, 3])
         w = np.maximum(0.0, xx2 - xx1 + 1)
         h = np.maximum(0.0, yy2 - yy1 + 1)
         inter = w * h
-        o = inter / (area[0] + area[:] - inter)
+        o = inter / (area[i] + area[cand] - inter)
 
         # nms
-        merge_index = np.where(o >= 0.3)[0]
-        det_accu = det[merge_index, :]
-        det = np.delete(det, merge_index, 0)
+        merge_index = cand[o >= 0.3]
+        alive[merge_index] = False
+        alive[i] = False
         if merge_index.shape[0] <= 1:
-            if det.shape[0] == 0:
-                try:
-                    dets = np.row_stack((dets, det_accu))
-                except:
-                    dets = det_accu
+            if not alive[i:].any():
+                dets.append(det[merge_index, :])
             continue
-        det_accu[:, 0:4] = det_accu[:, 0:4] * np.tile(det_accu[:, -1:], (1, 4))
-        max_score = np.max(det_accu[:, 4])
+        det_accu = det[merge_index, :]
+        weights = det_accu[:, 4:5]
         det_accu_sum = np.zeros((1, 5))
-        det_accu_sum[:, 0:4] = np.sum(det_accu[:, 0:4],
-                                      axis=0) / np.sum(det_accu[:, -1:])
-        det_accu_sum[:, 4] = max_score
-        try:
-            dets = np.row_stack((dets, det_accu_sum))
-        except:
-            dets = det_accu_sum
-    dets = dets[0:750, :]
-    return dets
-
-
-def flip_test(image, shrink):
-    img = image.transpose(Image.FLIP_LEFT_RIGHT)
-    det_f = detect_face(img, shrink)
+        det_accu_sum[:, 0:4] = np.sum(det_accu[:, 0:4] * weights,
+                                      axis=0) / np.sum(weights)
+        det_accu_sum[:, 4] = np.max(det_accu[:, 4])
+        dets.append(det_accu_sum)
+        # rows after max_dets would be dropped
+        if len(dets) >= max_dets:
+            break
+    dets = np.row_stack(dets)
+    return dets[0:max_dets, :]
+
+
+def flip_test(detect, shrink, width):
+    det_f = detect(shrink, flip=True)
     det_t = np.zeros(det_f.shape)
-    # image.size: [width, height]
-    det_t[:, 0] = image.size[0] - det_f[:, 2]
+    det_t[:, 0] = width - det_f[:, 2]
     det_t[:, 1] = det_f[:, 1]
-    det_t[:, 2] = image.size[0] - det_f[:, 0]
+    det_t[:, 2] = width - det_f[:, 0]
     det_t[:, 3] = det_f[:, 3]
     det_t[:, 4] = det_f[:, 4]
     return det_t
 
 
-def multi_scale_test(image, max_shrink):
+def multi_scale_test(detect, max_shrink):
     # Shrink detecting is only used to detect big faces
     st = 0.5 if max_shrink >= 0.75 else 0.5 * max_shrink
-    det_s = detect_face(image, st)
+    det_s = detect(st)
     index = np.where(
         np.maximum(det_s[:, 2] - det_s[:, 0] + 1, det_s[:, 3] - det_s[:, 1] + 1)
         > 30)[0]
     det_s = det_s[index, :]
     # Enlarge one times
     bt = min(2, max_shrink) if max_shrink > 1 else (st + max_shrink) / 2
-    det_b = detect_face(image, bt)
+    det_b = detect(bt)
 
     # Enlarge small image x times for small faces
     if max_shrink > 2:
         bt *= 2
         while bt < max_shrink:
-            det_b = np.row_stack((det_b, detect_face(image, bt)))
+            det_b = np.row_stack((det_b, detect(bt)))
             bt *= 2
-        det_b = np.row_stack((det_b, detect_face(image, max_shrink)))
+        det_b = np.row_stack((det_b, detect(max_shrink)))
 
     # Enlarged images are only used to detect small faces.
     if bt > 1:
@@ -229,9 +330,9 @@ def multi_scale_test(image, max_shrink):
     return det_s, det_b
 
 
-def multi_scale_test_pyramid(image, max_shrink):
+def multi_scale_test_pyramid(detect, max_shrink):
     # Use image pyramids to detect faces
-    det_b = detect_face(image, 0.25)
+    det_b = detect(0.25)
     index = np.where(
         np.maximum(det_b[:, 2] - det_b[:, 0] + 1, det_b[:, 3] - det_b[:, 1] + 1)
         > 30)[0]
@@ -240,7 +341,7 @@ def multi_scale_test_pyramid(image, max_shrink):
     st = [0.75, 1.25, 1.5, 1.75]
     for i in range(len(st)):
         if (st[i] <= max_shrink):
-            det_temp = detect_face(image, st[i])
+            det_temp = detect(st[i])
             # Enlarged images are only used to detect small faces.
             if st[i] > 1:
                 index = np.where(
@@ -23,6 +23,7 @@ import os
 import functools
 import numpy as np
 import cv2
+import paddle
 import random
 
 from utils.transforms import fliplr_joints
@@ -66,8 +67,9 @@ class Config:
     DEBUG = False
     TMPDIR = 'tmp_fold_for_debug'
 
-    # For reader
-    BUF_SIZE = 102400
+    # For reader, samples are mapped by THREAD threads and at most BUF_SIZE
+    # mapped samples are buffered ahead of the consumer
+    BUF_SIZE = 256
     THREAD = 1 if DEBUG else 8 # have to be larger than 0
 
     # Fixed infos of dataset
@@ -310,21 +312,13 @@ def _reader_creator(root, image_set, shuffle=False, is_train=False, use_gt_bbox=
 
 def train():
     reader, mapper = _reader_creator(cfg.DATAROOT, 'train', shuffle=True, is_train=True)
-    def pop():
-        for i, x in enumerate(reader()):
-            yield mapper(x)
-    return pop
+    return paddle.reader.xmap_readers(mapper, reader, cfg.THREAD, cfg.BUF_SIZE)
 
 def valid():
     reader, mapper = _reader_creator(cfg.DATAROOT, 'val', shuffle=False, is_train=False, use_gt_bbox=True)
-    def pop():
-        for i, x in enumerate(reader()):
-            yield mapper(x)
-    return pop
+    # keep the order of the samples, the predictions are matched with them
+    return paddle.reader.xmap_readers(mapper, reader, cfg.THREAD, cfg.BUF_SIZE, order=True)
 
 def test():
     reader, mapper = _reader_creator(cfg.DATAROOT, 'test', shuffle=False, is_train=False, use_gt_bbox=True)
-    def pop():
-        for i, x in enumerate(reader()):
-            yield mapper(x)
-    return pop
+    return paddle.reader.xmap_readers(mapper, reader, cfg.THREAD, cfg.BUF_SIZE, order=True)
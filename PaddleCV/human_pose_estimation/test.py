@@ -101,22 +101,19 @@ def test(args):
         for i in range(num_images):
             file_ids.append(data[i][1])
 
+        if args.flip_test:
+            # Append the flipped images to the batch, so that both are
+            # inferred in a single run
+            data = data + [(d[0][:, :, ::-1], d[1]) for d in data]
+
         input_image, out_heatmaps  = test_exe.run(
                 fetch_list=fetch_list,
                 feed=feeder.feed(data))
 
         if args.flip_test:
-            # Flip all the images in a same batch
-            data_fliped = []
-            for i in range(num_images):
-                data_fliped.append((
-                            data[i][0][:, :, ::-1],
-                            data[i][1]))
-
-            # Inference again
-            _, output_flipped = test_exe.run(
-                    fetch_list=fetch_list,
-                    feed=feeder.feed(data_fliped))
+            output_flipped = out_heatmaps[num_images:]
+            input_image = input_image[:num_images]
+            out_heatmaps = out_heatmaps[:num_images]
 
             # Flip back
             output_flipped = flip_back(output_flipped, FLIP_PAIRS)
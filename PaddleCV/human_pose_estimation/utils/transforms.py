@@ -38,14 +38,12 @@ def flip_back(output_flipped, matched_parts):
     assert output_flipped.ndim == 4,\
         'output_flipped should be [batch_size, num_joints, height, width]'
 
-    output_flipped = output_flipped[:, :, :, ::-1]
-
+    # Swap the matched joints and flip the width in a single gather
+    joints = np.arange(output_flipped.shape[1])
     for pair in matched_parts:
-        tmp = output_flipped[:, pair[0], :, :].copy()
-        output_flipped[:, pair[0], :, :] = output_flipped[:, pair[1], :, :]
-        output_flipped[:, pair[1], :, :] = tmp
+        joints[pair[0]], joints[pair[1]] = pair[1], pair[0]
 
-    return output_flipped
+    return output_flipped[:, joints, :, ::-1]
 
 
 def fliplr_joints(joints, joints_vis, width, matched_parts):
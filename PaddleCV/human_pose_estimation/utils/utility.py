@@ -79,7 +79,7 @@ def get_max_preds(batch_heatmaps):
     width = batch_heatmaps.shape[3]
     heatmaps_reshaped = batch_heatmaps.reshape((batch_size, num_joints, -1))
     idx = np.argmax(heatmaps_reshaped, 2)
-    maxvals = np.amax(heatmaps_reshaped, 2)
+    maxvals = np.take_along_axis(heatmaps_reshaped, idx[:, :, np.newaxis], 2)
 
     maxvals = maxvals.reshape((batch_size, num_joints, 1))
     idx = idx.reshape((batch_size, num_joints, 1))
@@ -176,28 +176,37 @@ def transform_preds(coords, center, scale, output_size):
 def get_final_preds(args, batch_heatmaps, center, scale):
     coords, maxvals = get_max_preds(batch_heatmaps)
 
+    batch_size = batch_heatmaps.shape[0]
+    num_joints = batch_heatmaps.shape[1]
     heatmap_height = batch_heatmaps.shape[2]
     heatmap_width = batch_heatmaps.shape[3]
 
-    # Post-processing
+    # Post-processing, move every peak a quarter pixel towards the higher
+    # of its neighbours, for all the joints of the batch at once
     if args.post_process:
-        for n in range(coords.shape[0]):
-            for p in range(coords.shape[1]):
-                hm = batch_heatmaps[n][p]
-                px = int(math.floor(coords[n][p][0] + 0.5))
-                py = int(math.floor(coords[n][p][1] + 0.5))
-                if 1 < px < heatmap_width-1 and 1 < py < heatmap_height-1:
-                    diff = np.array([hm[py][px+1] - hm[py][px-1],
-                                     hm[py+1][px]-hm[py-1][px]])
-                    coords[n][p] += np.sign(diff) * .25
-
-    preds = coords.copy()
-
-    # Transform back
-    for i in range(coords.shape[0]):
-        preds[i] = transform_preds(coords[i], center[i], scale[i],
-                                   [heatmap_width, heatmap_height])
-    return preds, maxvals
+        px = np.floor(coords[:, :, 0] + 0.5).astype(np.int64)
+        py = np.floor(coords[:, :, 1] + 0.5).astype(np.int64)
+        inside = (px > 1) & (px < heatmap_width - 1) & \
+                 (py > 1) & (py < heatmap_height - 1)
+        px = np.clip(px, 1, heatmap_width - 2)
+        py = np.clip(py, 1, heatmap_height - 2)
+        n = np.arange(batch_size)[:, np.newaxis]
+        p = np.arange(num_joints)[np.newaxis, :]
+        diff = np.stack([
+            batch_heatmaps[n, p, py, px + 1] - batch_heatmaps[n, p, py, px - 1],
+            batch_heatmaps[n, p, py + 1, px] - batch_heatmaps[n, p, py - 1, px]
+        ], axis=2)
+        coords += np.sign(diff) * .25 * inside[:, :, np.newaxis]
+
+    # Transform back, with the inverse affine transform of every image
+    trans = np.stack([
+        get_affine_transform(center[i], scale[i], 0,
+                             [heatmap_width, heatmap_height], inv=1)
+        for i in range(batch_size)
+    ]).reshape((batch_size, 2, 3))
+    preds = np.einsum('nij,npj->npi', trans[:, :, :2], coords) + \
+            trans[:, np.newaxis, :, 2]
+    return preds.astype(np.float32), maxvals
 
 
 def calc_dists(preds, target, normalize):
@@ -43,7 +43,7 @@ add_arg('pretrained_model', str,   None,                "Whether to use pretrain
 add_arg('checkpoint',       str,   None,                "Whether to resume checkpoint.")
 add_arg('lr',               float, 0.001,               "Set learning rate.")
 add_arg('lr_strategy',      str,   "piecewise_decay",   "Set the learning rate decay strategy.")
-add_arg('flip_test',        bool,  True,                "Flip test")
+add_arg('flip_test',        bool,  True,                "Flip test, doubles the batch fed to the model.")
 add_arg('shift_heatmap',    bool,  True,                "Shift heatmap")
 add_arg('post_process',     bool,  True,                "Post process")
 add_arg('data_root',        str,   "data/coco",         "Root directory of dataset")
@@ -155,28 +155,23 @@ def valid(args):
             scales.append(data[i][4])
             scores.append(data[i][5])
 
+        if args.flip_test:
+            # Append the flipped images to the batch, so that both are
+            # inferred in a single run. Their target_weight is zero, they
+            # do not count in the loss.
+            # Input, target, target_weight, c, s, score
+            data = data + [(d[0][:, :, ::-1], d[1], np.zeros_like(d[2]),
+                            d[3], d[4], d[5]) for d in data]
+
         input_image, loss, out_heatmaps, target_heatmaps = valid_exe.run(
                 fetch_list=fetch_list,
                 feed=feeder.feed(data))
 
         if args.flip_test:
-            # Flip all the images in a same batch
-            data_fliped = []
-            for i in range(num_images):
-                # Input, target, target_weight, c, s, score
-                data_fliped.append((
-                            # np.flip(input_image, 3)[i],
-                            data[i][0][:, :, ::-1],
-                            data[i][1],
-                            data[i][2],
-                            data[i][3],
-                            data[i][4],
-                            data[i][5]))
-
-            # Inference again
-            _, _, output_flipped, _ = valid_exe.run(
-                    fetch_list=fetch_list,
-                    feed=feeder.feed(data_fliped))
+            output_flipped = out_heatmaps[num_images:]
+            input_image = input_image[:num_images]
+            out_heatmaps = out_heatmaps[:num_images]
+            target_heatmaps = target_heatmaps[:num_images]
 
             # Flip back
             output_flipped = flip_back(output_flipped, FLIP_PAIRS)
@@ -191,6 +186,9 @@ def valid(args):
             out_heatmaps = (out_heatmaps + output_flipped) * 0.5
 
         loss = np.mean(np.array(loss))
+        if args.flip_test:
+            # Averaged over the flipped half of the batch too
+            loss *= 2
 
         # Accuracy
         _, avg_acc, cnt, pred = accuracy(out_heatmaps, target_heatmaps)
@@ -4,9 +4,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import os
+import sys
 import cv2
 import numpy as np
 import paddle.dataset as dataset
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from shm_utils.enqueuer import SharedMemoryEnqueuer
 
 DATA_PATH = "./data/cityscape"
 TRAIN_LIST = DATA_PATH + "/train.list"
@@ -40,41 +44,57 @@ class DataGenerater:
                 image_file, label_file = line.strip().split(' ')
                 self.image_label.append((image_file, label_file))
 
-    def create_train_reader(self, batch_size):
+    def create_train_reader(self, batch_size, num_workers=0, max_queue=16):
         """
         Create a reader for train dataset.
+
+        With num_workers > 0, the batches of a pass are built by num_workers
+        processes and passed as uint8 arrays through shared memory, then
+        converted and masked here. Every worker builds every num_workers-th
+        batch of the shuffled list.
         """
 
+        def read_batches(image_label):
+            for start in range(0, len(image_label), batch_size):
+                samples = [
+                    self.process_train_data(image, label)
+                    for image, label in image_label[start:start + batch_size]
+                ]
+                yield tuple(np.stack(field) for field in zip(*samples))
+
+        if num_workers <= 0:
+
+            def reader():
+                np.random.shuffle(self.image_label)
+                for batch in read_batches(self.image_label):
+                    yield self.make_batch(*batch)
+
+            return reader
+
+        h, w = TRAIN_DATA_SHAPE[1:]
+        # image and the labels at 1/4, 1/8 and 1/16 of a batch
+        batch_bytes = batch_size * h * w * (3 + 1. / 16 + 1. / 64 + 1. / 256
+                                            ) + 4 * 64
+
         def reader():
-            np.random.shuffle(self.image_label)
-            images = []
-            labels_sub1 = []
-            labels_sub2 = []
-            labels_sub4 = []
-            count = 0
-            for image, label in self.image_label:
-                image, label_sub1, label_sub2, label_sub4 = self.process_train_data(
-                    image, label)
-                count += 1
-                images.append(image)
-                labels_sub1.append(label_sub1)
-                labels_sub2.append(label_sub2)
-                labels_sub4.append(label_sub4)
-                if count == batch_size:
-                    yield self.mask(
-                        np.array(images),
-                        np.array(labels_sub1),
-                        np.array(labels_sub2), np.array(labels_sub4))
-                    images = []
-                    labels_sub1 = []
-                    labels_sub2 = []
-                    labels_sub4 = []
-                    count = 0
-            if images:
-                yield self.mask(
-                    np.array(images),
-                    np.array(labels_sub1),
-                    np.array(labels_sub2), np.array(labels_sub4))
+            shuffle_seed = np.random.randint(0, 2**31 - 1)
+
+            def batch_generator(worker_id, num_workers):
+                image_label = list(self.image_label)
+                np.random.RandomState(shuffle_seed).shuffle(image_label)
+                shard = [
+                    image_label[start:start + batch_size]
+                    for start in range(0, len(image_label), batch_size)
+                ][worker_id::num_workers]
+                return read_batches(sum(shard, []))
+
+            enqueuer = SharedMemoryEnqueuer(batch_generator, batch_bytes)
+            try:
+                enqueuer.start(max_queue_size=max_queue, workers=num_workers)
+                for batch in enqueuer.get():
+                    yield self.make_batch(*batch)
+            finally:
+                enqueuer.stop()
 
         return reader
 
@@ -96,21 +116,32 @@ class DataGenerater:
 
     def process_train_data(self, image, label):
         """
-        Process training data.
+        Process training data, returns the uint8 image and its labels at
+        1/4, 1/8 and 1/16 of the size, see make_batch.
         """
-        image, label = self.load(image, label)
+        image = cv2.imread(DATA_PATH + "/" + image, cv2.IMREAD_COLOR)
+        label = cv2.imread(DATA_PATH + "/" + label, cv2.IMREAD_GRAYSCALE)
         if self.flip:
             image, label = self.random_flip(image, label)
         if self.scaling:
             image, label = self.random_scaling(image, label)
         image, label = self.resize(image, label, out_size=TRAIN_DATA_SHAPE[1:])
-        label = label.astype("float32")
-        label_sub1 = dataset.image.to_chw(self.scale_label(label, factor=4))
-        label_sub2 = dataset.image.to_chw(self.scale_label(label, factor=8))
-        label_sub4 = dataset.image.to_chw(self.scale_label(label, factor=16))
-        image = dataset.image.to_chw(image)
+        label_sub1 = self.scale_label(label, factor=4)[:, :, 0]
+        label_sub2 = self.scale_label(label, factor=8)[:, :, 0]
+        label_sub4 = self.scale_label(label, factor=16)[:, :, 0]
         return image, label_sub1, label_sub2, label_sub4
 
+    def make_batch(self, images, labels_sub1, labels_sub2, labels_sub4):
+        """
+        Normalize a batch of uint8 NHWC images and add the channel axis to
+        its NHW labels.
+        """
+        images = images.transpose(0, 3, 1, 2).astype("float32")
+        images -= IMG_MEAN[:, np.newaxis, np.newaxis]
+        return self.mask(images, labels_sub1[:, np.newaxis].astype("float32"),
+                         labels_sub2[:, np.newaxis].astype("float32"),
+                         labels_sub4[:, np.newaxis].astype("float32"))
+
     def load(self, image, label):
         """
         Load image from file.
@@ -144,16 +175,19 @@ class DataGenerater:
             label, (w_new, h_new), interpolation=cv2.INTER_NEAREST)
         return image, label
 
-    def padding_as(self, image, h, w, is_color):
+    def padding_as(self, image, h, w, value):
         """
         Padding image.
         """
         pad_h = max(image.shape[0], h) - image.shape[0]
         pad_w = max(image.shape[1], w) - image.shape[1]
-        if is_color:
-            return np.pad(image, ((0, pad_h), (0, pad_w), (0, 0)), 'constant')
-        else:
-            return np.pad(image, ((0, pad_h), (0, pad_w)), 'constant')
+        if pad_h == 0 and pad_w == 0:
+            return image
+        pad_width = [(0, pad_h), (0, pad_w)] + [(0, 0)] * (image.ndim - 2)
+        out = np.pad(image, pad_width, 'constant')
+        out[image.shape[0]:] = value
+        out[:, image.shape[1]:] = value
+        return out
 
     def random_crop(self, im, out_shape, is_color=True):
         h, w = im.shape[:2]
@@ -168,19 +202,15 @@ class DataGenerater:
 
     def resize(self, image, label, out_size):
         """
-        Resize image and label by padding or cropping.
+        Resize image and label by padding or cropping, the image is padded
+        with the mean and the label with the ignore label.
         """
-        ignore_label = IGNORE_LABEL
-        label = label - ignore_label
-        if len(label.shape) == 2:
-            label = label[:, :, np.newaxis]
-        combined = np.concatenate((image, label), axis=2)
-        combined = self.padding_as(
-            combined, out_size[0], out_size[1], is_color=True)
+        combined = np.concatenate((image, label[:, :, np.newaxis]), axis=2)
+        pad_value = np.append(np.round(IMG_MEAN), IGNORE_LABEL)
+        combined = self.padding_as(combined, out_size[0], out_size[1],
+                                   pad_value.astype(combined.dtype))
         combined = self.random_crop(combined, out_size, is_color=True)
-        image = combined[:, :, 0:3]
-        label = combined[:, :, 3:4] + ignore_label
-        return image, label
+        return combined[:, :, 0:3], combined[:, :, 3]
 
     def scale_label(self, label, factor):
         """
@@ -205,7 +235,7 @@ class DataGenerater:
             "float32"), label0, mask_sub1, label1, mask_sub2, label2, mask_sub4
 
 
-def train(batch_size=32, flip=True, scaling=True):
+def train(batch_size=32, flip=True, scaling=True, num_workers=8):
     """
     Cityscape training set reader.
     It returns a reader, in which each result is a batch with batch_size samples.
@@ -216,11 +246,15 @@ def train(batch_size=32, flip=True, scaling=True):
     :type batch_size: bool
     :param scaling: Whether scale images randomly.
     :type batch_size: bool
+    :param num_workers: The number of processes reading the batches, 0 to
+    read them in the calling process.
+    :type num_workers: int
     :return: Training reader.
     :rtype: callable
     """
     reader = DataGenerater(
-        TRAIN_LIST, flip=flip, scaling=scaling).create_train_reader(batch_size)
+        TRAIN_LIST, flip=flip,
+        scaling=scaling).create_train_reader(batch_size, num_workers)
     return reader
 
 
@@ -28,6 +28,7 @@ add_arg('init_model',        str,   None,       "Pretrain model path.")
 add_arg('use_gpu',           bool,  True,       "Whether use GPU to train.")
 add_arg('random_mirror',     bool,  True,       "Whether prepare by random mirror.")
 add_arg('random_scaling',    bool,  True,       "Whether prepare by random scaling.")
+add_arg('num_workers',       int,   8,          "The number of processes reading training data, 0 to read it in the training process.")
 # yapf: enable
 
 LAMBDA1 = 0.16
@@ -108,7 +109,10 @@ def train(args):
     sub24_loss = 0.
     sub124_loss = 0.
     train_reader = cityscape.train(
-        args.batch_size, flip=args.random_mirror, scaling=args.random_scaling)
+        args.batch_size,
+        flip=args.random_mirror,
+        scaling=args.random_scaling,
+        num_workers=args.num_workers)
     start_time = time.time()
     while True:
         # train a pass
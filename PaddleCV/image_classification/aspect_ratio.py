@@ -0,0 +1,95 @@
+"""Aspect-ratio-bucketed rectangular validation.
+
+Instead of center-cropping every validation image to a square, images are
+sorted by aspect ratio and batched in that order; every batch is then cropped
+to one rectangle matching the mean aspect ratio of its images, which keeps
+more pixels of each image. The same approach is used by the fast_imagenet
+trainer.
+
+Computing the aspect ratios needs the size of every image, so the sorted index
+is cached next to the list file, keyed by a fingerprint of the list and the
+data dir.
+
+Rectangular inputs only work for models ending in global pooling; models that
+flatten fixed-size feature maps into fc layers are rejected by
+``check_model``.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import hashlib
+import numpy as np
+from PIL import Image
+
+import image_shard
+
+# models whose fc layers expect a fixed input size
+FIXED_INPUT_MODELS = ('AlexNet', 'VGG', 'GoogleNet')
+
+
+def check_model(model_name):
+    assert not model_name.startswith(FIXED_INPUT_MODELS), \
+        "{} needs a fixed input size and does not support rect_val".format(
+            model_name)
+
+
+def _fingerprint(file_list, data_dir):
+    md5 = hashlib.md5()
+    if image_shard.is_shard_dir(file_list):
+        with open(os.path.join(file_list, image_shard.SHARD_META), 'rb') as f:
+            md5.update(f.read())
+    else:
+        with open(file_list, 'rb') as f:
+            md5.update(f.read())
+    md5.update(os.path.abspath(data_dir).encode('utf-8'))
+    return md5.hexdigest()[:16]
+
+
+def _compute_ars(file_list, data_dir):
+    if image_shard.is_shard_dir(file_list):
+        index = np.concatenate([s.index for s in
+                                image_shard.open_shards(file_list)])
+        return index[:, 2] / index[:, 1].astype('float32')
+    ars = []
+    with open(file_list) as flist:
+        for line in flist:
+            img_path = line.split()[0]
+            # opening only reads the header, the image is not decoded
+            w, h = Image.open(os.path.join(data_dir, img_path)).size
+            ars.append(float(w) / h)
+    return np.array(ars, dtype='float32')
+
+
+def sort_ar(file_list, data_dir):
+    """Return the sample indices sorted by aspect ratio (w / h) and the
+    sorted aspect ratios, cached by fingerprint."""
+    cache_dir = file_list if image_shard.is_shard_dir(
+        file_list) else os.path.dirname(file_list)
+    cache_file = os.path.join(
+        cache_dir, 'ar_index_%s.npy' % _fingerprint(file_list, data_dir))
+    if os.path.isfile(cache_file):
+        idx_ar = np.load(cache_file)
+    else:
+        print("Creating AR index, this may take a couple of minutes...")
+        ars = _compute_ars(file_list, data_dir)
+        idx = np.argsort(ars, kind='mergesort')
+        idx_ar = np.stack([idx.astype('float64'), ars[idx]], axis=1)
+        np.save(cache_file, idx_ar)
+    return idx_ar[:, 0].astype('int64'), idx_ar[:, 1]
+
+
+def batch_ars(ars_sorted, batch_size):
+    """Mean aspect ratio of every batch of the sorted samples."""
+    return [
+        float(np.mean(ars_sorted[i:i + batch_size]))
+        for i in range(0, len(ars_sorted), batch_size)
+    ]
+
+
+def target_size(ar, crop_size):
+    """(height, width) of the crop for a batch of aspect ratio ``ar``: the
+    short side is ``crop_size``, the long side a multiple of 8."""
+    if ar < 1:
+        return int(crop_size / ar) // 8 * 8, crop_size
+    return crop_size, int(crop_size * ar) // 8 * 8
@@ -0,0 +1,148 @@
+"""Batch-level augmentation and normalization for the ImageNet readers.
+
+With ``batch_augment=True`` the sample readers in ``reader.py`` and
+``reader_cv2.py`` only decode and crop, and emit HWC RGB uint8 images. The
+random flip, color jitter, float32 conversion, mean/std normalization and the
+CHW transpose are then done here once per batch as whole-array NumPy
+operations, which cuts both the per-image Python overhead in the mapper
+threads and the bytes pushed through the ``xmap_readers`` queue by 4x.
+
+Usage:
+
+.. code-block:: python
+
+    train_reader = batch_augment.batch_reader(
+        reader.train(settings=args, batch_augment=True),
+        batch_size=batch_size, mode='train', drop_last=True)
+    py_reader.decorate_tensor_provider(train_reader)
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+IMG_MEAN = [0.485, 0.456, 0.406]
+IMG_STD = [0.229, 0.224, 0.225]
+
+# ITU-R 601-2 luma transform, the same one PIL uses for convert('L')
+GRAY_COEF = np.array([0.299, 0.587, 0.114], dtype='float32')
+
+
+def random_flip(imgs):
+    """Flip a random half of an NHWC batch left-right, in place."""
+    mask = np.random.randint(0, 2, imgs.shape[0]).astype('bool')
+    imgs[mask] = imgs[mask, :, ::-1]
+    return imgs
+
+
+def distort_color(imgs, lower=0.5, upper=1.5):
+    """Random brightness, contrast and saturation of an NHWC batch.
+
+    Vectorized equivalent of ``reader.distort_color``: every image gets its
+    own enhance factors, and the three ops are applied in a random order
+    (shared by the batch), clipping to [0, 255] after each op like PIL does.
+    Returns a float32 NHWC batch.
+    """
+    n = imgs.shape[0]
+    imgs = imgs.astype('float32')
+
+    def factor():
+        return np.random.uniform(lower, upper,
+                                 (n, 1, 1, 1)).astype('float32')
+
+    def random_brightness(x):
+        x *= factor()
+        return x
+
+    def random_contrast(x):
+        mean = np.dot(x, GRAY_COEF).mean(axis=(1, 2)).reshape((n, 1, 1, 1))
+        e = factor()
+        x *= e
+        x += (1 - e) * mean
+        return x
+
+    def random_color(x):
+        gray = np.dot(x, GRAY_COEF)[..., np.newaxis]
+        e = factor()
+        x *= e
+        x += (1 - e) * gray
+        return x
+
+    ops = [random_brightness, random_contrast, random_color]
+    np.random.shuffle(ops)
+    for op in ops:
+        imgs = op(imgs)
+        np.clip(imgs, 0, 255, out=imgs)
+    return imgs
+
+
+def normalize(imgs, mean=None, std=None):
+    """Convert an NHWC batch in [0, 255] into a normalized NCHW float32 one."""
+    mean = IMG_MEAN if mean is None else mean
+    std = IMG_STD if std is None else std
+    mean = np.array(mean, dtype='float32').reshape((1, 3, 1, 1)) * 255
+    scale = 1.0 / (np.array(std, dtype='float32').reshape((1, 3, 1, 1)) * 255)
+
+    chw = imgs.transpose((0, 3, 1, 2))
+    out = np.empty(chw.shape, dtype='float32')
+    np.subtract(chw, mean, out=out)
+    out *= scale
+    return out
+
+
+def augment(imgs, mode, color_jitter=False, mean=None, std=None):
+    """Run the batch stage on a stacked NHWC uint8 batch."""
+    if mode == 'train':
+        imgs = random_flip(imgs)
+        if color_jitter:
+            imgs = distort_color(imgs)
+    return normalize(imgs, mean=mean, std=std)
+
+
+def batch_reader(reader,
+                 batch_size,
+                 mode,
+                 color_jitter=False,
+                 mean=None,
+                 std=None,
+                 drop_last=False):
+    """Batch a uint8 sample reader and augment each batch as a whole.
+
+    ``reader`` yields ``(img, label)`` (or ``(img, )`` in test mode) with HWC
+    RGB uint8 images of the same shape within a batch. The returned reader
+    yields ``[imgs, labels]`` (or ``[imgs]``), ready for
+    ``py_reader.decorate_tensor_provider``.
+    """
+    batch_size = int(batch_size)
+
+    def _batch(buf, labels, size):
+        imgs = augment(
+            buf[:size], mode, color_jitter=color_jitter, mean=mean, std=std)
+        if mode == 'test':
+            return [imgs]
+        return [imgs, np.array(labels, dtype='int64').reshape((-1, 1))]
+
+    def _reader():
+        # staging buffer for the uint8 samples, reused across batches
+        buf = None
+        labels = []
+        size = 0
+        for sample in reader():
+            img = sample[0]
+            if buf is None or buf.shape[1:] != img.shape:
+                assert size == 0, \
+                    "images in a batch must have the same shape, " \
+                    "got {} and {}".format(buf.shape[1:], img.shape)
+                buf = np.empty((batch_size, ) + img.shape, dtype='uint8')
+            buf[size] = img
+            if mode != 'test':
+                labels.append(sample[1])
+            size += 1
+            if size == batch_size:
+                yield _batch(buf, labels, size)
+                labels = []
+                size = 0
+        if size > 0 and not drop_last:
+            yield _batch(buf, labels, size)
+
+    return _reader
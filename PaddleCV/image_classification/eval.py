@@ -11,6 +11,7 @@ import reader_cv2 as reader
 import argparse
 import functools
 import models
+import aspect_ratio
 from utils.learning_rate import cosine_decay
 from utils.utility import add_arguments, print_arguments
 import math
@@ -26,6 +27,9 @@ add_arg('with_mem_opt',     bool, True,                "Whether to use memory op
 add_arg('pretrained_model', str,  None,                "Whether to use pretrained model.")
 add_arg('model',            str,  "SE_ResNeXt50_32x4d", "Set the network to use.")
 add_arg('resize_short_size', int, 256,                "Set resize short size")
+add_arg('data_dir',         str,  "./data/ILSVRC2012/", "The ImageNet dataset root dir.")
+add_arg('rect_val',         bool, False,               "Whether to evaluate on aspect-ratio-bucketed rectangular crops.")
+add_arg('reader_workers',   int,  0,                    "Number of reader processes, 0 to use reader threads.")
 # yapf: enable
 
 def eval(args):
@@ -39,6 +43,8 @@ def eval(args):
     model_list = [m for m in dir(models) if "__" not in m]
     assert model_name in model_list, "{} is not in lists: {}".format(args.model,
                                                                      model_list)
+    if args.rect_val:
+        aspect_ratio.check_model(model_name)
 
     image = fluid.layers.data(name='image', shape=image_shape, dtype='float32')
     label = fluid.layers.data(name='label', shape=[1], dtype='int64')
@@ -80,25 +86,38 @@ def eval(args):
 
     fluid.io.load_persistables(exe, pretrained_model)
 
-    val_reader = paddle.batch(reader.val(settings=args), batch_size=args.batch_size)
+    if args.rect_val:
+        # batches of different crop sizes, fed as numpy arrays
+        val_reader = reader.rect_val(
+            settings=args, batch_size=args.batch_size, data_dir=args.data_dir)
+    else:
+        val_reader = paddle.batch(
+            reader.val(settings=args, data_dir=args.data_dir),
+            batch_size=args.batch_size)
     feeder = fluid.DataFeeder(place=place, feed_list=[image, label])
 
     test_info = [[], [], []]
     cnt = 0
     for batch_id, data in enumerate(val_reader()):
+        if args.rect_val:
+            feed = {'image': data[0], 'label': data[1]}
+            batch_len = len(data[1])
+        else:
+            feed = feeder.feed(data)
+            batch_len = len(data)
         t1 = time.time()
         loss, acc1, acc5 = exe.run(test_program,
                                    fetch_list=fetch_list,
-                                   feed=feeder.feed(data))
+                                   feed=feed)
         t2 = time.time()
         period = t2 - t1
         loss = np.mean(loss)
         acc1 = np.mean(acc1)
         acc5 = np.mean(acc5)
-        test_info[0].append(loss * len(data))
-        test_info[1].append(acc1 * len(data))
-        test_info[2].append(acc5 * len(data))
-        cnt += len(data)
+        test_info[0].append(loss * batch_len)
+        test_info[1].append(acc1 * batch_len)
+        test_info[2].append(acc5 * batch_len)
+        cnt += batch_len
         if batch_id % 10 == 0:
             print("Testbatch {0},loss {1}, "
                   "acc1 {2},acc5 {3},time {4}".format(batch_id, \
@@ -0,0 +1,136 @@
+"""Throughput benchmark of the fast_imagenet data loaders.
+
+Compares ``reader.PaddleDataLoader`` (task queue + shared-memory ring buffer)
+against the previous loader, which sliced the indices across workers and
+busy-polled one ``multiprocessing.Queue`` per worker.
+
+Usage:
+
+.. code-block:: bash
+
+    python benchmark_reader.py --data_dir=/data/imagenet --trn_dir=160/ --num_images=20000
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import functools
+import math
+import multiprocessing
+import random
+import time
+
+import numpy as np
+
+import datasets
+import reader
+import transforms
+from utility import add_arguments, print_arguments
+
+FINISH_EVENT = "FINISH_EVENT"
+
+
+class PollingDataLoader(object):
+    """The previous PaddleDataLoader, kept as the benchmark baseline."""
+
+    def __init__(self, dataset, indices, concurrent=24, queue_size=3072):
+        self.dataset = dataset
+        self.indices = indices
+        self.concurrent = concurrent
+        self.queue_size = queue_size // self.concurrent
+
+    def _worker_loop(self, queue, worker_indices, worker_id):
+        for idx in worker_indices:
+            img, label = self.dataset[idx]
+            img = np.array(img).astype('uint8').transpose((2, 0, 1))
+            queue.put((img, label))
+        queue.put(FINISH_EVENT)
+
+    def reader(self):
+        def _reader_creator():
+            worker_processes = []
+            index_queues = []
+            total_img = len(self.indices)
+            imgs_per_worker = int(math.ceil(total_img / self.concurrent))
+            for i in range(self.concurrent):
+                start = i * imgs_per_worker
+                end = (i + 1
+                       ) * imgs_per_worker if i != self.concurrent - 1 else None
+                index_queue = multiprocessing.Queue(self.queue_size)
+                w = multiprocessing.Process(
+                    target=self._worker_loop,
+                    args=(index_queue, self.indices[start:end], i))
+                w.daemon = True
+                w.start()
+                worker_processes.append(w)
+                index_queues.append(index_queue)
+            finish_workers = 0
+            recv_index = 0
+            while finish_workers < len(worker_processes):
+                while (index_queues[recv_index].empty()):
+                    recv_index = (recv_index + 1) % self.concurrent
+                sample = index_queues[recv_index].get()
+                recv_index = (recv_index + 1) % self.concurrent
+                if sample == FINISH_EVENT:
+                    finish_workers += 1
+                else:
+                    yield sample
+
+        return _reader_creator
+
+
+def run(name, reader_creator, num_images):
+    start = time.time()
+    cnt = 0
+    for _ in reader_creator():
+        cnt += 1
+    period = time.time() - start
+    assert cnt == num_images, "%s read %d of %d images" % (name, cnt,
+                                                           num_images)
+    print("%-10s %d images in %.2f sec, %.1f images/sec" %
+          (name, cnt, period, cnt / period))
+    return cnt / period
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    # yapf: disable
+    add_arg('data_dir',         str,   "./data/ILSVRC2012",  "The ImageNet dataset root dir.")
+    add_arg('trn_dir',          str,   "160/",               "Sub dir of the resized training images.")
+    add_arg('img_dim',          int,   128,                  "Training image size.")
+    add_arg('num_images',       int,   20000,                "Number of images to read, 0 for all.")
+    add_arg('concurrent',       int,   24,                   "Number of worker processes.")
+    # yapf: enable
+    args = parser.parse_args()
+    print_arguments(args)
+
+    train_tfms = [
+        transforms.RandomResizedCrop(args.img_dim),
+        transforms.RandomHorizontalFlip()
+    ]
+    dataset = datasets.ImageFolder(
+        "%s/%strain" % (args.data_dir, args.trn_dir),
+        transforms.Compose(train_tfms))
+    indices = list(range(len(dataset)))
+    random.seed(0)
+    random.shuffle(indices)
+    if args.num_images > 0:
+        indices = indices[:args.num_images]
+
+    baseline = run("polling",
+                   PollingDataLoader(
+                       dataset, indices, concurrent=args.concurrent).reader(),
+                   len(indices))
+    current = run("shm",
+                  reader.PaddleDataLoader(
+                      dataset,
+                      indices=indices,
+                      concurrent=args.concurrent,
+                      shuffle=False,
+                      sample_bytes=3 * args.img_dim * args.img_dim).reader(),
+                  len(indices))
+    print("speedup: %.2fx" % (current / baseline))
+
+
+if __name__ == '__main__':
+    main()
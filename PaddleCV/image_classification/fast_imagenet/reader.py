@@ -8,77 +8,201 @@ import random
 import pickle
 from tqdm import tqdm
 import time
+import ctypes
+import threading
+import traceback
 import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import transforms
 import datasets
 
 FINISH_EVENT = "FINISH_EVENT"
+ERROR_EVENT = "ERROR_EVENT"
+
+# how often blocked calls wake up to check for stop/dead workers, in seconds
+POLL_INTERVAL = 1.0
+# number of indices handed to a worker at a time
+CHUNK_SIZE = 16
 
 
 class PaddleDataLoader(object):
+    """Multiprocess loader for a map-style dataset.
+
+    Workers pull chunks of indices from one shared task queue, so a slow
+    worker simply takes fewer chunks instead of stalling a fixed slice of the
+    dataset. Decoded images are written into a preallocated shared-memory
+    ring buffer of ``queue_size`` slots of ``sample_bytes`` bytes; only slot
+    ids, shapes and labels go through the (blocking) ready queue. Samples
+    larger than a slot are sent through the queue instead.
+
+    If ``ordered`` is set, samples are yielded in index order, which the
+    rectangular validation needs to keep images of similar aspect ratio in the
+    same batch.
+    """
+
     def __init__(self,
                  dataset,
                  indices=None,
                  concurrent=24,
-                 queue_size=3072,
+                 queue_size=1024,
                  shuffle=True,
-                 shuffle_seed=0):
+                 shuffle_seed=0,
+                 ordered=False,
+                 sample_bytes=3 * 224 * 224):
         self.dataset = dataset
         self.indices = indices
         self.concurrent = concurrent
         self.shuffle = shuffle
         self.shuffle_seed = shuffle_seed
-        self.queue_size = queue_size // self.concurrent
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.sample_bytes = sample_bytes
+        self._buf = None
 
-    def _worker_loop(self, queue, worker_indices, worker_id):
+    def _worker_loop(self, task_queue, free_slots, ready_queue, worker_id):
+        # forked workers share the parent's RNG state, reseed them for the
+        # random transforms
+        seed = self.shuffle_seed * self.concurrent + worker_id
+        random.seed(seed)
+        np.random.seed(seed)
+        data = np.frombuffer(self._buf, dtype='uint8')
         cnt = 0
-        for idx in worker_indices:
-            cnt += 1
-            img, label = self.dataset[idx]
-            img = np.array(img).astype('uint8').transpose((2, 0, 1))
-            queue.put((img, label))
+        try:
+            while True:
+                task = task_queue.get()
+                if task is None:
+                    break
+                start_seq, chunk = task
+                for i, idx in enumerate(chunk):
+                    img, label = self.dataset[idx]
+                    img = np.array(img).astype('uint8').transpose((2, 0, 1))
+                    if img.nbytes > self.sample_bytes:
+                        ready_queue.put((start_seq + i, None, img, label))
+                    else:
+                        slot = free_slots.get()
+                        base = slot * self.sample_bytes
+                        data[base:base + img.nbytes] = img.reshape(-1)
+                        ready_queue.put((start_seq + i, slot, img.shape, label))
+                    cnt += 1
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            ready_queue.put((ERROR_EVENT, None, traceback.format_exc(), None))
         print("worker: [%d] read [%d] samples. " % (worker_id, cnt))
-        queue.put(FINISH_EVENT)
+        ready_queue.put((FINISH_EVENT, None, None, None))
 
     def reader(self):
         def _reader_creator():
-            worker_processes = []
-            index_queues = []
             total_img = len(self.dataset)
             print("total image: ", total_img)
             if self.shuffle:
-                self.indices = [i for i in xrange(total_img)]
+                self.indices = [i for i in range(total_img)]
                 random.seed(self.shuffle_seed)
                 random.shuffle(self.indices)
                 print("shuffle indices: %s ..." % self.indices[:10])
+            indices = self.indices
+            if indices is None:
+                indices = range(total_img)
+
+            if self._buf is None:
+                # allocated once before forking, reused by every epoch
+                self._buf = multiprocessing.RawArray(
+                    ctypes.c_uint8, self.queue_size * self.sample_bytes)
+            data = np.frombuffer(self._buf, dtype='uint8')
+
+            task_queue = multiprocessing.Queue(self.concurrent * 2)
+            free_slots = multiprocessing.Queue()
+            ready_queue = multiprocessing.Queue()
+            for slot in range(self.queue_size):
+                free_slots.put(slot)
+            stop_event = threading.Event()
+            # bounds the samples in flight, and so the reorder buffer
+            window = threading.Semaphore(self.queue_size)
 
-            imgs_per_worker = int(math.ceil(total_img / self.concurrent))
-            for i in xrange(self.concurrent):
-                start = i * imgs_per_worker
-                end = (i + 1
-                       ) * imgs_per_worker if i != self.concurrent - 1 else None
-                sliced_indices = self.indices[start:end]
-                index_queue = multiprocessing.Queue(self.queue_size)
+            worker_processes = []
+            for i in range(self.concurrent):
                 w = multiprocessing.Process(
                     target=self._worker_loop,
-                    args=(index_queue, sliced_indices, i))
+                    args=(task_queue, free_slots, ready_queue, i))
                 w.daemon = True
                 w.start()
                 worker_processes.append(w)
-                index_queues.append(index_queue)
+
+            def _put(item):
+                while not stop_event.is_set():
+                    try:
+                        task_queue.put(item, timeout=POLL_INTERVAL)
+                        return True
+                    except queue.Full:
+                        pass
+                return False
+
+            def _feed():
+                for start in range(0, len(indices), CHUNK_SIZE):
+                    chunk = list(indices[start:start + CHUNK_SIZE])
+                    for _ in chunk:
+                        while not window.acquire(False):
+                            if stop_event.wait(0.01):
+                                return
+                    if not _put((start, chunk)):
+                        return
+                for _ in worker_processes:
+                    _put(None)
+
+            feeder = threading.Thread(target=_feed)
+            feeder.daemon = True
+            feeder.start()
+
             finish_workers = 0
             worker_cnt = len(worker_processes)
-            recv_index = 0
-            while finish_workers < worker_cnt:
-                while (index_queues[recv_index].empty()):
-                    recv_index = (recv_index + 1) % self.concurrent
-                sample = index_queues[recv_index].get()
-                recv_index = (recv_index + 1) % self.concurrent
-                if sample == FINISH_EVENT:
-                    finish_workers += 1
-                else:
-                    yield sample
+            next_seq = 0
+            pending = {}
+            try:
+                while finish_workers < worker_cnt:
+                    try:
+                        seq, slot, img, label = ready_queue.get(
+                            timeout=POLL_INTERVAL)
+                    except queue.Empty:
+                        if any(w.exitcode not in (None, 0)
+                               for w in worker_processes):
+                            raise RuntimeError(
+                                "reader worker exited unexpectedly")
+                        continue
+                    if seq == FINISH_EVENT:
+                        finish_workers += 1
+                        continue
+                    if seq == ERROR_EVENT:
+                        raise RuntimeError("reader worker failed:\n" + img)
+                    if slot is not None:
+                        base = slot * self.sample_bytes
+                        size = int(np.prod(img))
+                        img = data[base:base + size].reshape(img).copy()
+                        free_slots.put(slot)
+                    if not self.ordered:
+                        window.release()
+                        yield img, label
+                        continue
+                    pending[seq] = (img, label)
+                    while next_seq in pending:
+                        sample = pending.pop(next_seq)
+                        next_seq += 1
+                        window.release()
+                        yield sample
+            finally:
+                stop_event.set()
+                for w in worker_processes:
+                    if finish_workers < worker_cnt and w.is_alive():
+                        # abandoned mid-epoch or failed
+                        w.terminate()
+                    w.join()
+                feeder.join()
+                for q in (task_queue, free_slots, ready_queue):
+                    q.cancel_join_thread()
+                    q.close()
 
         return _reader_creator
 
@@ -90,7 +214,9 @@ def train(traindir, sz, min_scale=0.08, shuffle_seed=0):
     ]
     train_dataset = datasets.ImageFolder(traindir,
                                          transforms.Compose(train_tfms))
-    return PaddleDataLoader(train_dataset, shuffle_seed=shuffle_seed).reader()
+    return PaddleDataLoader(
+        train_dataset, shuffle_seed=shuffle_seed,
+        sample_bytes=3 * sz * sz).reader()
 
 
 def test(valdir, bs, sz, rect_val=False):
@@ -101,14 +227,20 @@ def test(valdir, bs, sz, rect_val=False):
 
         ar_tfms = [transforms.Resize(int(sz * 1.14)), CropArTfm(idx2ar, sz)]
         val_dataset = ValDataset(valdir, transform=ar_tfms)
+        # rectangular crops can be larger than sz x sz, bigger ones are sent
+        # through the queue
         return PaddleDataLoader(
-            val_dataset, concurrent=1, indices=idx_sorted,
-            shuffle=False).reader()
+            val_dataset,
+            indices=idx_sorted,
+            shuffle=False,
+            ordered=True,
+            sample_bytes=3 * sz * sz * 2).reader()
 
     val_tfms = [transforms.Resize(int(sz * 1.14)), transforms.CenterCrop(sz)]
     val_dataset = datasets.ImageFolder(valdir, transforms.Compose(val_tfms))
 
-    return PaddleDataLoader(val_dataset).reader()
+    return PaddleDataLoader(
+        val_dataset, sample_bytes=3 * sz * sz).reader()
 
 
 class ValDataset(datasets.ImageFolder):
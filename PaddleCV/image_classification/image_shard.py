@@ -0,0 +1,286 @@
+"""Pre-decoded, memory-mapped image shards for the ImageNet readers.
+
+Decoding JPEGs on every epoch makes multi-GPU training decode bound. This
+module packs an image list (e.g. ``train_list.txt``) once into large shard
+files holding resized-short-side RGB uint8 pixels, and serves them back
+through ``np.memmap`` so a sample is a zero-copy slice of the page cache.
+
+Usage:
+
+.. code-block:: bash
+
+    python image_shard.py --data_dir=./data/ILSVRC2012/ --list=train
+    python image_shard.py --data_dir=./data/ILSVRC2012/ --list=val --shuffle=False
+
+This writes ``<data_dir>/train_shards`` and ``<data_dir>/val_shards``, which
+``reader.py``/``reader_cv2.py`` then pick up transparently.
+
+Layout of a shard directory:
+
+* ``shards.json``: meta info (format version, resize size, shard names).
+* ``shard-XXXXX.bin``: concatenated HWC RGB uint8 pixels.
+* ``shard-XXXXX.idx.npy``: int64 array with one ``(offset, height, width,
+  label)`` row per image.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import json
+import argparse
+import functools
+import multiprocessing
+import numpy as np
+from PIL import Image
+
+from utils.utility import add_arguments, print_arguments
+
+SHARD_META = 'shards.json'
+SHARD_VERSION = 1
+
+
+def shard_dir_of(data_dir, name):
+    """Return the shard directory packed from ``<name>_list.txt``."""
+    return os.path.join(data_dir, '%s_shards' % name)
+
+
+def is_shard_dir(path):
+    return os.path.isfile(os.path.join(path, SHARD_META))
+
+
+def load_meta(shard_dir):
+    with open(os.path.join(shard_dir, SHARD_META)) as f:
+        meta = json.load(f)
+    assert meta['version'] == SHARD_VERSION, \
+        "unsupported shard version {} in {}".format(meta['version'], shard_dir)
+    return meta
+
+
+# memmaps of the shard pixel files opened by this process, by path
+_memmaps = {}
+
+
+def _memmap(data_path):
+    data = _memmaps.get(data_path)
+    if data is None:
+        data = np.memmap(data_path, dtype='uint8', mode='r')
+        _memmaps[data_path] = data
+    return data
+
+
+class ShardImage(object):
+    """Reference to the pixels of one image in a shard file.
+
+    It pickles to a few bytes, so readers hand it to mapper processes instead
+    of the pixels, and ``numpy()`` slices the memmap in the process that
+    decodes the sample.
+    """
+
+    def __init__(self, data_path, offset, height, width):
+        self.data_path = data_path
+        self.offset = offset
+        self.height = height
+        self.width = width
+
+    def numpy(self):
+        """Return a read-only HWC RGB uint8 view into the mapped shard."""
+        size = self.height * self.width * 3
+        data = _memmap(self.data_path)
+        return data[self.offset:self.offset + size].reshape(
+            (self.height, self.width, 3))
+
+
+class ImageShard(object):
+    """Random access to the images of one shard.
+
+    The pixel file is mapped lazily so that shard objects are cheap to
+    create and safe to hand to forked workers before first use.
+    """
+
+    def __init__(self, shard_dir, name):
+        self.data_path = os.path.join(shard_dir, name + '.bin')
+        self.index = np.load(os.path.join(shard_dir, name + '.idx.npy'))
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def image(self, i):
+        """Return the ``ShardImage`` and the label of image ``i``."""
+        offset, h, w, label = self.index[i]
+        return ShardImage(self.data_path, int(offset), int(h),
+                          int(w)), int(label)
+
+    def __getitem__(self, i):
+        img, label = self.image(i)
+        return img.numpy(), label
+
+
+def open_shards(shard_dir):
+    meta = load_meta(shard_dir)
+    return [ImageShard(shard_dir, s['name']) for s in meta['shards']]
+
+
+def shard_reader(shard_dir,
+                 mode,
+                 shuffle=False,
+                 pass_id_as_seed=1,
+                 infinite=False):
+    """Sample generator over a shard directory.
+
+    Yields ``(img, label)`` for train/val and ``[img]`` for test, where
+    ``img`` is a ``ShardImage``, so that only its offset and shape are sent
+    to the mapper workers.
+
+    In distributed training every trainer shuffles the shard list with the
+    same seed, lays the images of the shards end to end in that order and
+    reads its own contiguous ``total // PADDLE_TRAINERS_NUM`` of them, so all
+    trainers yield the same number of samples per pass. A trainer reads
+    whole shards apart from the ones at the borders of its range, and the
+    last ``total % PADDLE_TRAINERS_NUM`` images of a pass are dropped, like
+    the lines of a list file.
+    """
+    all_shards = open_shards(shard_dir)
+    total = sum(len(shard) for shard in all_shards)
+
+    def reader():
+        pass_id_as_seed_counter = pass_id_as_seed
+        while True:
+            shard_ids = list(range(len(all_shards)))
+            if shuffle:
+                if pass_id_as_seed_counter:
+                    np.random.seed(pass_id_as_seed_counter)
+                np.random.shuffle(shard_ids)
+            begin, end = 0, total
+            if mode == 'train' and os.getenv('PADDLE_TRAINING_ROLE'):
+                trainer_id = int(os.getenv("PADDLE_TRAINER_ID", "0"))
+                trainer_count = int(os.getenv("PADDLE_TRAINERS_NUM", "1"))
+                per_node_images = total // trainer_count
+                begin = trainer_id * per_node_images
+                end = begin + per_node_images
+                print("read images from %d, length: %d, total: %d" %
+                      (begin, per_node_images, total))
+
+            # position of the current shard in the shuffled order of images
+            start = 0
+            for shard_id in shard_ids:
+                shard = all_shards[shard_id]
+                lo = max(begin - start, 0)
+                hi = min(end - start, len(shard))
+                start += len(shard)
+                if lo >= hi:
+                    continue
+                order = np.arange(lo, hi)
+                if shuffle:
+                    np.random.shuffle(order)
+                for i in order:
+                    img, label = shard.image(i)
+                    if mode == 'train' or mode == 'val':
+                        yield img, label
+                    elif mode == 'test':
+                        yield [img]
+            if not infinite:
+                break
+            pass_id_as_seed_counter += 1
+
+    return reader
+
+
+def _decode(line, data_dir, resize_short):
+    img_path, label = line.split()
+    img = Image.open(os.path.join(data_dir, img_path))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if resize_short > 0:
+        percent = float(resize_short) / min(img.size[0], img.size[1])
+        resized_width = int(round(img.size[0] * percent))
+        resized_height = int(round(img.size[1] * percent))
+        img = img.resize((resized_width, resized_height), Image.LANCZOS)
+    return np.asarray(img, dtype='uint8'), int(label)
+
+
+def pack(file_list,
+         data_dir,
+         output_dir,
+         resize_short=256,
+         images_per_shard=8192,
+         shuffle=True,
+         num_workers=8):
+    """Decode every image of ``file_list`` and write a shard directory.
+
+    Lists like ImageNet's ``train_list.txt`` are sorted by class, so they are
+    shuffled once (with a fixed seed) before packing; otherwise every shard
+    would hold only a few classes and within-shard shuffling could not mix
+    them.
+    """
+    with open(file_list) as flist:
+        lines = [line.strip() for line in flist if line.strip()]
+    if shuffle:
+        np.random.RandomState(0).shuffle(lines)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    decode = functools.partial(
+        _decode, data_dir=data_dir, resize_short=resize_short)
+    pool = multiprocessing.Pool(num_workers)
+    shards = []
+    try:
+        samples = pool.imap(decode, lines, chunksize=64)
+        for start in range(0, len(lines), images_per_shard):
+            name = 'shard-%05d' % len(shards)
+            num = min(images_per_shard, len(lines) - start)
+            index = np.zeros((num, 4), dtype='int64')
+            offset = 0
+            with open(os.path.join(output_dir, name + '.bin'), 'wb') as f:
+                for i in range(num):
+                    img, label = next(samples)
+                    h, w = img.shape[:2]
+                    index[i] = (offset, h, w, label)
+                    f.write(img.tobytes())
+                    offset += img.size
+            np.save(os.path.join(output_dir, name + '.idx.npy'), index)
+            shards.append({'name': name, 'num_images': num})
+            print("packed %s: %d images, %.2f GB" %
+                  (name, num, offset / 1024.0**3))
+    finally:
+        pool.close()
+        pool.join()
+
+    meta = {
+        'version': SHARD_VERSION,
+        'resize_short': resize_short,
+        'num_images': len(lines),
+        'shards': shards,
+    }
+    # written last, so a partially packed directory is never picked up
+    with open(os.path.join(output_dir, SHARD_META), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    # yapf: disable
+    add_arg('data_dir',         str,  "./data/ILSVRC2012/", "The ImageNet dataset root dir.")
+    add_arg('list',             str,  "train",    "Pack <data_dir>/<list>_list.txt.")
+    add_arg('output_dir',       str,  None,       "Output dir, <data_dir>/<list>_shards if not set.")
+    add_arg('resize_short',     int,  256,        "Resize the short side to this size, 0 to keep.")
+    add_arg('images_per_shard', int,  8192,       "Number of images per shard.")
+    add_arg('shuffle',          bool, True,       "Whether to shuffle the list before packing.")
+    add_arg('num_workers',      int,  8,          "Number of decoding processes.")
+    # yapf: enable
+    args = parser.parse_args()
+    print_arguments(args)
+    output_dir = args.output_dir or shard_dir_of(args.data_dir, args.list)
+    pack(
+        os.path.join(args.data_dir, '%s_list.txt' % args.list),
+        args.data_dir,
+        output_dir,
+        resize_short=args.resize_short,
+        images_per_shard=args.images_per_shard,
+        shuffle=args.shuffle,
+        num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,7 @@ import math
 parser = argparse.ArgumentParser(description=__doc__)
 # yapf: disable
 add_arg = functools.partial(add_arguments, argparser=parser)
+add_arg('batch_size',       int,  1,                    "Minibatch size.")
 add_arg('use_gpu',          bool, True,                 "Whether to use GPU or not.")
 add_arg('class_dim',        int,  1000,                 "Class number.")
 add_arg('image_shape',      str,  "3,224,224",          "Input image size")
@@ -26,6 +27,7 @@ add_arg('pretrained_model', str,  None,                 "Whether to use pretrain
 add_arg('model',            str,  "SE_ResNeXt50_32x4d", "Set the network to use.")
 add_arg('save_inference',   bool, False,                 "Whether to save inference model or not")
 add_arg('resize_short_size', int, 256,                  "Set resize short size")
+add_arg('reader_workers',   int,  0,                    "Number of reader processes, 0 to use reader threads.")
 # yapf: enable
 
 def infer(args):
@@ -73,7 +75,7 @@ def infer(args):
                 params_filename='params')
         print("model: ",model_name," is already saved")
         exit(0)
-    test_batch_size = 1
+    test_batch_size = args.batch_size
     test_reader = paddle.batch(reader.test(settings=args), batch_size=test_batch_size)
     feeder = fluid.DataFeeder(place=place, feed_list=[image])
 
@@ -82,10 +84,11 @@ def infer(args):
         result = exe.run(test_program,
                          fetch_list=fetch_list,
                          feed=feeder.feed(data))
-        result = result[0][0]
-        pred_label = np.argsort(result)[::-1][:TOPK]
-        print("Test-{0}-score: {1}, class {2}"
-              .format(batch_id, result[pred_label], pred_label))
+        for i, res in enumerate(result[0]):
+            pred_label = np.argsort(res)[::-1][:TOPK]
+            print("Test-{0}-score: {1}, class {2}"
+                  .format(batch_id * test_batch_size + i, res[pred_label],
+                          pred_label))
         sys.stdout.flush()
 
 
@@ -0,0 +1,247 @@
+"""Long-running, batched inference service for image classification.
+
+The inference model saved by ``infer.py --save_inference=True`` is loaded once.
+Images are POSTed as raw encoded bytes to ``http://<host>:<port>/infer``;
+decoding, resizing and cropping run in a process pool, and a batching thread
+groups concurrent requests into one executor run of up to ``max_batch_size``
+images, waiting at most ``max_latency_ms`` for a batch to fill up.
+``GET /stats`` reports the p50/p99 request latency and the throughput.
+
+Usage:
+
+.. code-block:: bash
+
+    python infer.py --model=ResNet50 --pretrained_model=${path_to_pretrain_model} --save_inference=True
+    python infer_server.py --model_dir=ResNet50 --port=8866
+    curl --data-binary @image.jpeg http://127.0.0.1:8866/infer
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import collections
+import functools
+import json
+import multiprocessing
+import threading
+import time
+
+import cv2
+import numpy as np
+import paddle.fluid as fluid
+from six.moves import BaseHTTPServer, queue, socketserver
+
+import batch_augment
+import reader_cv2 as reader
+from utils.utility import add_arguments, print_arguments
+
+parser = argparse.ArgumentParser(description=__doc__)
+add_arg = functools.partial(add_arguments, argparser=parser)
+# yapf: disable
+add_arg('model_dir',          str,   None,        "Directory of the saved inference model.")
+add_arg('use_gpu',            bool,  True,        "Whether to use GPU or not.")
+add_arg('host',               str,   "127.0.0.1", "Address to listen on.")
+add_arg('port',               int,   8866,        "Port to listen on.")
+add_arg('max_batch_size',     int,   32,          "Maximum number of images in one executor run.")
+add_arg('max_latency_ms',     float, 10.0,        "Maximum time to wait for a batch to fill up.")
+add_arg('preprocess_workers', int,   8,           "Number of preprocessing processes.")
+add_arg('image_shape',        str,   "3,224,224", "Input image size")
+add_arg('resize_short_size',  int,   256,         "Set resize short size")
+add_arg('topk',               int,   1,           "Number of top classes to return.")
+# yapf: enable
+
+# number of recent requests the latency percentiles are computed over
+STATS_WINDOW = 10000
+
+
+def preprocess(data, resize_short_size, crop_size):
+    """Decode an encoded image and center crop it to an HWC RGB uint8 array."""
+    img = cv2.imdecode(np.frombuffer(data, dtype='uint8'), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("cannot decode image")
+    img = reader.resize_short(img, resize_short_size)
+    img = reader.crop_image(img, target_size=crop_size, center=True)
+    return np.ascontiguousarray(img[:, :, ::-1])
+
+
+class Request(object):
+    def __init__(self, img, arrival):
+        self.img = img
+        # arrival includes the preprocessing time in the latency stats,
+        # queued bounds the wait for a batch to fill up
+        self.arrival = arrival
+        self.queued = time.time()
+        self.result = None
+        self.done = threading.Event()
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=STATS_WINDOW)
+        self.start = time.time()
+        self.requests = 0
+        self.batches = 0
+
+    def record(self, requests):
+        now = time.time()
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.latencies.extend(now - r.arrival for r in requests)
+
+    def report(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            period = time.time() - self.start
+            report = {
+                'requests': self.requests,
+                'batches': self.batches,
+                'avg_batch_size': self.requests / max(self.batches, 1),
+                'throughput': self.requests / period,
+            }
+        if len(latencies):
+            report['p50_ms'] = float(np.percentile(latencies, 50))
+            report['p99_ms'] = float(np.percentile(latencies, 99))
+        return report
+
+
+class Batcher(object):
+    """Groups queued requests into batches and runs them on one executor."""
+
+    def __init__(self, args):
+        place = fluid.CUDAPlace(0) if args.use_gpu else fluid.CPUPlace()
+        self.exe = fluid.Executor(place)
+        self.program, self.feed_names, self.fetch_targets = \
+            fluid.io.load_inference_model(
+                dirname=args.model_dir,
+                executor=self.exe,
+                model_filename='model',
+                params_filename='params')
+        self.max_batch_size = args.max_batch_size
+        self.max_latency = args.max_latency_ms / 1000.0
+        self.topk = args.topk
+        self.queue = queue.Queue()
+        self.stats = Stats()
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, img, arrival):
+        request = Request(img, arrival)
+        self.queue.put(request)
+        request.done.wait()
+        if isinstance(request.result, Exception):
+            raise request.result
+        return request.result
+
+    def _next_batch(self):
+        requests = [self.queue.get()]
+        deadline = requests[0].queued + self.max_latency
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return requests
+
+    def _loop(self):
+        while True:
+            requests = self._next_batch()
+            try:
+                imgs = batch_augment.normalize(
+                    np.stack([r.img for r in requests]))
+                probs, = self.exe.run(self.program,
+                                      feed={self.feed_names[0]: imgs},
+                                      fetch_list=self.fetch_targets)
+                labels = np.argsort(-probs, axis=1)[:, :self.topk]
+                for r, prob, label in zip(requests, probs, labels):
+                    r.result = {
+                        'class': label.tolist(),
+                        'score': prob[label].tolist()
+                    }
+            except Exception as e:
+                for r in requests:
+                    r.result = e
+            self.stats.record(requests)
+            for r in requests:
+                r.done.set()
+
+
+class InferServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(batcher, pool, preprocess_fn):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            body = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._reply(404, {'error': 'not found'})
+            self._reply(200, batcher.stats.report())
+
+        def do_POST(self):
+            if self.path != '/infer':
+                return self._reply(404, {'error': 'not found'})
+            arrival = time.time()
+            length = int(self.headers.get('Content-Length', 0))
+            data = self.rfile.read(length)
+            try:
+                img = pool.apply(preprocess_fn, (data, ))
+            except Exception as e:
+                # the image can not be decoded
+                return self._reply(400, {'error': str(e)})
+            try:
+                result = batcher.submit(img, arrival)
+            except Exception as e:
+                # the inference failed on the server
+                return self._reply(500, {'error': str(e)})
+            self._reply(200, result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(args):
+    crop_size = int(args.image_shape.split(",")[2])
+    preprocess_fn = functools.partial(
+        preprocess,
+        resize_short_size=args.resize_short_size,
+        crop_size=crop_size)
+    # fork the preprocessing workers before the executor starts any threads
+    pool = multiprocessing.Pool(args.preprocess_workers)
+    batcher = Batcher(args)
+    server = InferServer((args.host, args.port),
+                         make_handler(batcher, pool, preprocess_fn))
+    print("Serving {} on http://{}:{}".format(args.model_dir, args.host,
+                                              args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
+        print(json.dumps(batcher.stats.report()))
+
+
+def main():
+    args = parser.parse_args()
+    print_arguments(args)
+    serve(args)
+
+
+if __name__ == '__main__':
+    main()
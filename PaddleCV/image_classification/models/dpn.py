@@ -115,7 +115,8 @@ class DPN(object):
             pool_size=7,
             pool_stride=1,
             pool_padding=0,
-            pool_type='avg', )
+            pool_type='avg',
+            global_pooling=True, )
 
         stdv = 0.01
         param_attr = fluid.param_attr.ParamAttr(
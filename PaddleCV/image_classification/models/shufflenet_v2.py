@@ -62,7 +62,7 @@ class ShuffleNetV2():
                 
         conv_last = self.conv_bn_layer(input=conv, filter_size=1, num_filters=stage_out_channels[-1], 
                                        padding=0, stride=1, name='conv5')
-        pool_last = fluid.layers.pool2d(input=conv_last, pool_size=7, pool_stride=1, pool_padding=0, pool_type='avg')
+        pool_last = fluid.layers.pool2d(input=conv_last, pool_size=7, pool_stride=1, pool_padding=0, pool_type='avg', global_pooling=True)
 
 
         output = fluid.layers.fc(input=pool_last,
@@ -112,14 +112,18 @@ class ShuffleNetV2():
     def channel_shuffle(self, x, groups):
         batchsize, num_channels, height, width = x.shape[0], x.shape[1], x.shape[2], x.shape[3]
         channels_per_group = num_channels // groups
-    
-        # reshape
-        x = fluid.layers.reshape(x=x, shape=[batchsize, groups, channels_per_group, height, width])
+        # the runtime shape, height and width differ from the compile-time
+        # ones with rectangular inputs
+        x_shape = fluid.layers.shape(x)
+        x_shape.stop_gradient = True
+
+        # reshape, with the batch size copied and height * width inferred
+        x = fluid.layers.reshape(x=x, shape=[0, groups, channels_per_group, -1])
 
-        x = fluid.layers.transpose(x=x, perm=[0,2,1,3,4])
+        x = fluid.layers.transpose(x=x, perm=[0,2,1,3])
 
         # flatten
-        x = fluid.layers.reshape(x=x, shape=[batchsize, num_channels, height, width])
+        x = fluid.layers.reshape(x=x, shape=[batchsize, num_channels, height, width], actual_shape=x_shape)
 
         return x
 
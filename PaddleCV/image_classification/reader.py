@@ -1,4 +1,5 @@
 import os
+import sys
 import math
 import random
 import functools
@@ -6,6 +7,11 @@ import numpy as np
 import paddle
 from PIL import Image, ImageEnhance
 
+import image_shard
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from shm_utils import shm_reader
+
 random.seed(0)
 np.random.seed(0)
 
@@ -13,6 +19,8 @@ DATA_DIM = 224
 
 THREAD = 8
 BUF_SIZE = 1024
+# slots of the shared-memory ring buffer when reading with worker processes
+SHM_BUF_SIZE = 256
 
 DATA_DIR = 'data/ILSVRC2012'
 
@@ -96,17 +104,19 @@ def distort_color(img):
     return img
 
 
-def process_image(sample, mode, color_jitter, rotate):
-    img_path = sample[0]
-
-    img = Image.open(img_path)
+def process_image(sample, mode, color_jitter, rotate, batch_augment=False):
+    if isinstance(sample[0], image_shard.ShardImage):
+        # pre-decoded RGB sample from image_shard
+        img = Image.fromarray(sample[0].numpy())
+    else:
+        img = Image.open(sample[0])
     if mode == 'train':
         if rotate: img = rotate_image(img)
         img = random_crop(img, DATA_DIM)
     else:
         img = resize_short(img, target_size=256)
         img = crop_image(img, target_size=DATA_DIM, center=True)
-    if mode == 'train':
+    if mode == 'train' and not batch_augment:
         if color_jitter:
             img = distort_color(img)
         if np.random.randint(0, 2) == 1:
@@ -115,9 +125,13 @@ def process_image(sample, mode, color_jitter, rotate):
     if img.mode != 'RGB':
         img = img.convert('RGB')
 
-    img = np.array(img).astype('float32').transpose((2, 0, 1)) / 255
-    img -= img_mean
-    img /= img_std
+    if batch_augment:
+        # flip, color jitter and normalization are done by batch_augment
+        img = np.asarray(img, dtype='uint8')
+    else:
+        img = np.array(img).astype('float32').transpose((2, 0, 1)) / 255
+        img -= img_mean
+        img /= img_std
 
     if mode == 'train' or mode == 'val':
         return img, sample[1]
@@ -132,7 +146,33 @@ def _reader_creator(file_list,
                     rotate=False,
                     data_dir=DATA_DIR,
                     pass_id_as_seed=1,
-                    infinite=False):
+                    infinite=False,
+                    batch_augment=False,
+                    num_workers=0):
+    mapper = functools.partial(
+        process_image,
+        mode=mode,
+        color_jitter=color_jitter,
+        rotate=rotate,
+        batch_augment=batch_augment)
+
+    def map_reader(reader):
+        if num_workers > 0:
+            sample_bytes = 3 * DATA_DIM * DATA_DIM * (1 if batch_augment else
+                                                      4)
+            return shm_reader.map_readers(mapper, reader, num_workers,
+                                          SHM_BUF_SIZE, sample_bytes)
+        return paddle.reader.xmap_readers(mapper, reader, THREAD, BUF_SIZE)
+
+    if image_shard.is_shard_dir(file_list):
+        reader = image_shard.shard_reader(
+            file_list,
+            mode,
+            shuffle=shuffle,
+            pass_id_as_seed=pass_id_as_seed,
+            infinite=infinite)
+        return map_reader(reader)
+
     def reader():
         with open(file_list) as flist:
             full_lines = [line.strip() for line in flist]
@@ -170,14 +210,23 @@ def _reader_creator(file_list,
                 pass_id_as_seed_counter += 1
                 print("passid ++, current: ", pass_id_as_seed_counter)
 
-    mapper = functools.partial(
-        process_image, mode=mode, color_jitter=color_jitter, rotate=rotate)
+    return map_reader(reader)
+
 
-    return paddle.reader.xmap_readers(mapper, reader, THREAD, BUF_SIZE)
+def _file_list(data_dir, name):
+    """Prefer the packed shards of <name>_list.txt if they exist."""
+    shard_dir = image_shard.shard_dir_of(data_dir, name)
+    if image_shard.is_shard_dir(shard_dir):
+        return shard_dir
+    return os.path.join(data_dir, '%s_list.txt' % name)
 
 
-def train(data_dir=DATA_DIR, pass_id_as_seed=1, infinite=False):
-    file_list = os.path.join(data_dir, 'train_list.txt')
+def train(data_dir=DATA_DIR,
+          pass_id_as_seed=1,
+          infinite=False,
+          batch_augment=False,
+          num_workers=0):
+    file_list = _file_list(data_dir, 'train')
     return _reader_creator(
         file_list,
         'train',
@@ -186,16 +235,20 @@ def train(data_dir=DATA_DIR, pass_id_as_seed=1, infinite=False):
         rotate=False,
         data_dir=data_dir,
         pass_id_as_seed=pass_id_as_seed,
-        infinite=infinite)
+        infinite=infinite,
+        batch_augment=batch_augment,
+        num_workers=num_workers)
 
 
-def val(data_dir=DATA_DIR):
-    file_list = os.path.join(data_dir, 'val_list.txt')
+def val(data_dir=DATA_DIR, batch_augment=False, num_workers=0):
+    file_list = _file_list(data_dir, 'val')
     return _reader_creator(file_list, 'val', shuffle=False, 
-            data_dir=data_dir)
+            data_dir=data_dir, batch_augment=batch_augment,
+            num_workers=num_workers)
 
 
-def test(data_dir=DATA_DIR):
-    file_list = os.path.join(data_dir, 'val_list.txt')
+def test(data_dir=DATA_DIR, batch_augment=False, num_workers=0):
+    file_list = _file_list(data_dir, 'val')
     return _reader_creator(file_list, 'test', shuffle=False, 
-            data_dir=data_dir)
+            data_dir=data_dir, batch_augment=batch_augment,
+            num_workers=num_workers)
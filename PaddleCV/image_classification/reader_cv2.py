@@ -1,4 +1,5 @@
 import os
+import sys
 import math
 import random
 import functools
@@ -7,6 +8,12 @@ import paddle
 import cv2
 import io
 
+import image_shard
+import aspect_ratio
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from shm_utils import shm_reader
+
 random.seed(0)
 np.random.seed(0)
 
@@ -14,6 +21,8 @@ DATA_DIM = 224
 
 THREAD = 8
 BUF_SIZE = 102400
+# slots of the shared-memory ring buffer when reading with worker processes
+SHM_BUF_SIZE = 256
 
 DATA_DIR = './data/ILSVRC2012'
 
@@ -141,23 +150,29 @@ def process_image(
                   rotate,
                   crop_size=224,
                   mean=None,
-                  std=None):
+                  std=None,
+                  batch_augment=False):
     """ process_image """
 
     mean = [0.485, 0.456, 0.406] if mean is None else mean
     std = [0.229, 0.224, 0.225] if std is None else std
 
-    img_path = sample[0]
-    img = cv2.imread(img_path)
+    if isinstance(sample[0], image_shard.ShardImage):
+        # pre-decoded sample from image_shard, already RGB
+        img = sample[0].numpy()
+        is_bgr = False
+    else:
+        img = cv2.imread(sample[0])
+        is_bgr = True
 
     if mode == 'train':
         if rotate:
             img = rotate_image(img)
         if crop_size > 0:
             img = random_crop(img, crop_size,settings)
-        if color_jitter:
+        if color_jitter and not batch_augment:
             img = distort_color(img)
-        if np.random.randint(0, 2) == 1:
+        if np.random.randint(0, 2) == 1 and not batch_augment:
             img = img[:, ::-1, :]
     else:
         if crop_size > 0:
@@ -166,7 +181,16 @@ def process_image(
 
             img = crop_image(img, target_size=crop_size, center=True)
 
-    img = img[:, :, ::-1].astype('float32').transpose((2, 0, 1)) / 255
+    if is_bgr:
+        img = img[:, :, ::-1]
+    if batch_augment:
+        # flip, color jitter and normalization are done by batch_augment
+        if mode == 'train' or mode == 'val':
+            return (img, sample[1])
+        elif mode == 'test':
+            return (img, )
+
+    img = img.astype('float32').transpose((2, 0, 1)) / 255
     img_mean = np.array(mean).reshape((3, 1, 1))
     img_std = np.array(std).reshape((3, 1, 1))
     img -= img_mean
@@ -178,6 +202,43 @@ def process_image(
         return (img, )
 
 
+def crop_image_rect(img, height, width):
+    """ crop_image_rect """
+    h, w = img.shape[:2]
+    if h < height or w < width:
+        percent = max(float(height) / h, float(width) / w)
+        img = cv2.resize(img, (int(math.ceil(w * percent)),
+                               int(math.ceil(h * percent))))
+        h, w = img.shape[:2]
+    h_start = (h - height) // 2
+    w_start = (w - width) // 2
+    return img[h_start:h_start + height, w_start:w_start + width, :]
+
+
+def process_rect_image(sample, settings, mean=None, std=None):
+    """ process_rect_image """
+    mean = [0.485, 0.456, 0.406] if mean is None else mean
+    std = [0.229, 0.224, 0.225] if std is None else std
+
+    img, label, (height, width) = sample
+    if isinstance(img, np.ndarray):
+        # pre-decoded sample from image_shard, already RGB
+        is_bgr = False
+    else:
+        img = cv2.imread(img)
+        is_bgr = True
+
+    img = resize_short(img, settings.resize_short_size)
+    img = crop_image_rect(img, height, width)
+
+    if is_bgr:
+        img = img[:, :, ::-1]
+    img = img.astype('float32').transpose((2, 0, 1)) / 255
+    img -= np.array(mean).reshape((3, 1, 1))
+    img /= np.array(std).reshape((3, 1, 1))
+    return img, label
+
+
 def image_mapper(**kwargs):
     """ image_mapper """
     return functools.partial(process_image, **kwargs)
@@ -190,38 +251,53 @@ def _reader_creator(settings,
                     color_jitter=False,
                     rotate=False,
                     data_dir=DATA_DIR,
-                    pass_id_as_seed=0):
+                    pass_id_as_seed=0,
+                    infinite=False,
+                    batch_augment=False):
     def reader():
         with open(file_list) as flist:
             full_lines = [line.strip() for line in flist]
-            if shuffle:
-                if pass_id_as_seed:
-                    np.random.seed(pass_id_as_seed)
-                np.random.shuffle(full_lines)
-            if mode == 'train' and os.getenv('PADDLE_TRAINING_ROLE'):
-                # distributed mode if the env var `PADDLE_TRAINING_ROLE` exits
-                trainer_id = int(os.getenv("PADDLE_TRAINER_ID", "0"))
-                trainer_count = int(os.getenv("PADDLE_TRAINERS_NUM", "1"))
-                per_node_lines = len(full_lines) // trainer_count
-                lines = full_lines[trainer_id * per_node_lines:(trainer_id + 1)
-                                   * per_node_lines]
-                print(
-                    "read images from %d, length: %d, lines length: %d, total: %d"
-                    % (trainer_id * per_node_lines, per_node_lines, len(lines),
-                       len(full_lines)))
-            else:
-                lines = full_lines
-
-            for line in lines:
-                if mode == 'train' or mode == 'val':
-                    img_path, label = line.split()
-                    img_path = os.path.join(data_dir, img_path)
-                    yield img_path, int(label)
-                elif mode == 'test':
-                    img_path, label = line.split()
-                    img_path = os.path.join(data_dir, img_path)
- 
-                    yield [img_path]
+            pass_id_as_seed_counter = pass_id_as_seed
+            while True:
+                if shuffle:
+                    if pass_id_as_seed_counter:
+                        np.random.seed(pass_id_as_seed_counter)
+                    np.random.shuffle(full_lines)
+                if mode == 'train' and os.getenv('PADDLE_TRAINING_ROLE'):
+                    # distributed mode if the env var `PADDLE_TRAINING_ROLE` exits
+                    trainer_id = int(os.getenv("PADDLE_TRAINER_ID", "0"))
+                    trainer_count = int(os.getenv("PADDLE_TRAINERS_NUM", "1"))
+                    per_node_lines = len(full_lines) // trainer_count
+                    lines = full_lines[trainer_id * per_node_lines:(trainer_id + 1)
+                                       * per_node_lines]
+                    print(
+                        "read images from %d, length: %d, lines length: %d, total: %d"
+                        % (trainer_id * per_node_lines, per_node_lines, len(lines),
+                           len(full_lines)))
+                else:
+                    lines = full_lines
+
+                for line in lines:
+                    if mode == 'train' or mode == 'val':
+                        img_path, label = line.split()
+                        img_path = os.path.join(data_dir, img_path)
+                        yield img_path, int(label)
+                    elif mode == 'test':
+                        img_path, label = line.split()
+                        img_path = os.path.join(data_dir, img_path)
+
+                        yield [img_path]
+                if not infinite:
+                    break
+                pass_id_as_seed_counter += 1
+    if image_shard.is_shard_dir(file_list):
+        reader = image_shard.shard_reader(
+            file_list,
+            mode,
+            shuffle=shuffle,
+            pass_id_as_seed=pass_id_as_seed,
+            infinite=infinite)
+
     crop_size = int(settings.image_shape.split(",")[2])
     image_mapper = functools.partial(
         process_image,
@@ -229,13 +305,29 @@ def _reader_creator(settings,
         mode=mode,
         color_jitter=color_jitter,
         rotate=rotate,
-        crop_size=crop_size)
-    reader = paddle.reader.xmap_readers(
-        image_mapper, reader, THREAD, BUF_SIZE, order=False)
+        crop_size=crop_size,
+        batch_augment=batch_augment)
+    # settings built without the reader_workers option use reader threads
+    reader_workers = getattr(settings, 'reader_workers', 0)
+    if reader_workers > 0 and crop_size > 0:
+        sample_bytes = 3 * crop_size * crop_size * (1 if batch_augment else 4)
+        reader = shm_reader.map_readers(image_mapper, reader, reader_workers,
+                                        SHM_BUF_SIZE, sample_bytes)
+    else:
+        reader = paddle.reader.xmap_readers(
+            image_mapper, reader, THREAD, BUF_SIZE, order=False)
     return reader
 
-def train(settings, data_dir=DATA_DIR, pass_id_as_seed=0):
-    file_list = os.path.join(data_dir, 'train_list.txt')
+def _file_list(data_dir, name):
+    """Prefer the packed shards of <name>_list.txt if they exist."""
+    shard_dir = image_shard.shard_dir_of(data_dir, name)
+    if image_shard.is_shard_dir(shard_dir):
+        return shard_dir
+    return os.path.join(data_dir, '%s_list.txt' % name)
+
+def train(settings, data_dir=DATA_DIR, pass_id_as_seed=0, infinite=False,
+          batch_augment=False):
+    file_list = _file_list(data_dir, 'train')
     reader =  _reader_creator(
         settings,
         file_list,
@@ -245,18 +337,76 @@ def train(settings, data_dir=DATA_DIR, pass_id_as_seed=0):
         rotate=False,
         data_dir=data_dir,
         pass_id_as_seed=pass_id_as_seed,
+        infinite=infinite,
+        batch_augment=batch_augment,
         )
     if settings.use_mixup == True:
+        assert not batch_augment, "mixup does not support batch_augment"
         reader = create_mixup_reader(settings, reader)
     return reader
 
-def val(settings,data_dir=DATA_DIR):
-    file_list = os.path.join(data_dir, 'val_list.txt')
+def val(settings,data_dir=DATA_DIR, batch_augment=False):
+    file_list = _file_list(data_dir, 'val')
     return _reader_creator(settings ,file_list, 'val', shuffle=False, 
-            data_dir=data_dir)
+            data_dir=data_dir, batch_augment=batch_augment)
 
 
-def test(settings,data_dir=DATA_DIR):
-    file_list = os.path.join(data_dir, 'val_list.txt')
+def test(settings,data_dir=DATA_DIR, batch_augment=False):
+    file_list = _file_list(data_dir, 'val')
     return _reader_creator(settings, file_list, 'test', shuffle=False,
-            data_dir=data_dir)
+            data_dir=data_dir, batch_augment=batch_augment)
+
+
+def rect_val(settings, batch_size, data_dir=DATA_DIR):
+    """Validation batches sorted by aspect ratio and cropped to rectangles.
+
+    Yields [image, label] numpy batches, the images of a batch share one
+    crop size. See aspect_ratio.py.
+    """
+    file_list = _file_list(data_dir, 'val')
+    crop_size = int(settings.image_shape.split(",")[2])
+    idx_sorted, ars_sorted = aspect_ratio.sort_ar(file_list, data_dir)
+    sizes = [
+        aspect_ratio.target_size(ar, crop_size)
+        for ar in aspect_ratio.batch_ars(ars_sorted, batch_size)
+    ]
+
+    if image_shard.is_shard_dir(file_list):
+        shards = image_shard.open_shards(file_list)
+        starts = np.cumsum([0] + [len(shard) for shard in shards])
+
+        def get_sample(idx):
+            shard_id = np.searchsorted(starts, idx, side='right') - 1
+            return shards[shard_id][idx - starts[shard_id]]
+    else:
+        with open(file_list) as flist:
+            lines = [line.strip() for line in flist]
+
+        def get_sample(idx):
+            img_path, label = lines[idx].split()
+            return os.path.join(data_dir, img_path), int(label)
+
+    def reader():
+        for i, idx in enumerate(idx_sorted):
+            img, label = get_sample(idx)
+            yield img, label, sizes[i // batch_size]
+
+    mapper = functools.partial(process_rect_image, settings=settings)
+    # keep the sorted order, the batches are cut at the same boundaries
+    mapped_reader = paddle.reader.xmap_readers(
+        mapper, reader, THREAD, BUF_SIZE, order=True)
+
+    def batch_reader():
+        imgs, labels = [], []
+        for img, label in mapped_reader():
+            imgs.append(img)
+            labels.append(label)
+            if len(imgs) == batch_size:
+                yield [np.stack(imgs),
+                       np.array(labels, dtype='int64').reshape((-1, 1))]
+                imgs, labels = [], []
+        if imgs:
+            yield [np.stack(imgs),
+                   np.array(labels, dtype='int64').reshape((-1, 1))]
+
+    return batch_reader
@@ -11,6 +11,8 @@ import paddle
 import paddle.fluid as fluid
 import paddle.dataset.flowers as flowers
 import reader_cv2 as reader
+import batch_augment
+import aspect_ratio
 import argparse
 import functools
 import subprocess
@@ -54,6 +56,9 @@ add_arg('resize_short_size',      int,     256,      "Set the resize_short_size"
 add_arg('use_mixup',      bool,      False,        "Whether to use mixup or not")
 add_arg('mixup_alpha',      float,     0.2,      "Set the mixup_alpha parameter")
 add_arg('is_distill',       bool,  False,        "is distill or not")
+add_arg('batch_augment',    bool,  False,        "Whether to do flip and normalization on whole uint8 batches instead of per image.")
+add_arg('rect_val',         bool,  False,        "Whether to validate on aspect-ratio-bucketed rectangular crops.")
+add_arg('reader_workers',   int,   0,            "Number of reader processes, 0 to use reader threads.")
 
 def optimizer_setting(params):
     ls = params["learning_strategy"]
@@ -313,6 +318,8 @@ def get_device_num():
 def train(args):
     # parameters from arguments
     model_name = args.model
+    if args.rect_val:
+        aspect_ratio.check_model(model_name)
     checkpoint = args.checkpoint
     pretrained_model = args.pretrained_model
     with_memory_optimization = args.with_mem_opt
@@ -374,9 +381,26 @@ def train(args):
 
     test_batch_size = 16
     if not args.enable_ce:
-        train_reader = paddle.batch(
-            reader.train(settings=args), batch_size=train_batch_size, drop_last=True)
-        test_reader = paddle.batch(reader.val(settings=args), batch_size=test_batch_size)
+        if args.batch_augment:
+            train_reader = batch_augment.batch_reader(
+                reader.train(settings=args, data_dir=args.data_dir,
+                             batch_augment=True),
+                batch_size=train_batch_size, mode='train', drop_last=True)
+            test_reader = batch_augment.batch_reader(
+                reader.val(settings=args, data_dir=args.data_dir,
+                           batch_augment=True),
+                batch_size=test_batch_size, mode='val')
+        else:
+            train_reader = paddle.batch(
+                reader.train(settings=args, data_dir=args.data_dir),
+                batch_size=train_batch_size, drop_last=True)
+            test_reader = paddle.batch(
+                reader.val(settings=args, data_dir=args.data_dir),
+                batch_size=test_batch_size)
+        if args.rect_val:
+            test_reader = reader.rect_val(
+                settings=args, batch_size=test_batch_size,
+                data_dir=args.data_dir)
     else:
         # use flowers dataset for CE and set use_xmap False to avoid disorder data
         # but it is time consuming. For faster speed, need another dataset.
@@ -390,8 +414,14 @@ def train(args):
         test_reader = paddle.batch(
             flowers.test(use_xmap=False), batch_size=test_batch_size)
 
-    train_py_reader.decorate_paddle_reader(train_reader)
-    test_py_reader.decorate_paddle_reader(test_reader)
+    if args.batch_augment and not args.enable_ce:
+        train_py_reader.decorate_tensor_provider(train_reader)
+    else:
+        train_py_reader.decorate_paddle_reader(train_reader)
+    if (args.batch_augment or args.rect_val) and not args.enable_ce:
+        test_py_reader.decorate_tensor_provider(test_reader)
+    else:
+        test_py_reader.decorate_paddle_reader(test_reader)
 
     # use_ngraph is for CPU only, please refer to README_ngraph.md for details
     use_ngraph = os.getenv('FLAGS_use_ngraph')
@@ -14,7 +14,8 @@ import paddle.fluid as fluid
 import models
 import reader
 from utility import add_arguments, print_arguments
-from utility import fmt_time, recall_topk
+from utility import fmt_time
+import retrieval
 
 # yapf: disable
 parser = argparse.ArgumentParser(description=__doc__)
@@ -26,6 +27,8 @@ add_arg('image_shape', str, "3,224,224", "Input image size.")
 add_arg('use_gpu', bool, True, "Whether to use GPU or not.")
 add_arg('with_mem_opt', bool, False, "Whether to use memory optimization or not.")
 add_arg('pretrained_model', str, None, "Whether to use pretrained model.")
+add_arg('index_dir', str, None, "Directory to save the test features to as a retrieval index for infer.py, which is then searched from disk.")
+add_arg('num_workers', int, 0, "Number of processes of the top-k search, 0 to search in the main process.")
 # yapf: enable
 
 model_list = [m for m in dir(models) if "__" not in m]
@@ -85,8 +88,17 @@ def eval(args):
 
     f = np.vstack(f)
     l = np.hstack(l)
-    recall = recall_topk(f, l, k=1)
-    print("[%s] End test %d, test_recall %.5f" % (fmt_time(), len(f), recall))
+    if args.index_dir:
+        retrieval.save_index(args.index_dir, f, l)
+        database = args.index_dir
+    else:
+        database = retrieval.normalize(f)
+    ks = [1, 10, 100]
+    ids, _ = retrieval.search(database, max(ks), num_workers=args.num_workers)
+    recalls = retrieval.recall_at_k(ids, l, ks)
+    print("[%s] End test %d, test_recall %.5f" % (fmt_time(), len(f), recalls[0]))
+    print("[%s] %s" % (fmt_time(), ", ".join(
+        "Recall@%d %.5f" % (k, r) for k, r in zip(ks, recalls))))
     sys.stdout.flush()
 
 
@@ -14,6 +14,7 @@ import paddle.fluid as fluid
 import models
 import reader
 from utility import add_arguments, print_arguments
+import retrieval
 
 parser = argparse.ArgumentParser(description=__doc__)
 add_arg = functools.partial(add_arguments, argparser=parser)
@@ -25,6 +26,8 @@ add_arg('image_shape', str, "3,224,224", "Input image size.")
 add_arg('use_gpu', bool, True, "Whether to use GPU or not.")
 add_arg('with_mem_opt', bool, False, "Whether to use memory optimization or not.")
 add_arg('pretrained_model', str, None, "Whether to use pretrained model.")
+add_arg('index_dir', str, None, "Directory of a retrieval index saved by eval.py, to search the nearest images of every image in.")
+add_arg('topk', int, 10, "Number of nearest images to search in the index.")
 # yapf: enable
 
 model_list = [m for m in dir(models) if "__" not in m]
@@ -67,10 +70,21 @@ def infer(args):
 
     fetch_list = [out.name]
 
+    if args.index_dir:
+        index_fea, index_lab = retrieval.load_index(args.index_dir)
+
     for batch_id, data in enumerate(infer_reader()):
         result = exe.run(test_program, fetch_list=fetch_list, feed=feeder.feed(data))
-        result = result[0][0].reshape(-1)
+        feas = result[0]
+        result = feas[0].reshape(-1)
         print("Test-{0}-feature: {1}".format(batch_id, result[:5]))
+        if args.index_dir:
+            ids, dists = retrieval.search(
+                index_fea, args.topk, queries=retrieval.normalize(feas))
+            for i in range(len(ids)):
+                print("Test-{0}-{1}-topk: ids {2}, labels {3}, distances {4}".format(
+                    batch_id, i, ids[i].tolist(), index_lab[ids[i]].tolist(),
+                    np.round(dists[i], 4).tolist()))
         sys.stdout.flush()
 
 
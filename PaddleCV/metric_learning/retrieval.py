@@ -0,0 +1,166 @@
+"""Blocked top-k retrieval over L2 normalized features."""
+#  Copyright (c) 2019 PaddlePaddle Authors. All Rights Reserve.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import six
+import numpy as np
+from multiprocessing import Pool
+
+INDEX_FEATURES = 'features.npy'
+INDEX_LABELS = 'labels.npy'
+
+
+def normalize(fea):
+    """ L2 normalize every feature, as a float32 (N, D) array
+    """
+    fea = np.asarray(fea, dtype='float32')
+    fea = fea.reshape(fea.shape[0], -1)
+    n = np.sqrt(np.sum(fea**2, 1)).reshape(-1, 1)
+    return fea / np.maximum(n, 1e-12)
+
+
+def save_index(index_dir, fea, lab):
+    """ Save the normalized features and the labels of a database into
+    index_dir, for search() and load_index()
+    """
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    np.save(os.path.join(index_dir, INDEX_FEATURES), normalize(fea))
+    np.save(
+        os.path.join(index_dir, INDEX_LABELS),
+        np.asarray(lab, dtype='int64').reshape(-1))
+
+
+def load_index(index_dir):
+    """ Load the features of an index memory mapped and its labels
+    """
+    fea = np.load(os.path.join(index_dir, INDEX_FEATURES), mmap_mode='r')
+    lab = np.load(os.path.join(index_dir, INDEX_LABELS))
+    return fea, lab
+
+
+def _open_database(database):
+    if isinstance(database, six.string_types):
+        return load_index(database)[0]
+    return database
+
+
+def _search_block(database, queries, k, self_offset=None, block_size=4096):
+    """ Top-k of a block of queries, streaming the database in blocks and
+    merging the top-k of every block. If self_offset is not None, queries
+    are database[self_offset:self_offset + len(queries)] and are excluded
+    from their own results.
+    """
+    num = len(queries)
+    rows = np.arange(num)[:, np.newaxis]
+    best_sim = np.full((num, 0), -np.inf, dtype='float32')
+    best_ids = np.zeros((num, 0), dtype='int64')
+    for start in range(0, len(database), block_size):
+        block = np.asarray(database[start:start + block_size])
+        sim = np.dot(queries, block.T)
+        if self_offset is not None:
+            query_ids = np.arange(self_offset, self_offset + num)
+            hit = (query_ids >= start) & (query_ids < start + len(block))
+            sim[hit, query_ids[hit] - start] = -np.inf
+        if sim.shape[1] > k:
+            part = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+            sim = sim[rows, part]
+        else:
+            part = np.broadcast_to(np.arange(sim.shape[1]), sim.shape)
+        best_sim = np.concatenate([best_sim, sim], axis=1)
+        best_ids = np.concatenate([best_ids, part + start], axis=1)
+        if best_sim.shape[1] > k:
+            part = np.argpartition(-best_sim, k - 1, axis=1)[:, :k]
+            best_sim = best_sim[rows, part]
+            best_ids = best_ids[rows, part]
+    order = np.argsort(-best_sim, axis=1, kind='mergesort')
+    best_sim = best_sim[rows, order]
+    best_ids = best_ids[rows, order]
+    # squared euclidean distance of unit vectors
+    return best_ids, 2 - 2 * best_sim
+
+
+_worker_database = None
+
+
+def _init_worker(database):
+    global _worker_database
+    _worker_database = _open_database(database)
+
+
+def _search_task(task):
+    start, end, queries, k, block_size = task
+    if queries is None:
+        return _search_block(_worker_database,
+                             np.asarray(_worker_database[start:end]), k,
+                             start, block_size)
+    return _search_block(_worker_database, queries, k, None, block_size)
+
+
+def search(database, k, queries=None, block_size=4096, num_workers=0):
+    """ Find the k nearest database features of every query.
+
+    Args:
+        database: normalized (N, D) features, or the directory of an index
+            written by save_index, which is then streamed from disk.
+        k (int): number of neighbours, at most N (N - 1 without queries).
+        queries: normalized (M, D) query features. If None, every database
+            feature is searched in the rest of the database.
+        block_size (int): number of queries and of database features whose
+            distances are computed at once.
+        num_workers (int): number of processes searching blocks of queries,
+            0 to search in the calling process.
+
+    Returns:
+        (M, k) int64 database ids and float32 squared distances of the
+        neighbours, sorted by distance.
+    """
+    fea = _open_database(database)
+    num = len(fea) if queries is None else len(queries)
+    k = min(k, len(fea) - 1 if queries is None else len(fea))
+    tasks = [(start, min(start + block_size, num), None
+              if queries is None else queries[start:start + block_size], k,
+              block_size) for start in range(0, num, block_size)]
+    if num_workers > 0:
+        pool = Pool(num_workers, _init_worker, (database, ))
+        try:
+            results = pool.map(_search_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(fea)
+        results = [_search_task(task) for task in tasks]
+    if not results:
+        return (np.zeros((0, k), dtype='int64'), np.zeros(
+            (0, k), dtype='float32'))
+    ids, dists = zip(*results)
+    return np.concatenate(ids), np.concatenate(dists)
+
+
+def recall_at_k(ids, lab, ks, query_lab=None):
+    """ Recall@k of the top-k ids of search() for every k in ks: the
+    fraction of queries with a neighbour of the same label among their k
+    nearest
+    """
+    lab = np.asarray(lab).reshape(-1)
+    query_lab = lab if query_lab is None else np.asarray(query_lab).reshape(
+        -1)
+    hits = lab[ids] == query_lab[:, np.newaxis]
+    return [float(np.mean(np.any(hits[:, :k], axis=1))) for k in ks]
@@ -25,6 +25,7 @@ import distutils.util
 import numpy as np
 
 from paddle.fluid import core
+import retrieval
 
 
 def print_arguments(args):
@@ -73,24 +74,15 @@ def fmt_time():
     now_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
     return now_str
 
-def recall_topk(fea, lab, k = 1):
-    fea = np.array(fea)
-    fea = fea.reshape(fea.shape[0], -1)
-    n = np.sqrt(np.sum(fea**2, 1)).reshape(-1, 1)
-    fea = fea / n
-    a = np.sum(fea ** 2, 1).reshape(-1, 1)
-    b = a.T
-    ab = np.dot(fea, fea.T)
-    d = a + b - 2*ab
-    d = d + np.eye(len(fea)) * 1e8
-    sorted_index = np.argsort(d, 1)
-    res = 0
-    for i in range(len(fea)):
-        pred = lab[sorted_index[i][0]]
-        if lab[i] == pred:
-            res += 1.0
-    res = res / len(fea)
-    return res
+def recall_topk(fea, lab, k = 1, num_workers = 0):
+    """ Recall@k of every feature among the others, k may be an int or a
+    list of ints, for which a list of recalls is returned
+    """
+    ks = k if isinstance(k, (list, tuple)) else [k]
+    ids, _ = retrieval.search(
+        retrieval.normalize(fea), max(ks), num_workers=num_workers)
+    res = retrieval.recall_at_k(ids, lab, ks)
+    return res if isinstance(k, (list, tuple)) else res[0]
 
 def get_gpu_num():
     visibledevice = os.getenv('CUDA_VISIBLE_DEVICES')
@@ -7,8 +7,8 @@ import tarfile
 import numpy as np
 from PIL import Image
 from os import path
-from paddle.dataset.image import load_image
 import paddle
+from image_store import ImageStore
 
 try:
     input = raw_input
@@ -40,11 +40,13 @@ class DataGenerator(object):
                      img_label_list,
                      batchsize,
                      cycle,
-                     shuffle=True):
+                     shuffle=True,
+                     num_workers=4):
         '''
         Reader interface for training.
 
-        :param img_root_dir: The root path of the image for training.
+        :param img_root_dir: The root path of the image for training, or the
+        path of an image store packed by image_store.py.
         :type img_root_dir: str
 
         :param img_label_list: The path of the <image_name, label> file for training.
@@ -53,61 +55,75 @@ class DataGenerator(object):
         :param cycle: If number of iterations is greater than dataset_size / batch_size
         it reiterates dataset over as many times as necessary.
         :type cycle: bool
+
+        :param num_workers: The number of threads loading the images of
+        batches.
+        :type num_workers: int
         
         '''
 
-        img_label_lines = []
-        to_file = "tmp.txt"
-        if not shuffle:
-            cmd = "cat " + img_label_list + " | awk '{print $1,$2,$3,$4;}' > " + to_file
-        elif batchsize == 1:
-            cmd = "cat " + img_label_list + " | awk '{print $1,$2,$3,$4;}' | shuf > " + to_file
-        else:
-            #cmd1: partial shuffle
-            cmd = "cat " + img_label_list + " | awk '{printf(\"%04d%.4f %s\\n\", $1, rand(), $0)}' | sort | sed 1,$((1 + RANDOM % 100))d | "
-            #cmd2: batch merge and shuffle
-            cmd += "awk '{printf $2\" \"$3\" \"$4\" \"$5\" \"; if(NR % " + str(
-                batchsize) + " == 0) print \"\";}' | shuf | "
-            #cmd3: batch split
-            cmd += "awk '{if(NF == " + str(
-                batchsize
-            ) + " * 4) {for(i = 0; i < " + str(
-                batchsize
-            ) + "; i++) print $(4*i+1)\" \"$(4*i+2)\" \"$(4*i+3)\" \"$(4*i+4);}}' > " + to_file
-        os.system(cmd)
-        print("finish batch shuffle")
-        img_label_lines = open(to_file, 'r').readlines()
+        # w, h, img_name, labels
+        img_label_lines = [
+            line.strip() for line in open(img_label_list)
+            if line.strip() != ''
+        ]
+        widths = np.array([int(line.split(' ')[0]) for line in img_label_lines])
+        load_image = image_loader(img_root_dir)
 
-        def reader():
+        def batch_reader():
             sizes = len(img_label_lines) // batchsize
             if sizes == 0:
                 raise ValueError('Batch size is bigger than the dataset size.')
             while True:
-                for i in range(sizes):
-                    result = []
-                    sz = [0, 0]
-                    for j in range(batchsize):
-                        line = img_label_lines[i * batchsize + j]
-                        # h, w, img_name, labels
-                        items = line.split(' ')
-
-                        label = [int(c) for c in items[-1].split(',')]
-                        img = Image.open(os.path.join(img_root_dir, items[
-                            2])).convert('L')  #zhuanhuidu
-                        if j == 0:
-                            sz = img.size
-                        img = img.resize((sz[0], sz[1]))
-                        img = np.array(img) - 127.5
-                        img = img[np.newaxis, ...]
-                        if self.model == "crnn_ctc":
-                            result.append([img, label])
-                        else:
-                            result.append([img, [SOS] + label, label + [EOS]])
-                    yield result
+                if not shuffle:
+                    order = np.arange(len(img_label_lines))
+                elif batchsize == 1:
+                    order = np.random.permutation(len(img_label_lines))
+                else:
+                    # width buckets: sort by width with random ties, shift
+                    # the bucket boundaries by a random offset, then shuffle
+                    # the batches
+                    order = np.lexsort((np.random.rand(len(widths)), widths))
+                    order = order[np.random.randint(batchsize):]
+                batches = [
+                    order[i:i + batchsize]
+                    for i in range(0, len(order) - batchsize + 1, batchsize)
+                ]
+                if shuffle and batchsize > 1:
+                    np.random.shuffle(batches)
+                for batch in batches:
+                    yield [img_label_lines[i] for i in batch]
                 if not cycle:
                     break
 
-        return reader
+        def read_batch(lines):
+            result = []
+            sz = None
+            for line in lines:
+                items = line.split(' ')
+                label = [int(c) for c in items[-1].split(',')]
+                img = load_image(items[2])
+                # images of a batch have the size of the first one, which
+                # differs little within a width bucket
+                if sz is None:
+                    sz = (img.shape[1], img.shape[0])
+                elif (img.shape[1], img.shape[0]) != sz:
+                    img = cv2.resize(img, sz, interpolation=cv2.INTER_NEAREST)
+                img = img[np.newaxis, ...] - np.float32(127.5)
+                if self.model == "crnn_ctc":
+                    result.append([img, label])
+                else:
+                    result.append([img, [SOS] + label, label + [EOS]])
+            return result
+
+        if num_workers <= 0:
+            return lambda: (read_batch(batch) for batch in batch_reader())
+        return paddle.reader.xmap_readers(
+            read_batch,
+            batch_reader,
+            num_workers,
+            num_workers * 4,
+            order=not shuffle)
 
     def test_reader(self, img_root_dir, img_label_list):
         '''
@@ -119,6 +135,7 @@ class DataGenerator(object):
         :param img_label_list: The path of the <image_name, label> file for testing.
         :type img_label_list: str
         '''
+        load_image = image_loader(img_root_dir)
 
         def reader():
             for line in open(img_label_list):
@@ -126,9 +143,7 @@ class DataGenerator(object):
                 items = line.split(' ')
 
                 label = [int(c) for c in items[-1].split(',')]
-                img = Image.open(os.path.join(img_root_dir, items[2])).convert(
-                    'L')
-                img = np.array(img) - 127.5
+                img = load_image(items[2]) - np.float32(127.5)
                 img = img[np.newaxis, ...]
                 if self.model == "crnn_ctc":
                     yield img, label
@@ -189,6 +204,32 @@ class DataGenerator(object):
         return reader
 
 
+def image_loader(img_root_dir):
+    '''
+    Returns a function reading a grayscale image by its name, from an image
+    directory or from an image store packed by image_store.py.
+    '''
+    if path.isfile(img_root_dir):
+        store = ImageStore(img_root_dir)
+
+        def load_image(img_name):
+            img = cv2.imdecode(store.get(img_name), cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                raise ValueError("Cannot decode %s in %s" %
+                                 (img_name, img_root_dir))
+            return img
+    else:
+
+        def load_image(img_name):
+            img_path = path.join(img_root_dir, img_name)
+            img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                raise ValueError("Cannot read %s" % img_path)
+            return img
+
+    return load_image
+
+
 def num_classes():
     '''Get classes number of this dataset.
     '''
@@ -205,7 +246,8 @@ def train(batch_size,
           train_images_dir=None,
           train_list_file=None,
           cycle=False,
-          model="crnn_ctc"):
+          model="crnn_ctc",
+          num_workers=4):
     generator = DataGenerator(model)
     if train_images_dir is None:
         data_dir = download_data()
@@ -216,7 +258,12 @@ def train(batch_size,
     if 'ce_mode' in os.environ:
         shuffle = False
     return generator.train_reader(
-        train_images_dir, train_list_file, batch_size, cycle, shuffle=shuffle)
+        train_images_dir,
+        train_list_file,
+        batch_size,
+        cycle,
+        shuffle=shuffle,
+        num_workers=num_workers)
 
 
 def test(batch_size=1,
@@ -0,0 +1,130 @@
+"""
+Packed store of the images of an OCR data set.
+
+All images are packed into one file, which can be passed in place of an
+image directory, e.g. `--train_images=train_images.pack`:
+
+    header   magic, version, offset of the index
+    images   the image files as they are, 64-byte aligned
+    index    numpy arrays of the sorted image names and of the offset and
+             size of every image
+
+The file is memory mapped, so reading an image is a lookup in the sorted
+names and a slice of the mapped file, without opening any file.
+
+Pack the images of a list file with:
+
+    python image_store.py --images_dir=train_images \\
+        --images_list=train_list --output=train_images.pack
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import io
+import os
+import mmap
+import struct
+import argparse
+import numpy as np
+
+IMAGE_STORE_MAGIC = b'PDOCRIMG'
+IMAGE_STORE_VERSION = 1
+
+_HEADER = struct.Struct('<8sIQ')
+_ALIGNMENT = 64
+
+
+def _align(nbytes):
+    return (nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def pack_images(images_dir, images_list, output):
+    '''
+    Pack the images named in the third column of a list file into a store.
+
+    :param images_dir: The directory of the images.
+    :type images_dir: str
+
+    :param images_list: The path of the <width, height, image_name, label>
+    file.
+    :type images_list: str
+
+    :param output: The path of the store to be written.
+    :type output: str
+    '''
+    names = []
+    with open(images_list) as f:
+        for line in f:
+            items = line.strip().split(' ')
+            if len(items) >= 3:
+                names.append(items[2])
+    names = sorted(set(names))
+    offsets = np.zeros(len(names), dtype='int64')
+    sizes = np.zeros(len(names), dtype='int64')
+    with open(output, 'wb') as f:
+        f.write(_HEADER.pack(IMAGE_STORE_MAGIC, IMAGE_STORE_VERSION, 0))
+        pos = _align(_HEADER.size)
+        for i, name in enumerate(names):
+            with open(os.path.join(images_dir, name), 'rb') as img:
+                data = img.read()
+            f.seek(pos)
+            f.write(data)
+            offsets[i] = pos
+            sizes[i] = len(data)
+            pos = _align(pos + len(data))
+        f.seek(pos)
+        for array in [
+                np.array([name.encode('utf-8') for name in names]), offsets,
+                sizes
+        ]:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+        f.seek(0)
+        f.write(_HEADER.pack(IMAGE_STORE_MAGIC, IMAGE_STORE_VERSION, pos))
+    return len(names)
+
+
+class ImageStore(object):
+    '''
+    Read-only, memory mapped view of a store written by pack_images.
+    Safe to share between reader threads.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset = _HEADER.unpack(self._mm[:_HEADER.size])
+        if magic != IMAGE_STORE_MAGIC or version != IMAGE_STORE_VERSION:
+            raise ValueError("%s is not a version %d image store" %
+                             (path, IMAGE_STORE_VERSION))
+        index = io.BytesIO(self._mm[index_offset:])
+        self._names, self._offsets, self._sizes = [
+            np.lib.format.read_array(
+                index, allow_pickle=False) for _ in range(3)
+        ]
+        self._data = np.frombuffer(self._mm, dtype='uint8')
+
+    def __len__(self):
+        return len(self._names)
+
+    def get(self, name):
+        '''
+        Returns the encoded image file of the given name, as a uint8 array.
+        '''
+        key = name.encode('utf-8')
+        i = np.searchsorted(self._names, key)
+        if i == len(self._names) or self._names[i] != key:
+            raise KeyError("%s is not in %s" % (name, self.path))
+        offset = self._offsets[i]
+        return self._data[offset:offset + self._sizes[i]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pack the images of a list file into an image store.")
+    parser.add_argument('--images_dir', type=str, required=True)
+    parser.add_argument('--images_list', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    args = parser.parse_args()
+    num = pack_images(args.images_dir, args.images_list, args.output)
+    print("Packed %d images into %s." % (num, args.output))
@@ -24,8 +24,9 @@ add_arg('log_period',        int,   1000,       "Log period.")
 add_arg('save_model_period', int,   15000,      "Save model period. '-1' means never saving the model.")
 add_arg('eval_period',       int,   15000,      "Evaluate period. '-1' means never evaluating the model.")
 add_arg('save_model_dir',    str,   "./models", "The directory the model to be saved to.")
-add_arg('train_images',      str,   None,       "The directory of images to be used for training.")
+add_arg('train_images',      str,   None,       "The directory of images to be used for training, or an image store packed by image_store.py.")
 add_arg('train_list',        str,   None,       "The list file of images to be used for training.")
+add_arg('num_workers',       int,   4,          "The number of threads loading training images. Zero or less means loading them in the training thread.")
 add_arg('test_images',       str,   None,       "The directory of images to be used for test.")
 add_arg('test_list',         str,   None,       "The list file of images to be used for training.")
 add_arg('model',    str,   "crnn_ctc",           "Which type of network to be used. 'crnn_ctc' or 'attention'")
@@ -65,7 +66,8 @@ def train(args):
         train_images_dir=args.train_images,
         train_list_file=args.train_list,
         cycle=args.total_step > 0,
-        model=args.model)
+        model=args.model,
+        num_workers=args.num_workers)
     test_reader = data_reader.test(
         test_images_dir=args.test_images, test_list_file=args.test_list, model=args.model)
 
@@ -70,59 +70,102 @@ def clip_xyxy_to_image(x1, y1, x2, y2, height, width):
     return x1, y1, x2, y2
 
 
+def box_overlaps(box, boxes):
+    """IoU of one [x1 y1 x2 y2] box against an (N, 4) array of boxes."""
+    xx1 = np.maximum(box[0], boxes[:, 0])
+    yy1 = np.maximum(box[1], boxes[:, 1])
+    xx2 = np.minimum(box[2], boxes[:, 2])
+    yy2 = np.minimum(box[3], boxes[:, 3])
+    w = np.maximum(0.0, xx2 - xx1 + 1)
+    h = np.maximum(0.0, yy2 - yy1 + 1)
+    inter = w * h
+    area = (box[2] - box[0] + 1) * (box[3] - box[1] + 1)
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    return inter / (area + areas - inter)
+
+
 def nms(dets, thresh):
-    """Apply classic DPM-style greedy NMS."""
+    """Apply classic DPM-style greedy NMS.
+
+    dets is an (N, 5) array of [x1 y1 x2 y2 score]. Each step keeps the
+    highest scoring remaining box and drops, in one vectorized pass, all the
+    remaining boxes overlapping it by at least thresh. Returns the kept
+    indices in descending score order.
+    """
+    if dets.shape[0] == 0:
+        return []
+    boxes = dets[:, :4]
+    order = dets[:, 4].argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        ovr = box_overlaps(boxes[i], boxes[order[1:]])
+        order = order[1:][ovr < thresh]
+    return np.array(keep, dtype=np.int64)
+
+
+def soft_nms(dets, sigma=0.5, overlap_thresh=0.3, score_thresh=0.0001,
+             method='linear'):
+    """Apply soft-NMS (Bodla et al., 2017) to dets in place.
+
+    Instead of dropping the boxes overlapping a kept box, their scores are
+    decayed, linearly by (1 - IoU) above overlap_thresh or by the gaussian
+    exp(-IoU^2 / sigma). Boxes whose score falls below score_thresh are
+    dropped. Returns the kept indices in the order they were selected; the
+    decayed scores are written back to dets[:, 4].
+    """
+    assert method in ['linear', 'gaussian'], \
+        "Unknown soft-NMS method: {}".format(method)
     if dets.shape[0] == 0:
         return []
-    x1 = dets[:, 0]
-    y1 = dets[:, 1]
-    x2 = dets[:, 2]
-    y2 = dets[:, 3]
+    boxes = dets[:, :4]
     scores = dets[:, 4]
-
-    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    order = scores.argsort()[::-1]
-
-    ndets = dets.shape[0]
-    suppressed = np.zeros((ndets), dtype=np.int)
-
-    # nominal indices
-    # _i, _j
-    # sorted indices
-    # i, j
-    # temp variables for box i's (the box currently under consideration)
-    # ix1, iy1, ix2, iy2, iarea
-
-    # variables for computing overlap with box j (lower scoring box)
-    # xx1, yy1, xx2, yy2
-    # w, h
-    # inter, ovr
-
-    for _i in range(ndets):
-        i = order[_i]
-        if suppressed[i] == 1:
+    order = np.arange(dets.shape[0])
+
+    keep = []
+    while order.size > 0:
+        top = scores[order].argmax()
+        i = order[top]
+        keep.append(i)
+        order = np.delete(order, top)
+        if order.size == 0:
+            break
+        ovr = box_overlaps(boxes[i], boxes[order])
+        if method == 'linear':
+            weight = np.where(ovr > overlap_thresh, 1 - ovr, 1.0)
+        else:
+            weight = np.exp(-(ovr * ovr) / sigma)
+        scores[order] *= weight
+        order = order[scores[order] >= score_thresh]
+    return np.array(keep, dtype=np.int64)
+
+
+def batched_nms(boxes, scores, groups, nms_fn=nms, **kwargs):
+    """Run NMS independently per group (e.g. per image and class).
+
+    The candidates of all the groups are sorted and split by group in one
+    pass, so only the per-group nms_fn calls remain in Python. kwargs are
+    passed to nms_fn. Returns the kept indices and their scores, which
+    soft_nms decays.
+    """
+    dets = np.hstack((boxes, scores[:, np.newaxis]))
+    order = np.argsort(groups, kind='mergesort')
+    splits = np.flatnonzero(np.diff(groups[order])) + 1
+    keep = []
+    for inds in np.split(order, splits):
+        if inds.size == 0:
             continue
-        ix1 = x1[i]
-        iy1 = y1[i]
-        ix2 = x2[i]
-        iy2 = y2[i]
-        iarea = areas[i]
-        for _j in range(_i + 1, ndets):
-            j = order[_j]
-            if suppressed[j] == 1:
-                continue
-            xx1 = max(ix1, x1[j])
-            yy1 = max(iy1, y1[j])
-            xx2 = min(ix2, x2[j])
-            yy2 = min(iy2, y2[j])
-            w = max(0.0, xx2 - xx1 + 1)
-            h = max(0.0, yy2 - yy1 + 1)
-            inter = w * h
-            ovr = inter / (iarea + areas[j] - inter)
-            if ovr >= thresh:
-                suppressed[j] = 1
-
-    return np.where(suppressed == 0)[0]
+        group_dets = dets[inds]
+        group_keep = nms_fn(group_dets, **kwargs)
+        # soft_nms decays the scores of group_dets in place
+        dets[inds] = group_dets
+        keep.append(inds[group_keep])
+    if not keep:
+        return np.zeros((0, ), dtype=np.int64), scores[:0]
+    keep = np.concatenate(keep)
+    return keep, dets[keep, 4]
 
 
 def expand_boxes(boxes, scale):
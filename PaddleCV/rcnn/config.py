@@ -93,6 +93,9 @@ _C.TRAIN.gt_min_area = -1
 # Use horizontally-flipped images during training?
 _C.TRAIN.use_flipped = True
 
+# Pad images of the same orientation together (all landscape or all portrait)
+_C.TRAIN.group_by_aspect_ratio = False
+
 #
 # Inference options
 #
@@ -113,6 +116,18 @@ _C.TEST.score_thresh = 0.05
 # overlap threshold used for NMS
 _C.TEST.nms_thresh = 0.5
 
+# decode boxes and run NMS on the host with numpy instead of in the graph
+_C.TEST.host_nms = False
+
+# use soft-NMS instead of NMS, it runs on the host
+_C.TEST.softnms = False
+
+# soft-NMS score decay, 'linear' or 'gaussian'
+_C.TEST.softnms_method = 'linear'
+
+# sigma of the gaussian soft-NMS decay
+_C.TEST.softnms_sigma = 0.5
+
 # number of RPN proposals to keep before NMS
 _C.TEST.rpn_pre_nms_top_n = 6000
 
@@ -213,6 +228,15 @@ _C.class_num = 81
 # support pyreader
 _C.use_pyreader = True
 
+# directory of the roidb cache, empty for <data_dir>/cache
+_C.roidb_cache_dir = ''
+
+# number of processes building the roidb when it is not cached
+_C.roidb_workers = 8
+
+# number of processes decoding images, 0 to decode on the reader thread
+_C.reader_workers = 0
+
 # pixel mean values
 _C.pixel_means = [102.9801, 115.9465, 122.7717]
 
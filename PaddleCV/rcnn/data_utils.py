@@ -48,14 +48,16 @@ class DatasetPath(object):
         return os.path.join(cfg.data_dir, sfile_list)
 
 
-def get_image_blob(roidb, mode):
+def get_image_blob(roidb, mode, target_size=None):
     """Builds an input blob from the images in the roidb at the specified
-    scales.
+    scales. A random one of cfg.TRAIN.scales is used for training if
+    target_size is None.
     """
     if mode == 'train':
-        scales = cfg.TRAIN.scales
-        scale_ind = np.random.randint(0, high=len(scales))
-        target_size = scales[scale_ind]
+        if target_size is None:
+            scales = cfg.TRAIN.scales
+            scale_ind = np.random.randint(0, high=len(scales))
+            target_size = scales[scale_ind]
         max_size = cfg.TRAIN.max_size
     else:
         target_size = cfg.TEST.scales[0]
@@ -73,6 +75,20 @@ def get_image_blob(roidb, mode):
     return im, im_scale
 
 
+def get_im_scale(height, width, target_size, max_size):
+    """Return the scale prep_im_for_blob resizes an image of the given size
+    with, and the height and width of the resized image."""
+    im_size_min = min(height, width)
+    im_size_max = max(height, width)
+    im_scale = float(target_size) / float(im_size_min)
+    # Prevent the biggest axis from being more than max_size
+    if np.round(im_scale * im_size_max) > max_size:
+        im_scale = float(max_size) / float(im_size_max)
+    # cv2.resize rounds half to even like np.round
+    return im_scale, int(np.round(height * im_scale)), int(
+        np.round(width * im_scale))
+
+
 def prep_im_for_blob(im, pixel_means, target_size, max_size):
     """Prepare an image for use as a network input blob. Specially:
       - Subtract per-channel pixel mean
@@ -84,13 +100,8 @@ def prep_im_for_blob(im, pixel_means, target_size, max_size):
     im = im.astype(np.float32, copy=False)
     im -= pixel_means
 
-    im_shape = im.shape
-    im_size_min = np.min(im_shape[0:2])
-    im_size_max = np.max(im_shape[0:2])
-    im_scale = float(target_size) / float(im_size_min)
-    # Prevent the biggest axis from being more than max_size
-    if np.round(im_scale * im_size_max) > max_size:
-        im_scale = float(max_size) / float(im_size_max)
+    im_scale, _, _ = get_im_scale(im.shape[0], im.shape[1], target_size,
+                                  max_size)
     im = cv2.resize(
         im,
         None,
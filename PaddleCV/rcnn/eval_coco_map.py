@@ -58,6 +58,11 @@ def eval():
         mode='val')
     model.build_model(image_shape)
     pred_boxes = model.eval_bbox_out()
+    host_nms = cfg.TEST.host_nms or cfg.TEST.softnms
+    if host_nms:
+        assert not cfg.MASK_ON, \
+            "The mask head needs the in-graph NMS, disable host_nms and softnms."
+        pred_boxes_raw = model.eval_bbox_raw_out()
     if cfg.MASK_ON:
         masks = model.eval_mask_out()
     place = fluid.CUDAPlace(0) if cfg.use_gpu else fluid.CPUPlace()
@@ -75,7 +80,9 @@ def eval():
 
     dts_res = []
     segms_res = []
-    if cfg.MASK_ON:
+    if host_nms:
+        fetch_list = pred_boxes_raw
+    elif cfg.MASK_ON:
         fetch_list = [pred_boxes, masks]
     else:
         fetch_list = [pred_boxes]
@@ -89,12 +96,17 @@ def eval():
                           feed=feeder.feed(batch_data),
                           return_numpy=False)
 
-        pred_boxes_v = results[0]
-        if cfg.MASK_ON:
-            masks_v = results[1]
-
-        new_lod = pred_boxes_v.lod()
-        nmsed_out = pred_boxes_v
+        if host_nms:
+            new_lod, nmsed_out = get_nmsed_box(results[0], results[1],
+                                               results[2], class_nums, im_info)
+            new_lod = [new_lod]
+        else:
+            pred_boxes_v = results[0]
+            if cfg.MASK_ON:
+                masks_v = results[1]
+
+            new_lod = pred_boxes_v.lod()
+            nmsed_out = pred_boxes_v
 
         dts_res += get_dt_res(total_batch_size, new_lod[0], nmsed_out,
                               batch_data, num_id_to_cat_id_map)
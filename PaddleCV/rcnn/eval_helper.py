@@ -67,73 +67,83 @@ def box_decoder(deltas, boxes, weights):
 
 
 def clip_tiled_boxes(boxes, im_shape):
-    """Clip boxes to image boundaries. im_shape is [height, width] and boxes
-    has shape (N, 4 * num_tiled_boxes)."""
+    """Clip boxes to image boundaries. im_shape is [height, width], or an
+    (N, 2) array with the image shape of every box, and boxes has shape
+    (N, 4 * num_tiled_boxes)."""
     assert boxes.shape[1] % 4 == 0, \
         'boxes.shape[1] is {:d}, but must be divisible by 4.'.format(
         boxes.shape[1]
     )
+    im_shape = np.asarray(im_shape)
+    max_x = im_shape[..., 1:2] - 1
+    max_y = im_shape[..., 0:1] - 1
     # x1 >= 0
-    boxes[:, 0::4] = np.maximum(np.minimum(boxes[:, 0::4], im_shape[1] - 1), 0)
+    boxes[:, 0::4] = np.maximum(np.minimum(boxes[:, 0::4], max_x), 0)
     # y1 >= 0
-    boxes[:, 1::4] = np.maximum(np.minimum(boxes[:, 1::4], im_shape[0] - 1), 0)
+    boxes[:, 1::4] = np.maximum(np.minimum(boxes[:, 1::4], max_y), 0)
     # x2 < im_shape[1]
-    boxes[:, 2::4] = np.maximum(np.minimum(boxes[:, 2::4], im_shape[1] - 1), 0)
+    boxes[:, 2::4] = np.maximum(np.minimum(boxes[:, 2::4], max_x), 0)
     # y2 < im_shape[0]
-    boxes[:, 3::4] = np.maximum(np.minimum(boxes[:, 3::4], im_shape[0] - 1), 0)
+    boxes[:, 3::4] = np.maximum(np.minimum(boxes[:, 3::4], max_y), 0)
     return boxes
 
 
 def get_nmsed_box(rpn_rois, confs, locs, class_nums, im_info):
-    lod = rpn_rois.lod()[0]
+    """Host-side counterpart of the multiclass_nms in model.eval_bbox.
+
+    Decodes, clips and runs NMS (or soft-NMS if cfg.TEST.softnms) on all the
+    images and classes of a LoD batch at once, then keeps the top
+    cfg.TEST.detections_per_im detections of every image. Returns the LoD of
+    the detections and an array of [label, score, x1, y1, x2, y2] rows.
+    """
+    lod = np.array(rpn_rois.lod()[0])
     rpn_rois_v = np.array(rpn_rois)
     variance_v = np.array(cfg.bbox_reg_weights)
     confs_v = np.array(confs)
     locs_v = np.array(locs)
-    im_results = [[] for _ in range(len(lod) - 1)]
-    new_lod = [0]
-    for i in range(len(lod) - 1):
-        start = lod[i]
-        end = lod[i + 1]
-        if start == end:
-            continue
-        locs_n = locs_v[start:end, :]
-        rois_n = rpn_rois_v[start:end, :]
-        rois_n = rois_n / im_info[i][2]
-        rois_n = box_decoder(locs_n, rois_n, variance_v)
-        rois_n = clip_tiled_boxes(rois_n, im_info[i][:2] / im_info[i][2])
-
-        cls_boxes = [[] for _ in range(class_nums)]
-        scores_n = confs_v[start:end, :]
-        for j in range(1, class_nums):
-            inds = np.where(scores_n[:, j] > cfg.TEST.score_thresh)[0]
-            scores_j = scores_n[inds, j]
-            rois_j = rois_n[inds, j * 4:(j + 1) * 4]
-            dets_j = np.hstack((scores_j[:, np.newaxis], rois_j)).astype(
-                np.float32, copy=False)
-            keep = box_utils.nms(dets_j, cfg.TEST.nms_thresh)
-            nms_dets = dets_j[keep, :]
-            #add labels
-            label = np.array([j for _ in range(len(keep))])
-            nms_dets = np.hstack((nms_dets, label[:, np.newaxis])).astype(
-                np.float32, copy=False)
-            cls_boxes[j] = nms_dets
+    im_info = np.array(im_info, dtype=np.float32).reshape((-1, 3))
+    num_im = len(lod) - 1
+
+    im_ids = np.repeat(np.arange(num_im), np.diff(lod))
+    scales = im_info[im_ids, 2:3]
+    rois = box_decoder(locs_v, rpn_rois_v / scales, variance_v)
+    rois = clip_tiled_boxes(rois, im_info[im_ids, :2] / scales)
+
+    # candidates of all images and foreground classes above the threshold
+    rows, cols = np.where(confs_v[:, 1:] > cfg.TEST.score_thresh)
+    labels = cols + 1
+    scores = confs_v[rows, labels]
+    boxes = rois.reshape((rois.shape[0], -1, 4))[rows, labels]
+    ims = im_ids[rows]
+    if cfg.TEST.softnms:
+        keep, scores = box_utils.batched_nms(
+            boxes,
+            scores,
+            ims * class_nums + labels,
+            nms_fn=box_utils.soft_nms,
+            sigma=cfg.TEST.softnms_sigma,
+            overlap_thresh=cfg.TEST.nms_thresh,
+            method=cfg.TEST.softnms_method)
+    else:
+        keep, scores = box_utils.batched_nms(
+            boxes,
+            scores,
+            ims * class_nums + labels,
+            thresh=cfg.TEST.nms_thresh)
+    labels, boxes, ims = labels[keep], boxes[keep], ims[keep]
+
     # Limit to max_per_image detections **over all classes**
-        image_scores = np.hstack(
-            [cls_boxes[j][:, 1] for j in range(1, class_nums)])
-        if len(image_scores) > cfg.TEST.detections_per_im:
-            image_thresh = np.sort(image_scores)[-cfg.TEST.detections_per_im]
-            for j in range(1, class_nums):
-                keep = np.where(cls_boxes[j][:, 1] >= image_thresh)[0]
-                cls_boxes[j] = cls_boxes[j][keep, :]
-
-        im_results_n = np.vstack([cls_boxes[j] for j in range(1, class_nums)])
-        im_results[i] = im_results_n
-        new_lod.append(len(im_results_n) + new_lod[-1])
-        boxes = im_results_n[:, 2:]
-        scores = im_results_n[:, 1]
-        labels = im_results_n[:, 0]
-    im_results = np.vstack([im_results[k] for k in range(len(lod) - 1)])
+    order = np.lexsort((-scores, ims))
+    ims = ims[order]
+    rank = np.arange(len(ims)) - np.searchsorted(ims, ims)
+    order = order[rank < cfg.TEST.detections_per_im]
+
+    im_results = np.hstack((labels[order, np.newaxis],
+                            scores[order, np.newaxis], boxes[order])).astype(
+                                np.float32, copy=False)
+    counts = np.bincount(ims[rank < cfg.TEST.detections_per_im],
+                         minlength=num_im)
+    new_lod = [0] + np.cumsum(counts).tolist()
     return new_lod, im_results
 
 
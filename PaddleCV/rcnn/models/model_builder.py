@@ -70,6 +70,10 @@ class RCNN(object):
     def eval_bbox_out(self):
         return self.pred_result
 
+    def eval_bbox_raw_out(self):
+        """Outputs before box decoding and NMS, see eval_helper.get_nmsed_box"""
+        return [self.rpn_rois, self.cls_prob, self.bbox_pred]
+
     def build_input(self, image_shape):
         if self.use_pyreader:
             in_shapes = [[-1] + image_shape, [-1, 4], [-1, 1], [-1, 1],
@@ -135,7 +139,7 @@ class RCNN(object):
         im_scale_lod = fluid.layers.sequence_expand(self.im_scale,
                                                     self.rpn_rois)
         boxes = self.rpn_rois / im_scale_lod
-        cls_prob = fluid.layers.softmax(self.cls_score, use_cudnn=False)
+        self.cls_prob = fluid.layers.softmax(self.cls_score, use_cudnn=False)
         bbox_pred_reshape = fluid.layers.reshape(self.bbox_pred,
                                                  (-1, cfg.class_num, 4))
         decoded_box = fluid.layers.box_coder(
@@ -149,7 +153,7 @@ class RCNN(object):
             input=decoded_box, im_info=self.im_info)
         self.pred_result = fluid.layers.multiclass_nms(
             bboxes=cliped_box,
-            scores=cls_prob,
+            scores=self.cls_prob,
             score_threshold=cfg.TEST.score_thresh,
             nms_top_k=-1,
             nms_threshold=cfg.TEST.nms_thresh,
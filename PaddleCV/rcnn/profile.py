@@ -96,10 +96,11 @@ def train():
         reader_time = []
         run_time = []
         total_images = 0
+        train_iter = train_reader()
 
         for batch_id in range(iterations):
             start_time = time.time()
-            data = next(train_reader())
+            data = next(train_iter)
             end_time = time.time()
             reader_time.append(end_time - start_time)
             start_time = time.time()
@@ -16,20 +16,29 @@ import random
 import numpy as np
 import xml.etree.ElementTree
 import os
+import sys
 import time
 import copy
 import six
 import cv2
-from collections import deque
 
 from roidbs import JsonDataset
 import data_utils
 from config import cfg
 import segm_utils
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from shm_utils import shm_reader
 
+# bytes of a ground truth box in a shared-memory slot: gt_boxes, gt_classes
+# and is_crowd
+GT_BOX_BYTES = 4 * 4 + 4 + 4
+# bytes of the alignment padding of the arrays of a sample in a slot
+SLOT_ALIGN_BYTES = 6 * 64
 
-def roidb_reader(roidb, mode):
-    im, im_scales = data_utils.get_image_blob(roidb, mode)
+
+def roidb_reader(roidb, mode, target_size=None):
+    im, im_scales = data_utils.get_image_blob(roidb, mode, target_size)
     im_id = roidb['id']
     im_height = np.round(roidb['height'] * im_scales)
     im_width = np.round(roidb['width'] * im_scales)
@@ -67,11 +76,60 @@ def roidb_reader(roidb, mode):
     return outs
 
 
+def max_sample_bytes(roidbs, mode, group_size):
+    """The bytes of the arrays of the largest sample coco() maps: the largest
+    resized image, or padded group of images, and the ground truth of the
+    image with the most boxes."""
+    if mode == 'train':
+        # the largest scale resizes every image to its largest shape
+        target_size, max_size = max(cfg.TRAIN.scales), cfg.TRAIN.max_size
+    else:
+        target_size, max_size = cfg.TEST.scales[0], cfg.TEST.max_size
+    heights = np.array([r['height'] for r in roidbs])
+    widths = np.array([r['width'] for r in roidbs])
+    shapes = np.array([
+        data_utils.get_im_scale(h, w, target_size, max_size)[1:]
+        for h, w in zip(heights, widths)
+    ])
+    if mode == 'train' and group_size > 1:
+        # a group is padded to its largest height and width
+        groups = [np.ones(len(roidbs), dtype=bool)]
+        if cfg.TRAIN.group_by_aspect_ratio:
+            groups = [widths >= heights, widths < heights]
+        im_pixels = max(
+            np.prod(shapes[g].max(axis=0)) for g in groups if g.any())
+    else:
+        im_pixels = np.prod(shapes, axis=1).max()
+    num_boxes = 0
+    if mode == 'train':
+        num_boxes = max(len(r['gt_classes']) for r in roidbs)
+    return int(3 * im_pixels * 4 + num_boxes * GT_BOX_BYTES +
+               SLOT_ALIGN_BYTES)
+
+
+def has_valid_masks(roidb):
+    """Whether roidb_reader gets a mask for every ground truth box."""
+    for segm, iscrowd in zip(roidb['segms'], roidb['is_crowd']):
+        if iscrowd:
+            continue
+        if len(segm) == 0 or any(len(poly) == 0 for poly in segm):
+            return False
+    return True
+
+
 def coco(mode,
          batch_size=None,
          total_batch_size=None,
          padding_total=False,
          shuffle=False):
+    """Create a reader of minibatches of batch_size images.
+
+    Images are decoded and resized by cfg.reader_workers processes, or on the
+    reader thread if it is 0. Training minibatches are padded to the largest
+    image of the minibatch, or of the total_batch_size images of all the
+    devices if padding_total. With cfg.TRAIN.group_by_aspect_ratio, those
+    images are either all landscape or all portrait, which cuts the padding.
+    """
     total_batch_size = total_batch_size if total_batch_size else batch_size
     assert total_batch_size % batch_size == 0
     json_dataset = JsonDataset(mode)
@@ -79,79 +137,100 @@ def coco(mode,
 
     print("{} on {} with {} roidbs".format(mode, cfg.dataset, len(roidbs)))
 
-    def padding_minibatch(batch_data):
-        if len(batch_data) == 1:
-            return batch_data
-
-        max_shape = np.array([data[0].shape for data in batch_data]).max(axis=0)
+    device_num = total_batch_size // batch_size
+    # images padded to the same shape
+    group_size = total_batch_size if padding_total else batch_size
 
-        padding_batch = []
-        for data in batch_data:
-            im_c, im_h, im_w = data[0].shape[:]
-            padding_im = np.zeros(
-                (im_c, max_shape[1], max_shape[2]), dtype=np.float32)
-            padding_im[:, :im_h, :im_w] = data[0]
-            padding_batch.append((padding_im, ) + data[1:])
-        return padding_batch
-
-    def reader():
-        if mode == "train":
+    def train_groups():
+        groups = {True: [], False: []}
+        group_num = 0
+        # the last iteration reads the minibatches of all the devices
+        max_groups = cfg.max_iter * device_num * batch_size // group_size
+        while True:
             if shuffle:
-                roidb_perm = deque(np.random.permutation(roidbs))
+                perm = np.random.permutation(len(roidbs))
             else:
-                roidb_perm = deque(roidbs)
-            roidb_cur = 0
-            count = 0
-            batch_out = []
-            device_num = total_batch_size / batch_size
-            while True:
-                roidb = roidb_perm[0]
-                roidb_cur += 1
-                roidb_perm.rotate(-1)
-                if roidb_cur >= len(roidbs):
-                    if shuffle:
-                        roidb_perm = deque(np.random.permutation(roidbs))
-                    else:
-                        roidb_perm = deque(roidbs)
-                    roidb_cur = 0
-                # im, gt_boxes, gt_classes, is_crowd, im_info, im_id, gt_masks
-                datas = roidb_reader(roidb, mode)
-                if datas[1].shape[0] == 0:
+                perm = np.arange(len(roidbs))
+            for i in perm:
+                roidb = roidbs[i]
+                if cfg.MASK_ON and not has_valid_masks(roidb):
                     continue
-                if cfg.MASK_ON:
-                    if len(datas[-1]) != datas[1].shape[0]:
-                        continue
-                batch_out.append(datas)
-                if not padding_total:
-                    if len(batch_out) == batch_size:
-                        yield padding_minibatch(batch_out)
-                        count += 1
-                        batch_out = []
-                else:
-                    if len(batch_out) == total_batch_size:
-                        batch_out = padding_minibatch(batch_out)
-                        for i in range(device_num):
-                            sub_batch_out = []
-                            for j in range(batch_size):
-                                sub_batch_out.append(batch_out[i * batch_size +
-                                                               j])
-                            yield sub_batch_out
-                            count += 1
-                            sub_batch_out = []
-                        batch_out = []
-                iter_id = count // device_num
-                if iter_id >= cfg.max_iter:
-                    return
-        elif mode == "val":
-            batch_out = []
-            for roidb in roidbs:
-                im, im_info, im_id = roidb_reader(roidb, mode)
-                batch_out.append((im, im_info, im_id))
-                if len(batch_out) == batch_size:
-                    yield batch_out
-                    batch_out = []
-            if len(batch_out) != 0:
-                yield batch_out
+                key = True
+                if cfg.TRAIN.group_by_aspect_ratio:
+                    key = roidb['width'] >= roidb['height']
+                groups[key].append(roidb)
+                if len(groups[key]) == group_size:
+                    yield groups[key]
+                    groups[key] = []
+                    group_num += 1
+                    if group_num >= max_groups:
+                        return
+
+    def val_groups():
+        for i in range(0, len(roidbs), batch_size):
+            yield roidbs[i:i + batch_size]
+
+    def tasks():
+        groups = train_groups() if mode == 'train' else val_groups()
+        for group_id, group in enumerate(groups):
+            if mode == 'train':
+                scales = cfg.TRAIN.scales
+                target_sizes = [
+                    scales[np.random.randint(0, high=len(scales))]
+                    for _ in group
+                ]
+                max_size = cfg.TRAIN.max_size
+            else:
+                target_sizes = [cfg.TEST.scales[0]] * len(group)
+                max_size = cfg.TEST.max_size
+            pad_shape = None
+            if mode == 'train' and len(group) > 1:
+                shapes = [
+                    data_utils.get_im_scale(r['height'], r['width'], t,
+                                            max_size)[1:]
+                    for r, t in zip(group, target_sizes)
+                ]
+                pad_shape = (3, ) + tuple(np.max(shapes, axis=0))
+            for index, (roidb, target_size) in enumerate(
+                    zip(group, target_sizes)):
+                yield group_id, len(group), index, roidb, target_size, pad_shape
+
+    def map_task(task):
+        group_id, group_len, index, roidb, target_size, pad_shape = task
+        datas = roidb_reader(roidb, mode, target_size)
+        if pad_shape is not None:
+            datas = (shm_reader.PaddedArray(datas[0], pad_shape), ) + datas[1:]
+        return (group_id, group_len, index) + datas
+
+    if cfg.reader_workers > 0:
+        mapped_reader = shm_reader.map_readers(
+            map_task,
+            tasks,
+            cfg.reader_workers,
+            buffer_size=2 * group_size + cfg.reader_workers,
+            sample_bytes=max_sample_bytes(roidbs, mode, group_size))
+    else:
+
+        def mapped_reader():
+            for task in tasks():
+                sample = map_task(task)
+                if isinstance(sample[3], shm_reader.PaddedArray):
+                    sample = sample[:3] + (sample[3].numpy(), ) + sample[4:]
+                yield sample
+
+    def reader():
+        pending = {}
+        for sample in mapped_reader():
+            group_id, group_len, index = sample[:3]
+            group = pending.setdefault(group_id, [None] * group_len)
+            group[index] = sample[3:]
+            if any(datas is None for datas in group):
+                continue
+            del pending[group_id]
+            # im, gt_boxes, gt_classes, is_crowd, im_info, im_id, gt_masks
+            # for training, im, im_info, im_id for evaluation
+            for i in range(0, group_len, batch_size):
+                yield group[i:i + batch_size]
 
     return reader
 
@@ -25,12 +25,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import copy
+import hashlib
 import logging
+import multiprocessing
 import numpy as np
 import os
-import scipy.sparse
-import random
+import pickle
 import time
 import matplotlib
 matplotlib.use('Agg')
@@ -42,61 +42,331 @@ from data_utils import DatasetPath
 
 logger = logging.getLogger(__name__)
 
+# bump when the layout of the cached columns changes
+ROIDB_CACHE_VERSION = 1
+# number of images built by one task of the worker pool
+ROIDB_CHUNK_SIZE = 1000
+# bytes read from each end of the annotation file for the cache key
+HASH_BLOCK_SIZE = 1 << 20
+
+# dataset shared with the forked workers building the roidb
+_worker_dataset = None
+
+
+def _file_fingerprint(path):
+    """Hash of the size, mtime and the first and last blocks of a file, which
+    catches any realistic change of an annotation file without reading all of
+    it at every start."""
+    stat = os.stat(path)
+    md5 = hashlib.md5()
+    md5.update('{}:{}'.format(stat.st_size, stat.st_mtime).encode('utf-8'))
+    with open(path, 'rb') as f:
+        md5.update(f.read(HASH_BLOCK_SIZE))
+        f.seek(max(0, stat.st_size - HASH_BLOCK_SIZE))
+        md5.update(f.read(HASH_BLOCK_SIZE))
+    return md5.hexdigest()
+
+
+def _build_columns(image_ids):
+    """Build the columns of the roidb entries of image_ids, run in a worker."""
+    return _worker_dataset._entries_to_columns(image_ids)
+
 
 class JsonDataset(object):
-    """A class representing a COCO json dataset."""
+    """A class representing a COCO json dataset.
+
+    The roidb is built from the annotation file by a pool of cfg.roidb_workers
+    processes and saved as a columnar .npz cache in cfg.roidb_cache_dir, keyed
+    by the annotation file and the config it depends on. Later runs load the
+    cache without parsing the annotation file at all.
+    """
 
     def __init__(self, mode):
         print('Creating: {}'.format(cfg.dataset))
         self.name = cfg.dataset
+        self.mode = mode
         self.is_train = mode == 'train'
         data_path = DatasetPath(mode)
         data_dir = data_path.get_data_dir()
-        file_list = data_path.get_file_list()
+        self.annotation_file = data_path.get_file_list()
         self.image_directory = data_dir
-        self.COCO = COCO(file_list)
+        self._COCO = None
+        self.cache_file = self._cache_file()
+        if os.path.exists(self.cache_file):
+            self.cache = np.load(self.cache_file)
+            category_ids = self.cache['category_ids'].tolist()
+            categories = self.cache['categories'].tolist()
+        else:
+            self.cache = None
+            category_ids = self.COCO.getCatIds()
+            categories = [c['name'] for c in self.COCO.loadCats(category_ids)]
         # Set up dataset classes
-        category_ids = self.COCO.getCatIds()
-        categories = [c['name'] for c in self.COCO.loadCats(category_ids)]
+        self.category_ids = category_ids
         self.category_to_id_map = dict(zip(categories, category_ids))
         self.classes = ['__background__'] + categories
         self.num_classes = len(self.classes)
         self.json_category_id_to_contiguous_id = {
             v: i + 1
-            for i, v in enumerate(self.COCO.getCatIds())
+            for i, v in enumerate(category_ids)
         }
         self.contiguous_category_id_to_json_id = {
             v: k
             for k, v in self.json_category_id_to_contiguous_id.items()
         }
 
+    @property
+    def COCO(self):
+        if self._COCO is None:
+            self._COCO = COCO(self.annotation_file)
+        return self._COCO
+
+    def _cache_file(self):
+        cache_dir = cfg.roidb_cache_dir or os.path.join(cfg.data_dir, 'cache')
+        key = hashlib.md5()
+        key.update(_file_fingerprint(self.annotation_file).encode('utf-8'))
+        # only the config the cached columns depend on, flipping and the
+        # training filter are applied when loading
+        key.update('{}:{}:{}:{}'.format(ROIDB_CACHE_VERSION, self.is_train,
+                                        cfg.TRAIN.gt_min_area,
+                                        cfg.MASK_ON).encode('utf-8'))
+        name = '{}_{}_roidb_{}.npz'.format(self.name, self.mode,
+                                           key.hexdigest()[:16])
+        return os.path.join(cache_dir, name)
+
     def get_roidb(self):
         """Return an roidb corresponding to the json dataset. Optionally:
            - include ground truth boxes in the roidb
-           - add proposals specified in a proposals file
-           - filter proposals based on a minimum side length
-           - filter proposals that intersect with crowd regions
+           - append horizontally-flipped entries
+           - filter entries without ground truth boxes for training
+        The segms of an entry are only kept with cfg.MASK_ON, as numpy arrays.
         """
+        start_time = time.time()
+        if self.cache is not None:
+            columns = dict(self.cache)
+            self.cache.close()
+            columns['rles'], columns['flipped_rles'] = pickle.loads(
+                columns['rles'].tobytes())
+            print('Loaded roidb cache {}'.format(self.cache_file))
+        else:
+            columns = self._build_roidb_columns()
+            self._save_cache(columns)
+        if self.is_train and cfg.TRAIN.use_flipped:
+            print('Appending horizontally-flipped training examples...')
+            columns = self._extend_with_flipped_columns(columns)
+        print('Loaded dataset: {:s}'.format(self.name))
+        print('{:d} roidb entries'.format(len(columns['id'])))
+        if self.is_train:
+            keep = self._filter_for_training(columns)
+        else:
+            keep = np.arange(len(columns['id']))
+        roidb = self._columns_to_roidb(columns, keep)
+        print('get_roidb took {:.3f}s'.format(time.time() - start_time))
+        return roidb
+
+    def _build_roidb_columns(self):
+        global _worker_dataset
         image_ids = self.COCO.getImgIds()
+        if not image_ids:
+            raise ValueError('No images in the annotation file {}'.format(
+                self.annotation_file))
         image_ids.sort()
-        roidb = copy.deepcopy(self.COCO.loadImgs(image_ids))
-        for entry in roidb:
+        chunks = [
+            image_ids[i:i + ROIDB_CHUNK_SIZE]
+            for i in range(0, len(image_ids), ROIDB_CHUNK_SIZE)
+        ]
+        start_time = time.time()
+        if cfg.roidb_workers > 1 and len(chunks) > 1:
+            _worker_dataset = self
+            pool = multiprocessing.Pool(min(cfg.roidb_workers, len(chunks)))
+            try:
+                results = pool.map(_build_columns, chunks)
+            finally:
+                pool.terminate()
+                _worker_dataset = None
+        else:
+            results = [self._entries_to_columns(chunk) for chunk in chunks]
+        print('Building roidb took {:.3f}s'.format(time.time() - start_time))
+
+        columns = {}
+        for k in results[0]:
+            if k in ('rles', 'flipped_rles'):
+                columns[k] = [rle for r in results for rle in r[k]]
+            else:
+                columns[k] = np.concatenate([r[k] for r in results])
+        columns['category_ids'] = np.array(self.category_ids, dtype=np.int64)
+        columns['categories'] = np.array(self.classes[1:])
+        return columns
+
+    def _save_cache(self, columns):
+        arrays = dict(columns)
+        # RLE segms are few, pickle them together instead of making columns
+        del arrays['flipped_rles']
+        arrays['rles'] = np.frombuffer(
+            pickle.dumps(
+                (columns['rles'], columns['flipped_rles']), protocol=2),
+            dtype=np.uint8)
+        tmp_file = self.cache_file + '.tmp.{}'.format(os.getpid())
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # np.savez appends .npz to names without it
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, **arrays)
+            os.rename(tmp_file, self.cache_file)
+            print('Saved roidb cache {}'.format(self.cache_file))
+        except (IOError, OSError) as e:
+            logger.warning('Failed to save roidb cache {}: {}'.format(
+                self.cache_file, e))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _entries_to_columns(self, image_ids):
+        """Build the roidb entries of image_ids and pack them into columns.
+
+        Images have id, width, height, file_name and gt_num, the number of
+        their ground truth objects. Objects have gt_boxes, gt_classes, gt_id,
+        is_crowd and, with cfg.MASK_ON, num_polys, the number of polygons of
+        their segm or -1 for an RLE segm. Polygons are poly_len coordinates
+        of poly_coords, and rles and flipped_rles hold the RLE segms.
+        """
+        entries = []
+        file_names = []
+        for img in self.COCO.loadImgs(image_ids):
+            entry = dict(img)
+            file_names.append(entry['file_name'])
             self._prep_roidb_entry(entry)
-        if self.is_train:
-            # Include ground-truth object annotations
-            start_time = time.time()
-            for entry in roidb:
+            if self.is_train:
                 self._add_gt_annotations(entry)
-            end_time = time.time()
-            print('_add_gt_annotations took {:.3f}s'.format(end_time -
-                                                            start_time))
-            if cfg.TRAIN.use_flipped:
-                print('Appending horizontally-flipped training examples...')
-                self._extend_with_flipped_entries(roidb)
-        print('Loaded dataset: {:s}'.format(self.name))
-        print('{:d} roidb entries'.format(len(roidb)))
-        if self.is_train:
-            self._filter_for_training(roidb)
+            entries.append(entry)
+
+        columns = {
+            'id': np.array([e['id'] for e in entries], dtype=np.int64),
+            'width': np.array([e['width'] for e in entries], dtype=np.int32),
+            'height': np.array([e['height'] for e in entries], dtype=np.int32),
+            'file_name': np.array(file_names),
+            'gt_num': np.array([len(e['gt_boxes']) for e in entries],
+                               dtype=np.int64),
+        }
+        for k in ['gt_boxes', 'gt_classes', 'gt_id', 'is_crowd']:
+            columns[k] = np.concatenate([e[k] for e in entries])
+        columns['gt_boxes'] = columns['gt_boxes'].reshape((-1, 4))
+
+        num_polys = []
+        poly_len = []
+        poly_coords = []
+        rles = []
+        flipped_rles = []
+        if cfg.MASK_ON:
+            for e in entries:
+                for segm in e['segms']:
+                    if segm_utils.is_poly(segm):
+                        num_polys.append(len(segm))
+                        poly_len.extend(len(poly) for poly in segm)
+                        poly_coords.extend(segm)
+                    else:
+                        num_polys.append(-1)
+                        rles.append(segm)
+                        flipped_rles.extend(
+                            segm_utils.flip_segms([segm], e['height'],
+                                                  e['width']))
+        columns['num_polys'] = np.array(num_polys, dtype=np.int64)
+        columns['poly_len'] = np.array(poly_len, dtype=np.int64)
+        columns['poly_coords'] = np.array(
+            [c for poly in poly_coords for c in poly], dtype=np.float64)
+        columns['rles'] = rles
+        columns['flipped_rles'] = flipped_rles
+        return columns
+
+    def _extend_with_flipped_columns(self, columns):
+        """Append horizontally flipped copies of all the entries.
+
+        "Flipping" an entry means that that image and associated metadata
+        (e.g., ground truth boxes and segms) are horizontally flipped, which is
+        done here on whole columns at once.
+        """
+        width = columns['width']
+        obj_width = np.repeat(width, columns['gt_num']).astype(np.float32)
+        gt_boxes = columns['gt_boxes'].copy()
+        gt_boxes[:, 0] = obj_width - columns['gt_boxes'][:, 2] - 1
+        gt_boxes[:, 2] = obj_width - columns['gt_boxes'][:, 0] - 1
+        assert (gt_boxes[:, 2] >= gt_boxes[:, 0]).all()
+
+        # x coordinates are at the even positions of every polygon
+        poly_coords = columns['poly_coords'].copy()
+        if len(poly_coords):
+            obj_polys = np.maximum(columns['num_polys'], 0)
+            poly_width = np.repeat(
+                np.repeat(width, columns['gt_num']), obj_polys)
+            poly_start = np.cumsum(columns['poly_len']) - columns['poly_len']
+            pos = np.arange(len(poly_coords)) - np.repeat(
+                poly_start, columns['poly_len'])
+            is_x = pos % 2 == 0
+            coord_width = np.repeat(poly_width, columns['poly_len'])
+            poly_coords[is_x] = coord_width[is_x] - poly_coords[is_x] - 1
+
+        flipped = dict(columns)
+        for k in ['id', 'width', 'height', 'file_name', 'gt_num']:
+            flipped[k] = np.concatenate([columns[k], columns[k]])
+        flipped['flipped'] = np.concatenate([
+            np.zeros(len(width), dtype=np.bool_), np.ones(
+                len(width), dtype=np.bool_)
+        ])
+        flipped['gt_boxes'] = np.concatenate([columns['gt_boxes'], gt_boxes])
+        for k in ['gt_classes', 'gt_id', 'is_crowd', 'num_polys', 'poly_len']:
+            flipped[k] = np.concatenate([columns[k], columns[k]])
+        flipped['poly_coords'] = np.concatenate(
+            [columns['poly_coords'], poly_coords])
+        flipped['rles'] = columns['rles'] + columns['flipped_rles']
+        return flipped
+
+    def _columns_to_roidb(self, columns, keep):
+        """Make the roidb entries keep of the columns, their arrays are views
+        of the columns."""
+        num_entries = len(columns['id'])
+        flipped = columns.get('flipped',
+                              np.zeros(num_entries, dtype=np.bool_))
+
+        gt_offsets = np.concatenate([[0], np.cumsum(columns['gt_num'])])
+        segms = []
+        if cfg.MASK_ON and len(columns['num_polys']):
+            coords = columns['poly_coords']
+            poly_ends = np.cumsum(columns['poly_len']).tolist()
+            polys = [
+                coords[start:end]
+                for start, end in zip([0] + poly_ends[:-1], poly_ends)
+            ]
+            rles = iter(columns['rles'])
+            poly_cur = 0
+            for n in columns['num_polys'].tolist():
+                if n < 0:
+                    segms.append(next(rles))
+                else:
+                    segms.append(polys[poly_cur:poly_cur + n])
+                    poly_cur += n
+
+        ids = columns['id'].tolist()
+        widths = columns['width'].tolist()
+        heights = columns['height'].tolist()
+        file_names = columns['file_name'].tolist()
+        flipped = flipped.tolist()
+        offsets = gt_offsets.tolist()
+        image_prefix = os.path.join(self.image_directory, '')
+        roidb = []
+        for i in keep.tolist():
+            start, end = offsets[i], offsets[i + 1]
+            roidb.append({
+                'id': ids[i],
+                'width': widths[i],
+                'height': heights[i],
+                'image': image_prefix + file_names[i],
+                'flipped': flipped[i],
+                'gt_boxes': columns['gt_boxes'][start:end],
+                'gt_classes': columns['gt_classes'][start:end],
+                'gt_id': columns['gt_id'][start:end],
+                'is_crowd': columns['is_crowd'][start:end],
+                'segms': segms[start:end],
+            })
         return roidb
 
     def _prep_roidb_entry(self, entry):
@@ -169,48 +439,17 @@ class JsonDataset(object):
         entry['is_crowd'] = np.append(entry['is_crowd'], is_crowd)
         entry['segms'].extend(valid_segms)
 
-    def _extend_with_flipped_entries(self, roidb):
-        """Flip each entry in the given roidb and return a new roidb that is the
-        concatenation of the original roidb and the flipped entries.
-        "Flipping" an entry means that that image and associated metadata (e.g.,
-        ground truth boxes and object proposals) are horizontally flipped.
+    def _filter_for_training(self, columns):
+        """Return the indices of the entries that have usable RoIs based on
+        config settings.
         """
-        flipped_roidb = []
-        for entry in roidb:
-            width = entry['width']
-            gt_boxes = entry['gt_boxes'].copy()
-            oldx1 = gt_boxes[:, 0].copy()
-            oldx2 = gt_boxes[:, 2].copy()
-            gt_boxes[:, 0] = width - oldx2 - 1
-            gt_boxes[:, 2] = width - oldx1 - 1
-            assert (gt_boxes[:, 2] >= gt_boxes[:, 0]).all()
-            flipped_entry = {}
-            dont_copy = ('gt_boxes', 'flipped', 'segms')
-            for k, v in entry.items():
-                if k not in dont_copy:
-                    flipped_entry[k] = v
-            flipped_entry['gt_boxes'] = gt_boxes
-            flipped_entry['segms'] = segm_utils.flip_segms(
-                entry['segms'], entry['height'], entry['width'])
-            flipped_entry['flipped'] = True
-            flipped_roidb.append(flipped_entry)
-        roidb.extend(flipped_roidb)
-
-    def _filter_for_training(self, roidb):
-        """Remove roidb entries that have no usable RoIs based on config settings.
-        """
-
-        def is_valid(entry):
-            # Valid images have:
-            #   (1) At least one groundtruth RoI OR
-            #   (2) At least one background RoI
-            gt_boxes = entry['gt_boxes']
-            # image is only valid if such boxes exist
-            valid = len(gt_boxes) > 0
-            return valid
-
-        num = len(roidb)
-        filtered_roidb = [entry for entry in roidb if is_valid(entry)]
-        num_after = len(filtered_roidb)
+        # Valid images have:
+        #   (1) At least one groundtruth RoI OR
+        #   (2) At least one background RoI
+        # image is only valid if such boxes exist
+        keep = np.flatnonzero(columns['gt_num'] > 0)
+        num = len(columns['gt_num'])
+        num_after = len(keep)
         print('Filtered {} roidb entries: {} -> {}'.format(num - num_after, num,
                                                            num_after))
+        return keep
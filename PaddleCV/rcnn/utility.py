@@ -137,6 +137,8 @@ def parse_args():
     add_arg('padding_minibatch',bool,   False,
         "If False, only resize image and not pad, image shape is different between"
         " GPUs in one mini-batch. If True, image shape is the same in one mini-batch.")
+    add_arg('group_by_aspect_ratio', bool, False, "Whether to put only landscape or only portrait images in a padded mini-batch.")
+    add_arg('reader_workers',   int,    0,          "Number of processes decoding images, 0 to decode on the reader thread.")
     #SOLVER
     add_arg('learning_rate',    float,  0.01,     "Learning rate.")
     add_arg('max_iter',         int,    180000,   "Iter number.")
@@ -157,6 +159,8 @@ def parse_args():
     add_arg('pixel_means',     float,   [102.9801, 115.9465, 122.7717], "pixel mean")
     add_arg('nms_thresh',    float, 0.5,    "NMS threshold.")
     add_arg('score_thresh',    float, 0.05,    "score threshold for NMS.")
+    add_arg('host_nms',        bool,  False,   "Decode boxes and run NMS on the host instead of in the graph.")
+    add_arg('softnms',         bool,  False,   "Use soft-NMS instead of NMS, runs on the host.")
     add_arg('snapshot_stride',  int,    10000,    "save model every snapshot stride.")
     # SINGLE EVAL AND DRAW
     add_arg('draw_threshold',  float, 0.8,    "Confidence threshold to draw bbox.")
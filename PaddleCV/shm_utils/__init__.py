@@ -0,0 +1,9 @@
+"""Shared-memory data loading utilities shared by the PaddleCV models.
+
+Import them with the PaddleCV directory appended to ``sys.path``::
+
+    sys.path.append(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+    from shm_utils import shm_reader
+    from shm_utils.enqueuer import SharedMemoryEnqueuer
+"""
@@ -0,0 +1,186 @@
+"""
+Multiprocess batch enqueuer passing batches through shared memory.
+
+The start/stop/get interface is based on the GeneratorEnqueuer of
+https://github.com/fchollet/keras/blob/master/keras/utils/data_utils.py
+"""
+
+import sys
+import ctypes
+import random
+import signal
+import traceback
+import numpy as np
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+ERROR_EVENT = "ERROR_EVENT"
+DONE_EVENT = "DONE_EVENT"
+
+# how often a blocked get() wakes up to check for dead workers, in seconds
+POLL_INTERVAL = 1.0
+
+
+# handle terminate reader process, do not print stack frame
+def _reader_quit(signum, frame):
+    print("Reader process exit.")
+    sys.exit()
+
+
+def _align(nbytes, alignment=64):
+    return (nbytes + alignment - 1) // alignment * alignment
+
+
+class SharedMemoryEnqueuer(object):
+    """
+    Runs a batch generator in each of several worker processes and hands the
+    batches over through a shared-memory ring buffer.
+
+    Every batch is a tuple of numpy arrays, written by a worker into one of
+    `max_queue_size` preallocated slots; only the slot id and the array
+    shapes go through a queue, so batch data is never pickled.
+
+    Args:
+        generator_creator: function of (worker_id, num_workers), called in
+            each worker process, returning a generator of batches. Workers
+            should read disjoint shards of the data. `get()` ends once the
+            generators of all the workers are exhausted, and never if they
+            yield endlessly.
+        batch_bytes (int): upper bound of the total bytes of the arrays of
+            one batch.
+        random_seed (int): Initial seed for workers,
+            will be incremented by one for each workers.
+    """
+
+    def __init__(self, generator_creator, batch_bytes, random_seed=None):
+        self._generator_creator = generator_creator
+        self._slot_bytes = _align(int(batch_bytes))
+        self.seed = random_seed
+        self._workers = []
+        self._buf = None
+        self._free_slots = None
+        self._ready_queue = None
+
+    def start(self, workers=1, max_queue_size=10):
+        """
+        Start worker processes which write batches into the shared memory.
+
+        Args:
+            workers (int): number of worker processes
+            max_queue_size (int): number of batches buffered in shared memory
+        """
+        self._buf = multiprocessing.RawArray(
+            ctypes.c_uint8, max_queue_size * self._slot_bytes)
+        self._free_slots = multiprocessing.Queue()
+        self._ready_queue = multiprocessing.Queue()
+        for slot in range(max_queue_size):
+            self._free_slots.put(slot)
+        try:
+            for worker_id in range(workers):
+                if self.seed is None:
+                    seed = np.random.randint(0, 2**31 - 1)
+                else:
+                    seed = self.seed + worker_id
+                w = multiprocessing.Process(
+                    target=self._worker_loop, args=(worker_id, workers, seed))
+                w.daemon = True
+                w.start()
+                self._workers.append(w)
+        except:
+            self.stop()
+            raise
+
+    def _worker_loop(self, worker_id, num_workers, seed):
+        signal.signal(signal.SIGTERM, _reader_quit)
+        # Reset random seed else all children processes
+        # share the same seed
+        random.seed(seed)
+        np.random.seed(seed)
+        data = np.frombuffer(self._buf, dtype='uint8')
+        try:
+            for batch in self._generator_creator(worker_id, num_workers):
+                slot = self._free_slots.get()
+                fields = self._write_batch(data, slot * self._slot_bytes,
+                                           batch)
+                self._ready_queue.put((slot, fields))
+            self._ready_queue.put((DONE_EVENT, None))
+        except Exception:
+            self._ready_queue.put((ERROR_EVENT, traceback.format_exc()))
+
+    def _write_batch(self, data, base, batch):
+        fields = []
+        offset = 0
+        for array in batch:
+            array = np.ascontiguousarray(array)
+            end = offset + array.nbytes
+            if end > self._slot_bytes:
+                raise ValueError("batch needs more than %d bytes, please "
+                                 "increase batch_bytes" % self._slot_bytes)
+            data[base + offset:base + end] = array.reshape(-1).view('uint8')
+            fields.append((offset, array.shape, array.dtype.str))
+            offset = _align(end)
+        return fields
+
+    def is_running(self):
+        """
+        Returns:
+            bool: Whether the worker processes are running.
+        """
+        return len(self._workers) > 0
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker processes and wait for them to exit.
+        Should be called by the same thread which called `start()`.
+
+        Args:
+            timeout(int|None): maximum time to wait on `process.join()`.
+        """
+        for w in self._workers:
+            if w.is_alive():
+                w.terminate()
+        for w in self._workers:
+            w.join(timeout)
+        for q in (self._free_slots, self._ready_queue):
+            if q is not None:
+                q.cancel_join_thread()
+                q.close()
+        self._workers = []
+        self._free_slots = None
+        self._ready_queue = None
+        self._buf = None
+
+    def get(self):
+        """
+        Creates a generator to extract batches from the shared memory.
+
+        # Yields
+            tuple of the numpy arrays of a batch, copied out of the
+            shared memory.
+        """
+        data = np.frombuffer(self._buf, dtype='uint8')
+        num_done = 0
+        while self.is_running() and num_done < len(self._workers):
+            try:
+                slot, fields = self._ready_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if any(w.exitcode not in (None, 0) for w in self._workers):
+                    raise RuntimeError("reader worker exited unexpectedly")
+                continue
+            if slot == ERROR_EVENT:
+                raise RuntimeError("reader worker failed:\n" + fields)
+            if slot == DONE_EVENT:
+                num_done += 1
+                continue
+            base = slot * self._slot_bytes
+            batch = []
+            for offset, shape, dtype in fields:
+                nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                # copy out, the slot is recycled as soon as we return
+                batch.append(data[base + offset:base + offset + nbytes].view(
+                    dtype).reshape(shape).copy())
+            self._free_slots.put(slot)
+            yield tuple(batch)
@@ -0,0 +1,241 @@
+# Copyright (c) 2018 PaddlePaddle Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Process-pool replacement for ``paddle.reader.xmap_readers``.
+
+``xmap_readers`` runs the mapper in threads, so PIL/cv2 decoding and
+augmentation are bound by the GIL. ``map_readers`` runs the mapper in worker
+processes instead and hands the mapped samples back through a preallocated
+shared-memory ring buffer: every array of a sample is copied by the worker
+into a fixed-size slot and copied out of it by the reader, and only the slot
+id, the array shapes and small python values go back pickled through a queue.
+A ``PaddedArray`` is zero padded to its target shape while it is written into
+the slot, so padding a minibatch costs no copy beyond those two.
+
+The source reader itself (list reading, shuffling, trainer splitting) runs
+unchanged in the parent process, so the per-epoch sample order is exactly the
+one of the source reader. Workers pull samples from a shared task queue, which
+balances load between them; the output order is the completion order, like
+``xmap_readers(order=False)``.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import ctypes
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+FINISH_EVENT = "FINISH_EVENT"
+ERROR_EVENT = "ERROR_EVENT"
+
+# how often blocked calls wake up to check for stop/dead workers, in seconds
+POLL_INTERVAL = 1.0
+
+
+class PaddedArray(object):
+    """An array to be zero padded at the end of each axis to shape."""
+
+    def __init__(self, array, shape):
+        assert all(n <= m for n, m in zip(array.shape, shape)), \
+            "can not pad an array of shape {} to {}".format(array.shape, shape)
+        self.array = array
+        self.shape = tuple(shape)
+
+    def numpy(self):
+        out = np.zeros(self.shape, dtype=self.array.dtype)
+        out[tuple(slice(0, n) for n in self.array.shape)] = self.array
+        return out
+
+
+def _align(nbytes, alignment=64):
+    return (nbytes + alignment - 1) // alignment * alignment
+
+
+def _write_sample(data, base, slot_bytes, sample):
+    """Copy the arrays of ``sample`` into the slot starting at ``base``.
+
+    Returns the field descriptions: ``('a', offset, shape, dtype)`` for arrays
+    stored in the slot and ``('v', value)`` for small values sent inline.
+    """
+    fields = []
+    offset = 0
+    for item in sample:
+        if isinstance(item, (np.ndarray, PaddedArray)):
+            if isinstance(item, PaddedArray):
+                array = item.array
+                shape = item.shape
+            else:
+                array = np.ascontiguousarray(item)
+                shape = array.shape
+            dtype = array.dtype
+            end = offset + int(np.prod(shape)) * dtype.itemsize
+            if end > slot_bytes:
+                raise ValueError("sample needs more than %d bytes, please "
+                                 "increase sample_bytes" % slot_bytes)
+            out = data[base + offset:base + end].view(dtype).reshape(shape)
+            if shape != array.shape:
+                out.fill(0)
+                out = out[tuple(slice(0, n) for n in array.shape)]
+            out[...] = array
+            fields.append(('a', offset, shape, dtype.str))
+            offset = _align(end)
+        else:
+            fields.append(('v', item))
+    return fields
+
+
+def _read_sample(data, base, fields):
+    sample = []
+    for field in fields:
+        if field[0] == 'a':
+            _, offset, shape, dtype = field
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            # copy out, the slot is recycled as soon as we return
+            item = data[base + offset:base + offset + nbytes].view(
+                dtype).reshape(shape).copy()
+            sample.append(item)
+        else:
+            sample.append(field[1])
+    return tuple(sample)
+
+
+def _worker_loop(mapper, buf, slot_bytes, task_queue, free_slots, ready_queue,
+                 seed):
+    # forked workers share the parent's RNG state, reseed for augmentation
+    np.random.seed(seed)
+    data = np.frombuffer(buf, dtype='uint8')
+    try:
+        while True:
+            sample = task_queue.get()
+            if sample is None:
+                break
+            sample = mapper(sample)
+            slot = free_slots.get()
+            fields = _write_sample(data, slot * slot_bytes, slot_bytes, sample)
+            ready_queue.put((slot, fields))
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        ready_queue.put((ERROR_EVENT, traceback.format_exc()))
+    ready_queue.put((FINISH_EVENT, None))
+
+
+def map_readers(mapper, reader, process_num, buffer_size, sample_bytes):
+    """Map samples of ``reader`` with ``mapper`` in ``process_num`` processes.
+
+    Args:
+        mapper: function applied to each sample, returns a tuple or list of
+            numpy arrays, PaddedArrays and small python values.
+        reader: the source sample reader, iterated in the parent process.
+            Its samples are pickled to the workers, so it should yield
+            paths or small references, e.g. ``image_shard.ShardImage``,
+            rather than arrays.
+        process_num (int): number of worker processes.
+        buffer_size (int): number of slots in the shared-memory ring buffer.
+        sample_bytes (int): slot size, an upper bound for the total bytes of
+            the arrays of one mapped sample.
+
+    Returns:
+        A reader yielding the mapped samples. Workers are started per epoch and
+        are terminated when the epoch ends, fails, or when the returned
+        generator is closed or dropped mid-epoch.
+    """
+    context = {'buf': None}
+    slot_bytes = _align(int(sample_bytes))
+
+    def _reader():
+        if context['buf'] is None:
+            # allocated once before forking, reused by every epoch
+            context['buf'] = multiprocessing.RawArray(ctypes.c_uint8,
+                                                      buffer_size * slot_bytes)
+        buf = context['buf']
+        data = np.frombuffer(buf, dtype='uint8')
+
+        task_queue = multiprocessing.Queue(buffer_size)
+        free_slots = multiprocessing.Queue()
+        ready_queue = multiprocessing.Queue()
+        for slot in range(buffer_size):
+            free_slots.put(slot)
+        stop_event = threading.Event()
+
+        workers = []
+        for i in range(process_num):
+            seed = np.random.randint(0, 2**31 - 1)
+            w = multiprocessing.Process(
+                target=_worker_loop,
+                args=(mapper, buf, slot_bytes, task_queue, free_slots,
+                      ready_queue, seed))
+            w.daemon = True
+            w.start()
+            workers.append(w)
+
+        def _put(item):
+            while not stop_event.is_set():
+                try:
+                    task_queue.put(item, timeout=POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _feed():
+            try:
+                for sample in reader():
+                    if not _put(sample):
+                        return
+            except Exception:
+                ready_queue.put((ERROR_EVENT, traceback.format_exc()))
+            for _ in workers:
+                _put(None)
+
+        feeder = threading.Thread(target=_feed)
+        feeder.daemon = True
+        feeder.start()
+
+        finished = 0
+        try:
+            while finished < len(workers):
+                try:
+                    slot, fields = ready_queue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    if any(w.exitcode not in (None, 0) for w in workers):
+                        raise RuntimeError("reader worker exited unexpectedly")
+                    continue
+                if slot == FINISH_EVENT:
+                    finished += 1
+                elif slot == ERROR_EVENT:
+                    raise RuntimeError("reader worker failed:\n" + fields)
+                else:
+                    sample = _read_sample(data, slot * slot_bytes, fields)
+                    free_slots.put(slot)
+                    yield sample
+        finally:
+            stop_event.set()
+            for w in workers:
+                if finished < len(workers) and w.is_alive():
+                    # abandoned mid-epoch or failed
+                    w.terminate()
+                w.join()
+            feeder.join()
+            for q in (task_queue, free_slots, ready_queue):
+                q.cancel_join_thread()
+                q.close()
+
+    return _reader
@@ -0,0 +1,193 @@
+#  Copyright (c) 2019 PaddlePaddle Authors. All Rights Reserve.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+"""
+Transforms of a whole clip, given as a (T, H, W, C) uint8 array.
+
+Every frame of a clip shares one crop window, so crops and flips are views
+of the clip, resizing writes every frame into one preallocated array, and
+normalization converts the whole clip at once.
+"""
+
+import random
+import cv2
+import numpy as np
+
+MULTI_CROPS = [1, 3, 5, 10]
+
+
+def resize(clip, width, height):
+    length, h, w, channel = clip.shape
+    if (w, h) == (width, height):
+        return clip
+    out = np.empty((length, height, width, channel), dtype=clip.dtype)
+    for i in range(length):
+        # resizing frame by frame is faster than resizing the clip as one
+        # image of length * channel channels
+        cv2.resize(
+            clip[i], (width, height),
+            dst=out[i],
+            interpolation=cv2.INTER_LINEAR)
+    return out
+
+
+def crop(clip, x1, y1, tw, th):
+    return clip[:, y1:y1 + th, x1:x1 + tw]
+
+
+def scale(clip, target_size):
+    """
+    Resize the short side to target_size and the long side to 4/3 of it.
+    """
+    h, w = clip.shape[1:3]
+    if (w <= h and w == target_size) or (h <= w and h == target_size):
+        return clip
+    if w < h:
+        return resize(clip, target_size, int(target_size * 4.0 / 3.0))
+    return resize(clip, int(target_size * 4.0 / 3.0), target_size)
+
+
+def multi_scale_crop(clip, target_size, scales=None, max_distort=1, \
+        fix_crop=True, more_fix_crop=True):
+    scales = scales if scales is not None else [1, .875, .75, .66]
+    image_h, image_w = clip.shape[1:3]
+
+    base_size = min(image_w, image_h)
+    crop_sizes = [int(base_size * x) for x in scales]
+    crop_h = [target_size if abs(x - target_size) < 3 else x for x in crop_sizes]
+    crop_w = [target_size if abs(x - target_size) < 3 else x for x in crop_sizes]
+
+    pairs = []
+    for i, h in enumerate(crop_h):
+        for j, w in enumerate(crop_w):
+            if abs(i - j) <= max_distort:
+                pairs.append((w, h))
+
+    crop_pair = random.choice(pairs)
+    if not fix_crop:
+        w_offset = random.randint(0, image_w - crop_pair[0])
+        h_offset = random.randint(0, image_h - crop_pair[1])
+    else:
+        w_offset, h_offset = random.choice(
+            fix_offsets(image_w, image_h, crop_pair[0], crop_pair[1],
+                        more_fix_crop))
+
+    clip = crop(clip,
+                int(round(w_offset)),
+                int(round(h_offset)), crop_pair[0], crop_pair[1])
+    return resize(clip, target_size, target_size)
+
+
+def fix_offsets(image_w, image_h, crop_w, crop_h, more_fix_crop=True):
+    w_step = (image_w - crop_w) / 4
+    h_step = (image_h - crop_h) / 4
+
+    ret = list()
+    ret.append((0, 0))  # upper left
+    if w_step != 0:
+        ret.append((4 * w_step, 0))  # upper right
+    if h_step != 0:
+        ret.append((0, 4 * h_step))  # lower left
+    if h_step != 0 and w_step != 0:
+        ret.append((4 * w_step, 4 * h_step))  # lower right
+    if h_step != 0 or w_step != 0:
+        ret.append((2 * w_step, 2 * h_step))  # center
+
+    if more_fix_crop:
+        ret.append((0, 2 * h_step))  # center left
+        ret.append((4 * w_step, 2 * h_step))  # center right
+        ret.append((2 * w_step, 4 * h_step))  # lower center
+        ret.append((2 * w_step, 0 * h_step))  # upper center
+
+        ret.append((1 * w_step, 1 * h_step))  # upper left quarter
+        ret.append((3 * w_step, 1 * h_step))  # upper right quarter
+        ret.append((1 * w_step, 3 * h_step))  # lower left quarter
+        ret.append((3 * w_step, 3 * h_step))  # lower righ quarter
+
+    return ret
+
+
+def random_crop(clip, target_size):
+    h, w = clip.shape[1:3]
+    assert (w >= target_size) and (h >= target_size), \
+          "image width({}) and height({}) should be larger than crop size".format(w, h, target_size)
+    x1 = random.randint(0, w - target_size)
+    y1 = random.randint(0, h - target_size)
+    return crop(clip, x1, y1, target_size, target_size)
+
+
+def random_flip(clip):
+    if random.random() < 0.5:
+        return clip[:, :, ::-1]
+    return clip
+
+
+def center_crop(clip, target_size):
+    h, w = clip.shape[1:3]
+    assert (w >= target_size) and (h >= target_size), \
+         "image width({}) and height({}) should be larger than crop size".format(w, h, target_size)
+    x1 = int(round((w - target_size) / 2.))
+    y1 = int(round((h - target_size) / 2.))
+    return crop(clip, x1, y1, target_size, target_size)
+
+
+def multi_crop(clip, target_size, num_crops):
+    """
+    Crops for multi-crop testing, stacked into a
+    (num_crops, T, target_size, target_size, C) array.
+     1: the center crop
+     3: crops at the start, center and end of the long side
+     5: the four corner crops and the center crop
+    10: the 5 crops and their horizontal flips
+    """
+    assert num_crops in MULTI_CROPS, \
+            "num_crops {} not in {}".format(num_crops, MULTI_CROPS)
+    if num_crops == 1:
+        return center_crop(clip, target_size)[np.newaxis]
+    h, w = clip.shape[1:3]
+    assert (w >= target_size) and (h >= target_size), \
+         "image width({}) and height({}) should be larger than crop size".format(w, h, target_size)
+    if num_crops == 3:
+        if w >= h:
+            step = (w - target_size) // 2
+            offsets = [(i * step, (h - target_size) // 2) for i in range(3)]
+        else:
+            step = (h - target_size) // 2
+            offsets = [((w - target_size) // 2, i * step) for i in range(3)]
+    else:
+        w_step = (w - target_size) // 4
+        h_step = (h - target_size) // 4
+        offsets = [(0, 0), (4 * w_step, 0), (0, 4 * h_step),
+                   (4 * w_step, 4 * h_step), (2 * w_step, 2 * h_step)]
+    crops = [
+        crop(clip, x1, y1, target_size, target_size)
+        for x1, y1 in offsets
+    ]
+    if num_crops == 10:
+        crops += [c[:, :, ::-1] for c in crops]
+    return np.stack(crops)
+
+
+def normalize(clip, img_mean, img_std):
+    """
+    Converts a (..., T, H, W, C) uint8 clip to float32 and (..., T, C, H, W)
+    layout, scales it to [0, 1] and normalizes it with the (C, 1, 1) mean
+    and std.
+    """
+    axes = list(range(clip.ndim - 3)) + [clip.ndim - 1, clip.ndim - 3,
+                                         clip.ndim - 2]
+    imgs = np.empty([clip.shape[i] for i in axes], dtype='float32')
+    np.copyto(imgs, clip.transpose(axes))
+    imgs *= 1. / (255 * img_std)
+    imgs -= img_mean / img_std
+    return imgs
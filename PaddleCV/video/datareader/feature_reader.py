@@ -14,12 +14,11 @@
 
 import sys
 from .reader_utils import DataReader
+from . import feature_store
 try:
     import cPickle as pickle
-    from cStringIO import StringIO
 except ImportError:
     import pickle
-    from io import BytesIO
 import numpy as np
 import random
 
@@ -34,6 +33,13 @@ class FeatureReader(DataReader):
     dataset cfg: num_classes
                  batch_size
                  list
+                 format, 'pkl' (default) or 'columnar' if the list holds
+                         shards of a feature store, see feature_store.py
+                 bucket_batches, if positive, sort windows of
+                                 bucket_batches * batch_size videos by length
+                                 and batch neighbours, so that the sequences
+                                 of a batch have similar lengths. Batches are
+                                 shuffled again when training. columnar only
                  NextVlad only: eigen_file
     """
 
@@ -47,12 +53,16 @@ class FeatureReader(DataReader):
         self.filelist = cfg[mode.upper()]['filelist']
         self.eigen_file = cfg.MODEL.get('eigen_file', None)
         self.seg_num = cfg.MODEL.get('seg_num', None)
+        self.format = cfg.MODEL.get('format', 'pkl')
+        self.bucket_batches = cfg[mode.upper()].get('bucket_batches', 0)
 
     def create_reader(self):
         fl = open(self.filelist).readlines()
         fl = [line.strip() for line in fl if line.strip() != '']
         if self.mode == 'train':
             random.shuffle(fl)
+        if self.format == 'columnar':
+            return self._columnar_reader(fl)
 
         def reader():
             batch_out = []
@@ -67,41 +77,91 @@ class FeatureReader(DataReader):
                 for i in indexes:
                     record = data[i]
                     nframes = record[b'nframes']
-                    rgb = record[b'feature'].astype(float)
-                    audio = record[b'audio'].astype(float)
-                    if self.mode != 'infer':
-                        label = record[b'label']
-                        one_hot_label = make_one_hot(label, self.num_classes)
-                    video = record[b'video']
-
-                    rgb = rgb[0:nframes, :]
-                    audio = audio[0:nframes, :]
-
-                    if self.name != 'NEXTVLAD':
-                        rgb = dequantize(
-                            rgb,
-                            max_quantized_value=2.,
-                            min_quantized_value=-2.)
-                        audio = dequantize(
-                            audio,
-                            max_quantized_value=2,
-                            min_quantized_value=-2)
-
-                    if self.name == 'ATTENTIONCLUSTER':
-                        sample_inds = generate_random_idx(rgb.shape[0],
-                                                          self.seg_num)
-                        rgb = rgb[sample_inds]
-                        audio = audio[sample_inds]
-                    if self.mode != 'infer':
-                        batch_out.append((rgb, audio, one_hot_label))
-                    else:
-                        batch_out.append((rgb, audio, video))
+                    label = record[b'label'] if self.mode != 'infer' else None
+                    batch_out.append((record[b'feature'][0:nframes, :],
+                                      record[b'audio'][0:nframes, :], label,
+                                      record[b'video']))
                     if len(batch_out) == self.batch_size:
-                        yield batch_out
+                        yield self._make_batch(batch_out)
                         batch_out = []
 
         return reader
 
+    def _columnar_reader(self, fl):
+        stores = [feature_store.FeatureStore(path) for path in fl]
+        # (store, video) of every video
+        store_ids = np.concatenate(
+            [np.full(len(store), i, dtype='int64')
+             for i, store in enumerate(stores)])
+        video_ids = np.concatenate(
+            [np.arange(len(store)) for store in stores])
+        nframes = np.concatenate([store.nframes for store in stores])
+
+        def reader():
+            order = np.arange(len(video_ids))
+            if self.mode == 'train':
+                np.random.shuffle(order)
+            batches = [
+                order[i:i + self.batch_size]
+                for i in range(0, len(order), self.batch_size)
+            ]
+            if self.bucket_batches > 0:
+                window = self.bucket_batches * self.batch_size
+                batches = []
+                for start in range(0, len(order), window):
+                    part = order[start:start + window]
+                    part = part[np.argsort(nframes[part], kind='mergesort')]
+                    batches.extend(part[i:i + self.batch_size]
+                                   for i in range(0, len(part),
+                                                  self.batch_size))
+                if self.mode == 'train':
+                    random.shuffle(batches)
+            for batch in batches:
+                if len(batch) < self.batch_size:
+                    continue
+                samples = []
+                for idx in batch:
+                    store = stores[store_ids[idx]]
+                    video = video_ids[idx]
+                    start = store.frame_offsets[video]
+                    end = store.frame_offsets[video + 1]
+                    label = store.get_labels(
+                        video) if self.mode != 'infer' else None
+                    samples.append((store.rgb[start:end], store.audio[
+                        start:end], label, store.video_ids[video]))
+                yield self._make_batch(samples)
+
+        return reader
+
+    def _make_batch(self, samples):
+        """
+        Turn (rgb, audio, label, video id) samples, with uint8 features,
+        into a batch, dequantizing and expanding the labels of all samples
+        at once.
+        """
+        rgbs, audios, labels, videos = zip(*samples)
+        if self.name == 'ATTENTIONCLUSTER':
+            sample_inds = [
+                generate_random_idx(rgb.shape[0], self.seg_num)
+                for rgb in rgbs
+            ]
+            rgbs = [rgb[inds] for rgb, inds in zip(rgbs, sample_inds)]
+            audios = [audio[inds] for audio, inds in zip(audios, sample_inds)]
+        splits = np.cumsum([rgb.shape[0] for rgb in rgbs])[:-1]
+        rgb = np.concatenate(rgbs).astype('float32')
+        audio = np.concatenate(audios).astype('float32')
+        if self.name != 'NEXTVLAD':
+            rgb = dequantize(
+                rgb, max_quantized_value=2., min_quantized_value=-2.)
+            audio = dequantize(
+                audio, max_quantized_value=2, min_quantized_value=-2)
+        rgbs = np.split(rgb, splits)
+        audios = np.split(audio, splits)
+        if self.mode == 'infer':
+            return list(zip(rgbs, audios, videos))
+        one_hot_labels = make_one_hot_batch(labels, self.num_classes)
+        return list(zip(rgbs, audios, one_hot_labels))
+
 
 def dequantize(feat_vector, max_quantized_value=2., min_quantized_value=-2.):
     """
@@ -124,6 +184,19 @@ def make_one_hot(label, dim=3862):
     return one_hot_label
 
 
+def make_one_hot_batch(labels, dim=3862):
+    """
+    One-hot labels of a batch, labels is a list of the class ids of every
+    sample.
+    """
+    one_hot_labels = np.zeros((len(labels), dim), dtype='float32')
+    rows = np.repeat(np.arange(len(labels)), [len(l) for l in labels])
+    cols = np.concatenate([np.asarray(l, dtype='int64').reshape(-1)
+                           for l in labels]) if len(labels) else []
+    one_hot_labels[rows, cols] = 1
+    return one_hot_labels
+
+
 def generate_random_idx(feature_len, seg_num):
     idxs = []
     stride = float(feature_len) / seg_num
@@ -0,0 +1,86 @@
+#  Copyright (c) 2019 PaddlePaddle Authors. All Rights Reserve.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+"""
+Columnar store of YouTube-8M frame features.
+
+A shard is a directory of .npy columns:
+
+    rgb.npy            (total frames, 1024) uint8 quantized features
+    audio.npy          (total frames, 128) uint8 quantized features
+    frame_offsets.npy  (videos + 1) int64, frames of video i are
+                       [frame_offsets[i], frame_offsets[i + 1])
+    labels.npy         (total labels) int32 class ids
+    label_offsets.npy  (videos + 1) int64, same for the labels
+    video_ids.npy      (videos) video ids
+
+The feature columns are memory mapped, so a reader only touches the frames
+of the videos it reads.
+"""
+
+import os
+import numpy as np
+
+FEATURE_COLUMNS = ['rgb', 'audio']
+
+
+def write_shard(path, records):
+    """
+    Write the records of a YouTube-8M pkl file, dicts of 'video', 'feature',
+    'audio', 'label' and 'nframes', into the shard directory `path`.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    nframes = [int(r['nframes']) for r in records]
+    columns = {
+        'rgb': np.concatenate(
+            [r['feature'][:n] for r, n in zip(records, nframes)]).astype(
+                'uint8'),
+        'audio': np.concatenate(
+            [r['audio'][:n] for r, n in zip(records, nframes)]).astype(
+                'uint8'),
+        'frame_offsets': np.cumsum([0] + nframes).astype('int64'),
+        'labels': np.array(
+            [l for r in records for l in r['label']], dtype='int32'),
+        'label_offsets': np.cumsum(
+            [0] + [len(r['label']) for r in records]).astype('int64'),
+        'video_ids': np.array([
+            v.decode('utf-8') if isinstance(v, bytes) else v
+            for v in (r['video'] for r in records)
+        ]),
+    }
+    for name, column in columns.items():
+        np.save(os.path.join(path, name + '.npy'), column)
+
+
+class FeatureStore(object):
+    """
+    Memory mapped view of a shard written by write_shard.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for name in FEATURE_COLUMNS:
+            setattr(self, name,
+                    np.load(
+                        os.path.join(path, name + '.npy'), mmap_mode='r'))
+        for name in ['frame_offsets', 'labels', 'label_offsets', 'video_ids']:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy')))
+        self.nframes = np.diff(self.frame_offsets)
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def get_labels(self, index):
+        return self.labels[self.label_offsets[index]:self.label_offsets[
+            index + 1]]
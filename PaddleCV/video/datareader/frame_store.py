@@ -0,0 +1,260 @@
+#  Copyright (c) 2019 PaddlePaddle Authors. All Rights Reserve.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+"""
+Packed video frame store.
+
+The frames of many videos are packed into one shard file:
+
+    header   magic, version, encoding, offset of the index
+    frames   one blob per frame, 64-byte aligned, either a JPEG file or
+             a raw RGB uint8 array
+    index    numpy arrays of the video ids, labels, frame counts, frame
+             shapes and the offset and size of every frame
+
+All the frames of a video have the shape recorded for it, which the writer
+checks.
+
+Shards are memory mapped, so reading a clip touches only the pages of its
+sampled frames. A video is addressed by the key `<shard path>#<index>`,
+which the file lists of the readers use in place of a pkl or mp4 path.
+"""
+
+import io
+import mmap
+import struct
+import threading
+import cv2
+import numpy as np
+
+FRAME_STORE_MAGIC = b'PDFRAMES'
+FRAME_STORE_VERSION = 1
+ENCODINGS = ['jpeg', 'raw']
+
+_HEADER = struct.Struct('<8sIIQ')
+_ALIGNMENT = 64
+
+
+def _align(nbytes):
+    return (nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+
+def _jpeg_size(data):
+    """
+    Returns the (height, width) in the SOF segment of a JPEG file without
+    decoding it, or None if it is not found.
+    """
+    pos = 2
+    while pos + 9 <= len(data):
+        prefix, marker = struct.unpack_from('>BB', data, pos)
+        if prefix != 0xFF:
+            return None
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in _SOF_MARKERS:
+            return struct.unpack_from('>HH', data, pos + 5)
+        pos += 2 + struct.unpack_from('>H', data, pos + 2)[0]
+    return None
+
+
+def make_key(path, index):
+    return '{}#{}'.format(path, index)
+
+
+def parse_key(key):
+    path, index = key.rsplit('#', 1)
+    return path, int(index)
+
+
+class FrameStoreWriter(object):
+    """
+    Writes the videos added with `add_video` into one shard file.
+
+    Args:
+        path (str): path of the shard file.
+        encoding (str): 'jpeg' if frames are given as encoded JPEG files,
+            'raw' if they are given as (H, W, 3) RGB uint8 arrays.
+    """
+
+    def __init__(self, path, encoding='jpeg'):
+        assert encoding in ENCODINGS, \
+                "encoding {} not in {}".format(encoding, ENCODINGS)
+        self.path = path
+        self.encoding = encoding
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(FRAME_STORE_MAGIC, FRAME_STORE_VERSION,
+                                      ENCODINGS.index(encoding), 0))
+        self._pos = _align(_HEADER.size)
+        self._vids = []
+        self._labels = []
+        self._shapes = []
+        self._lens = []
+        self._offsets = []
+        self._sizes = []
+
+    def __len__(self):
+        return len(self._vids)
+
+    def add_video(self, vid, label, frames):
+        """
+        Append a video, returns its index in the shard.
+        """
+        if len(frames) < 1:
+            raise ValueError("video {} has no frames".format(vid))
+        if self.encoding == 'jpeg':
+            shape = cv2.imdecode(
+                np.frombuffer(frames[0], dtype='uint8'),
+                cv2.IMREAD_COLOR).shape
+        else:
+            shape = frames[0].shape
+        offsets = []
+        sizes = []
+        pos = self._pos
+        for frame in frames:
+            if self.encoding == 'raw':
+                if frame.shape != shape or frame.dtype != np.uint8:
+                    raise ValueError("raw frames of video {} should be uint8 "
+                                     "and of the same shape".format(vid))
+                frame = np.ascontiguousarray(frame).tobytes()
+            else:
+                size = _jpeg_size(frame)
+                if size is None:
+                    size = cv2.imdecode(
+                        np.frombuffer(frame, dtype='uint8'),
+                        cv2.IMREAD_COLOR).shape[:2]
+                if tuple(size) != shape[:2]:
+                    raise ValueError("frames of video {} should be of the "
+                                     "same shape".format(vid))
+            self._file.seek(pos)
+            self._file.write(frame)
+            offsets.append(pos)
+            sizes.append(len(frame))
+            pos = _align(pos + len(frame))
+        # a video failing halfway is overwritten by the next one
+        self._pos = pos
+        self._offsets.extend(offsets)
+        self._sizes.extend(sizes)
+        self._vids.append(vid)
+        self._labels.append(label)
+        self._shapes.append(shape)
+        self._lens.append(len(frames))
+        return len(self._vids) - 1
+
+    def close(self):
+        self._file.seek(self._pos)
+        for array in [
+                np.array(self._vids, dtype='U'),
+                np.array(self._labels, dtype='int64'),
+                np.array(self._lens, dtype='int64'),
+                np.array(self._shapes, dtype='int64').reshape([-1, 3]),
+                np.array(self._offsets, dtype='int64'),
+                np.array(self._sizes, dtype='int64')
+        ]:
+            np.lib.format.write_array(self._file, array, allow_pickle=False)
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(FRAME_STORE_MAGIC, FRAME_STORE_VERSION,
+                                      ENCODINGS.index(self.encoding),
+                                      self._pos))
+        self._file.close()
+
+
+class FrameStore(object):
+    """
+    Read-only, memory mapped view of a shard written by FrameStoreWriter.
+    Safe to share between threads and forked processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, encoding, index_offset = _HEADER.unpack(
+            self._mm[:_HEADER.size])
+        if magic != FRAME_STORE_MAGIC or version != FRAME_STORE_VERSION:
+            raise ValueError("{} is not a version {} frame store".format(
+                path, FRAME_STORE_VERSION))
+        self.encoding = ENCODINGS[encoding]
+        index = io.BytesIO(self._mm[index_offset:])
+        self.vids, self.labels, self.lens, self.shapes, offsets, sizes = [
+            np.lib.format.read_array(
+                index, allow_pickle=False) for _ in range(6)
+        ]
+        self._starts = np.cumsum(self.lens) - self.lens
+        self._offsets = offsets
+        self._sizes = sizes
+        self._data = np.frombuffer(self._mm, dtype='uint8')
+
+    def __len__(self):
+        return len(self.vids)
+
+    def video_info(self, index):
+        """
+        Returns:
+            tuple of the video id, label and number of frames.
+        """
+        return self.vids[index], int(self.labels[index]), int(self.lens[
+            index])
+
+    def get_frames(self, index, frame_indices):
+        """
+        Read the given frames of a video.
+
+        Returns:
+            (len(frame_indices), H, W, 3) RGB uint8 array.
+        """
+        shape = tuple(self.shapes[index])
+        out = np.empty((len(frame_indices), ) + shape, dtype='uint8')
+        decoded = {}
+        for i, idx in enumerate(frame_indices):
+            if idx not in decoded:
+                decoded[idx] = self._read_frame(self._starts[index] + idx,
+                                                shape)
+            out[i] = decoded[idx]
+        return out
+
+    def _read_frame(self, frame, shape):
+        offset = self._offsets[frame]
+        buf = self._data[offset:offset + self._sizes[frame]]
+        if self.encoding == 'raw':
+            return buf.reshape(shape)
+        img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("cannot decode frame {} of {}".format(frame,
+                                                                   self.path))
+        if img.shape != shape:
+            raise ValueError("frame {} of {} is not of the shape {} of its "
+                             "video".format(frame, self.path, shape))
+        return img[:, :, ::-1]
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_video(key):
+    """
+    Returns the (FrameStore, index) of the video of the given key, shards
+    are opened once per process.
+    """
+    path, index = parse_key(key)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = FrameStore(path)
+            _stores[path] = store
+    return store, index
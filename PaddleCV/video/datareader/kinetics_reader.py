@@ -20,26 +20,31 @@ import random
 import functools
 try:
     import cPickle as pickle
-    from cStringIO import StringIO
 except ImportError:
     import pickle
-    from io import BytesIO
 import numpy as np
 import paddle
-from PIL import Image, ImageEnhance
 import logging
 
 from .reader_utils import DataReader
+from . import frame_store
+from . import clip_transforms
 
 logger = logging.getLogger(__name__)
 python_ver = sys.version_info
 
+# gaps between sampled mp4 frames longer than this are skipped by seeking
+# instead of grabbing every frame in between
+SEEK_MIN_GAP = 64
+
 
 class KineticsReader(DataReader):
     """
-    Data reader for kinetics dataset of two format mp4 and pkl.
+    Data reader for kinetics dataset of three format mp4, pkl and frames.
     1. mp4, the original format of kinetics400
     2. pkl, the mp4 was decoded previously and stored as pkl
+    3. frames, the frames were packed into shards of a frame store,
+       see frame_store.py
     In both case, load the data, and then get the frame data in the form of numpy and label as an integer.
      dataset cfg: format
                   num_classes
@@ -52,6 +57,8 @@ class KineticsReader(DataReader):
                   image_std
                   batch_size
                   list
+                  num_crops, number of crops of each clip when testing,
+                             see clip_transforms.multi_crop
     """
 
     def __init__(self, name, mode, cfg):
@@ -67,6 +74,8 @@ class KineticsReader(DataReader):
         self.num_reader_threads = self.get_config_from_sec(mode, 'num_reader_threads')
         self.buf_size = self.get_config_from_sec(mode, 'buf_size')
         self.enable_ce = self.get_config_from_sec(mode, 'enable_ce')
+        self.num_crops = self.get_config_from_sec(mode, 'num_crops', 1) \
+            if mode != 'train' else 1
 
         self.img_mean = np.array(cfg.MODEL.image_mean).reshape(
             [3, 1, 1]).astype(np.float32)
@@ -92,8 +101,13 @@ class KineticsReader(DataReader):
             for imgs, label in _reader():
                 if imgs is None:
                     continue
-                batch_out.append((imgs, label))
-                if len(batch_out) == self.batch_size:
+                if self.num_crops > 1:
+                    # crops of a video are consecutive samples, batch_size
+                    # counts videos
+                    batch_out.extend((crop, label) for crop in imgs)
+                else:
+                    batch_out.append((imgs, label))
+                if len(batch_out) == self.batch_size * self.num_crops:
                     yield batch_out
                     batch_out = []
 
@@ -147,6 +161,7 @@ class KineticsReader(DataReader):
                     logger.error('{} frame length {} less than 1.'.format(pickle_path,
                                                                           len(frames)))
                     return None, None
+                imgs = video_loader(frames, seg_num, seglen, mode)
             except:
                 logger.info('Error when loading {}'.format(pickle_path))
                 return None, None
@@ -156,33 +171,50 @@ class KineticsReader(DataReader):
             elif mode == 'infer':
                 ret_label = vid
 
-            imgs = video_loader(frames, seg_num, seglen, mode)
             return imgs_transform(imgs, ret_label, mode, seg_num, seglen, \
                          short_size, target_size, img_mean, img_std)
 
 
+        def decode_frames(sample, mode, seg_num, seglen, short_size,
+                          target_size, img_mean, img_std):
+            sample = sample[0].split(' ')
+            key = sample[0]
+            try:
+                store, index = frame_store.open_video(key)
+                vid, label, videolen = store.video_info(index)
+                indices = get_frame_indices(videolen, seg_num, seglen, mode)
+                frames = store.get_frames(index, indices)
+            except:
+                logger.error('Error when loading {}'.format(key))
+                return None, None
+
+            if mode == 'infer':
+                label = vid
+
+            return imgs_transform(frames, label, mode, seg_num, seglen, \
+                         short_size, target_size, img_mean, img_std)
+
+
         def imgs_transform(imgs, label, mode, seg_num, seglen, short_size, target_size,
                            img_mean, img_std):
-            imgs = group_scale(imgs, short_size)
+            # imgs is a (seg_num * seglen, H, W, 3) RGB uint8 clip
+            imgs = clip_transforms.scale(imgs, short_size)
 
             if mode == 'train':
                 if self.name == "TSM":
-                    imgs = group_multi_scale_crop(imgs, short_size)
-                imgs = group_random_crop(imgs, target_size)
-                imgs = group_random_flip(imgs)
+                    imgs = clip_transforms.multi_scale_crop(imgs, short_size)
+                imgs = clip_transforms.random_crop(imgs, target_size)
+                imgs = clip_transforms.random_flip(imgs)
+            elif self.num_crops > 1:
+                imgs = clip_transforms.multi_crop(imgs, target_size,
+                                                  self.num_crops)
             else:
-                imgs = group_center_crop(imgs, target_size)
-
-            np_imgs = (np.array(imgs[0]).astype('float32').transpose(
-                (2, 0, 1))).reshape(1, 3, target_size, target_size) / 255
-            for i in range(len(imgs) - 1):
-                img = (np.array(imgs[i + 1]).astype('float32').transpose(
-                    (2, 0, 1))).reshape(1, 3, target_size, target_size) / 255
-                np_imgs = np.concatenate((np_imgs, img))
-            imgs = np_imgs
-            imgs -= img_mean
-            imgs /= img_std
-            imgs = np.reshape(imgs, (seg_num, seglen * 3, target_size, target_size))
+                imgs = clip_transforms.center_crop(imgs, target_size)
+
+            imgs = clip_transforms.normalize(imgs, img_mean, img_std)
+            # multi-crop clips keep the leading crop axis
+            imgs = np.reshape(imgs, imgs.shape[:-4] + \
+                    (seg_num, seglen * 3, target_size, target_size))
 
             return imgs, label
 
@@ -200,6 +232,8 @@ class KineticsReader(DataReader):
             decode_func = decode_pickle
         elif format == 'mp4':
             decode_func = decode_mp4
+        elif format == 'frames':
+            decode_func = decode_frames
         else:
             raise "Not implemented format {}".format(format)
 
@@ -216,147 +250,27 @@ class KineticsReader(DataReader):
         return paddle.reader.xmap_readers(mapper, reader, num_threads, buf_size)
 
 
-def group_multi_scale_crop(img_group, target_size, scales=None, \
-        max_distort=1, fix_crop=True, more_fix_crop=True):
-    scales = scales if scales is not None else [1, .875, .75, .66]
-    input_size = [target_size, target_size]
-
-    im_size = img_group[0].size
-
-    # get random crop offset
-    def _sample_crop_size(im_size):
-        image_w, image_h = im_size[0], im_size[1]
-
-        base_size = min(image_w, image_h)
-        crop_sizes = [int(base_size * x) for x in scales]
-        crop_h = [input_size[1] if abs(x - input_size[1]) < 3 else x for x in crop_sizes]
-        crop_w = [input_size[0] if abs(x - input_size[0]) < 3 else x for x in crop_sizes]
-
-        pairs = []
-        for i, h in enumerate(crop_h):
-            for j, w in enumerate(crop_w):
-                if abs(i - j) <= max_distort:
-                    pairs.append((w, h))
-
-        crop_pair = random.choice(pairs)
-        if not fix_crop:
-            w_offset = random.randint(0, image_w - crop_pair[0])
-            h_offset = random.randint(0, image_h - crop_pair[1])
-        else:
-            w_step = (image_w - crop_pair[0]) / 4
-            h_step = (image_h - crop_pair[1]) / 4
-
-            ret = list()
-            ret.append((0, 0))  # upper left
-            if w_step != 0:
-                ret.append((4 * w_step, 0))  # upper right
-            if h_step != 0:
-                ret.append((0, 4 * h_step))  # lower left
-            if h_step != 0 and w_step != 0:
-                ret.append((4 * w_step, 4 * h_step))  # lower right
-            if h_step != 0 or w_step != 0:
-                ret.append((2 * w_step, 2 * h_step))  # center
-
-            if more_fix_crop:
-                ret.append((0, 2 * h_step))  # center left
-                ret.append((4 * w_step, 2 * h_step))  # center right
-                ret.append((2 * w_step, 4 * h_step))  # lower center
-                ret.append((2 * w_step, 0 * h_step))  # upper center
-
-                ret.append((1 * w_step, 1 * h_step))  # upper left quarter
-                ret.append((3 * w_step, 1 * h_step))  # upper right quarter
-                ret.append((1 * w_step, 3 * h_step))  # lower left quarter
-                ret.append((3 * w_step, 3 * h_step))  # lower righ quarter
-
-            w_offset, h_offset = random.choice(ret)
-
-        return crop_pair[0], crop_pair[1], w_offset, h_offset
-
-    crop_w, crop_h, offset_w, offset_h = _sample_crop_size(im_size)
-    crop_img_group = [img.crop((offset_w, offset_h, offset_w + crop_w, offset_h + crop_h)) for img in img_group]
-    ret_img_group = [img.resize((input_size[0], input_size[1]), Image.BILINEAR) for img in crop_img_group]
-
-    return ret_img_group
-
-
-def group_random_crop(img_group, target_size):
-    w, h = img_group[0].size
-    th, tw = target_size, target_size
-
-    assert (w >= target_size) and (h >= target_size), \
-          "image width({}) and height({}) should be larger than crop size".format(w, h, target_size)
-
-    out_images = []
-    x1 = random.randint(0, w - tw)
-    y1 = random.randint(0, h - th)
-
-    for img in img_group:
-        if w == tw and h == th:
-            out_images.append(img)
-        else:
-            out_images.append(img.crop((x1, y1, x1 + tw, y1 + th)))
-
-    return out_images
-
-
-def group_random_flip(img_group):
-    v = random.random()
-    if v < 0.5:
-        ret = [img.transpose(Image.FLIP_LEFT_RIGHT) for img in img_group]
-        return ret
-    else:
-        return img_group
-
-
-def group_center_crop(img_group, target_size):
-    img_crop = []
-    for img in img_group:
-        w, h = img.size
-        th, tw = target_size, target_size
-        assert (w >= target_size) and (h >= target_size), \
-             "image width({}) and height({}) should be larger than crop size".format(w, h, target_size)
-        x1 = int(round((w - tw) / 2.))
-        y1 = int(round((h - th) / 2.))
-        img_crop.append(img.crop((x1, y1, x1 + tw, y1 + th)))
-
-    return img_crop
-
-
-def group_scale(imgs, target_size):
-    resized_imgs = []
-    for i in range(len(imgs)):
-        img = imgs[i]
-        w, h = img.size
-        if (w <= h and w == target_size) or (h <= w and h == target_size):
-            resized_imgs.append(img)
-            continue
-
-        if w < h:
-            ow = target_size
-            oh = int(target_size * 4.0 / 3.0)
-            resized_imgs.append(img.resize((ow, oh), Image.BILINEAR))
-        else:
-            oh = target_size
-            ow = int(target_size * 4.0 / 3.0)
-            resized_imgs.append(img.resize((ow, oh), Image.BILINEAR))
-
-    return resized_imgs
-
-
 def imageloader(buf):
-    if isinstance(buf, str):
-        img = Image.open(StringIO(buf))
-    else:
-        img = Image.open(BytesIO(buf))
-
-    return img.convert('RGB')
+    img = cv2.imdecode(np.frombuffer(buf, dtype='uint8'), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("cannot decode frame")
+    return img[:, :, ::-1]
 
 
 def video_loader(frames, nsample, seglen, mode):
-    videolen = len(frames)
-    average_dur = int(videolen / nsample)
+    indices = get_frame_indices(len(frames), nsample, seglen, mode)
+    return np.stack([imageloader(frames[idx]) for idx in indices])
+
 
-    imgs = []
+def get_frame_indices(videolen, nsample, seglen, mode, center_segment=True):
+    """
+    Indices of the `nsample * seglen` frames sampled from a video of
+    `videolen` frames, in sampling order. When not training, the frames are
+    taken from the middle of each segment if `center_segment`, else they
+    start at its middle frame, as the mp4 loader always did.
+    """
+    average_dur = int(videolen / nsample)
+    indices = []
     for i in range(nsample):
         idx = 0
         if mode == 'train':
@@ -369,7 +283,10 @@ def video_loader(frames, nsample, seglen, mode):
                 idx = i
         else:
             if average_dur >= seglen:
-                idx = (average_dur - seglen) // 2
+                if center_segment:
+                    idx = (average_dur - seglen) // 2
+                else:
+                    idx = (average_dur - 1) // 2
                 idx += i * average_dur
             elif average_dur >= 1:
                 idx += i * average_dur
@@ -377,14 +294,39 @@ def video_loader(frames, nsample, seglen, mode):
                 idx = i
 
         for jj in range(idx, idx + seglen):
-            imgbuf = frames[int(jj % videolen)]
-            img = imageloader(imgbuf)
-            imgs.append(img)
+            indices.append(int(jj % videolen))
 
-    return imgs
+    return indices
 
 
-def mp4_loader(filepath, nsample, seglen, mode):
+def read_mp4_frames(cap, indices):
+    """
+    Decode only the frames in `indices` from an opened capture. Short gaps
+    are skipped with grab(), which does not convert the skipped frames, and
+    long ones with a seek. Returns a dict of index to RGB frame, or None if
+    a frame could not be read, e.g. when the container reports a wrong
+    frame count.
+    """
+    frames = {}
+    pos = 0
+    for idx in sorted(set(indices)):
+        if idx - pos > SEEK_MIN_GAP:
+            if not cap.set(cv2.CAP_PROP_POS_FRAMES, idx):
+                return None
+            pos = idx
+        while pos < idx:
+            if not cap.grab():
+                return None
+            pos += 1
+        ret, frame = cap.read()
+        if not ret:
+            return None
+        pos += 1
+        frames[idx] = frame[:, :, ::-1]
+    return frames
+
+
+def read_all_mp4_frames(filepath):
     cap = cv2.VideoCapture(filepath)
     videolen = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     sampledFrames = []
@@ -395,30 +337,27 @@ def mp4_loader(filepath, nsample, seglen, mode):
             continue
         img = frame[:, :, ::-1]
         sampledFrames.append(img)
-    average_dur = int(len(sampledFrames) / nsample)
-    imgs = []
-    for i in range(nsample):
-        idx = 0
-        if mode == 'train':
-            if average_dur >= seglen:
-                idx = random.randint(0, average_dur - seglen)
-                idx += i * average_dur
-            elif average_dur >= 1:
-                idx += i * average_dur
-            else:
-                idx = i
-        else:
-            if average_dur >= seglen:
-                idx = (average_dur - 1) // 2
-                idx += i * average_dur
-            elif average_dur >= 1:
-                idx += i * average_dur
-            else:
-                idx = i
+    cap.release()
+    return sampledFrames
 
-        for jj in range(idx, idx + seglen):
-            imgbuf = sampledFrames[int(jj % len(sampledFrames))]
-            img = Image.fromarray(imgbuf, mode='RGB')
-            imgs.append(img)
 
-    return imgs
+def mp4_loader(filepath, nsample, seglen, mode):
+    cap = cv2.VideoCapture(filepath)
+    videolen = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = None
+    if videolen > 0:
+        indices = get_frame_indices(
+            videolen, nsample, seglen, mode, center_segment=False)
+        frames = read_mp4_frames(cap, indices)
+    cap.release()
+
+    if frames is None:
+        # the frame count is missing or wrong, decode the whole video
+        sampledFrames = read_all_mp4_frames(filepath)
+        if len(sampledFrames) < 1:
+            return []
+        indices = get_frame_indices(
+            len(sampledFrames), nsample, seglen, mode, center_segment=False)
+        frames = sampledFrames
+
+    return np.stack([frames[idx] for idx in indices])
@@ -21,6 +21,7 @@ import cv2
 import logging
 
 from .reader_utils import DataReader
+from . import frame_store
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +42,8 @@ class NonlocalReader(DataReader):
                 jitter_scales
                 Test only cfg: num_test_clips
                                use_multi_crop
+          MODEL cfg:    format, 'mp4' (default) or 'frames' if the file
+                        list holds the keys of a frame store
     """
 
     def __init__(self, name, mode, cfg):
@@ -68,6 +71,7 @@ class NonlocalReader(DataReader):
         dataset_args['min_size'] = cfg[mode.upper()]['jitter_scales'][0]
         dataset_args['max_size'] = cfg[mode.upper()]['jitter_scales'][1]
         dataset_args['num_reader_threads'] = num_reader_threads
+        dataset_args['format'] = cfg.MODEL.get('format', 'mp4')
         filelist = cfg[mode.upper()]['filelist']
         batch_size = cfg[mode.upper()]['batch_size']
 
@@ -92,6 +96,16 @@ class NonlocalReader(DataReader):
             raise NotImplementedError
 
 
+def get_start_frame(frame_cnt, sampling_rate, length, start_frm,
+                    sample_times):
+    if start_frm < 0:
+        if (frame_cnt - length * sampling_rate > 0):
+            return random.randint(0, frame_cnt - length * sampling_rate)
+        return 0
+    frame_gaps = float(frame_cnt) / float(sample_times)
+    return int(frame_gaps * start_frm) % frame_cnt
+
+
 def video_fast_get_frame(video_path,
                          sampling_rate=1,
                          length=64,
@@ -106,16 +120,8 @@ def video_fast_get_frame(video_path,
 
     video_output = np.ndarray(shape=[length, height, width, 3], dtype=np.uint8)
 
-    use_start_frm = start_frm
-    if start_frm < 0:
-        if (frame_cnt - length * sampling_rate > 0):
-            use_start_frm = random.randint(0,
-                                           frame_cnt - length * sampling_rate)
-        else:
-            use_start_frm = 0
-    else:
-        frame_gaps = float(frame_cnt) / float(sample_times)
-        use_start_frm = int(frame_gaps * start_frm) % frame_cnt
+    use_start_frm = get_start_frame(frame_cnt, sampling_rate, length,
+                                    start_frm, sample_times)
 
     for i in range(frame_cnt):
         ret, frame = cap.read()
@@ -134,6 +140,22 @@ def video_fast_get_frame(video_path,
     return video_output
 
 
+def video_store_get_frame(key,
+                          sampling_rate=1,
+                          length=64,
+                          start_frm=-1,
+                          sample_times=1):
+    """same as video_fast_get_frame, reading only the sampled frames of a
+    video in a frame store"""
+    store, index = frame_store.open_video(key)
+    _, _, frame_cnt = store.video_info(index)
+    use_start_frm = get_start_frame(frame_cnt, sampling_rate, length,
+                                    start_frm, sample_times)
+    indices = [(use_start_frm + idx * sampling_rate) % frame_cnt
+               for idx in range(length)]
+    return store.get_frames(index, indices)
+
+
 def apply_resize(rgbdata, min_size, max_size):
     length, height, width, channel = rgbdata.shape
     ratio = 1.0
@@ -197,6 +219,9 @@ def crop_mirror_transform(rgbdata,
 
 def make_reader(filelist, batch_size, sample_times, is_training, shuffle,
                 **dataset_args):
+    get_frame = video_store_get_frame if dataset_args['format'] == 'frames' \
+            else video_fast_get_frame
+
     def reader():
         fl = open(filelist).readlines()
         fl = [line.strip() for line in fl if line.strip() != '']
@@ -221,7 +246,7 @@ def make_reader(filelist, batch_size, sample_times, is_training, shuffle,
             label = np.array([label]).astype(np.int64)
             # 1, get rgb data for fixed length of frames
             try:
-                rgbdata = video_fast_get_frame(fn, \
+                rgbdata = get_frame(fn, \
                              sampling_rate = dataset_args['sample_rate'], length = dataset_args['video_length'], \
                              start_frm = start_frm, sample_times = in_sample_times)
             except:
@@ -252,6 +277,9 @@ def make_reader(filelist, batch_size, sample_times, is_training, shuffle,
 
 def make_multi_reader(filelist, batch_size, sample_times, is_training, shuffle,
                       **dataset_args):
+    get_frame = video_store_get_frame if dataset_args['format'] == 'frames' \
+            else video_fast_get_frame
+
     def read_into_queue(flq, queue):
         batch_out = []
         for line in flq:
@@ -269,7 +297,7 @@ def make_multi_reader(filelist, batch_size, sample_times, is_training, shuffle,
             label = np.array([label]).astype(np.int64)
             # 1, get rgb data for fixed length of frames
             try:
-                rgbdata = video_fast_get_frame(fn, \
+                rgbdata = get_frame(fn, \
                              sampling_rate = dataset_args['sample_rate'], length = dataset_args['video_length'], \
                              start_frm = start_frm, sample_times = in_sample_times)
             except:
@@ -0,0 +1,148 @@
+#  Copyright (c) 2019 PaddlePaddle Authors. All Rights Reserve.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import os
+import sys
+import argparse
+import functools
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+# import the module alone, without the paddle readers of the package
+sys.path.insert(0,
+                os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    '../../datareader'))
+from frame_store import FrameStoreWriter, make_key
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# example command line:
+#   python video2frames.py --filelist=train.list --input_format=pkl \
+#       --output_dir=data_k400/train_frames --num_workers=8
+#
+# converts the videos of a file list of the pkl format (one pkl path per
+# line) or of the mp4 format (mp4 path and label per line) into shards of a
+# frame store, and writes the file list of the frames format to
+# <output_dir>/frames.list, with the video key and label per line.
+
+parser = argparse.ArgumentParser(
+    description='Pack the frames of a video file list into a frame store.')
+parser.add_argument('--filelist', type=str, required=True)
+parser.add_argument(
+    '--input_format', type=str, default='pkl', choices=['pkl', 'mp4'])
+parser.add_argument('--output_dir', type=str, required=True)
+parser.add_argument(
+    '--shard_size', type=int, default=1000, help='videos per shard')
+parser.add_argument(
+    '--encoding',
+    type=str,
+    default='jpeg',
+    choices=['jpeg', 'raw'],
+    help='raw frames take much more space but are not decoded when read')
+parser.add_argument(
+    '--jpeg_quality',
+    type=int,
+    default=95,
+    help='JPEG quality of the frames decoded from mp4')
+parser.add_argument('--num_workers', type=int, default=8)
+
+
+def load_pkl(line, encoding, jpeg_quality):
+    path = line.split(' ')[0]
+    with open(path, 'rb') as f:
+        if sys.version_info < (3, 0):
+            vid, label, frames = pickle.load(f)
+        else:
+            vid, label, frames = pickle.load(f, encoding='bytes')
+    if isinstance(vid, bytes):
+        vid = vid.decode('utf-8')
+    if encoding == 'raw':
+        frames = [
+            cv2.imdecode(
+                np.frombuffer(
+                    frame, dtype='uint8'), cv2.IMREAD_COLOR)[:, :, ::-1]
+            for frame in frames
+        ]
+    return vid, label, frames
+
+
+def load_mp4(line, encoding, jpeg_quality):
+    items = line.split(' ')
+    path, label = items[0], int(items[1])
+    vid = os.path.splitext(os.path.basename(path))[0]
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if encoding == 'raw':
+            frames.append(frame[:, :, ::-1])
+        else:
+            frames.append(
+                cv2.imencode('.jpg', frame,
+                             [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1]
+                .tobytes())
+    cap.release()
+    return vid, label, frames
+
+
+def write_shard(task, load_func, output_dir, encoding, jpeg_quality):
+    shard_id, lines = task
+    path = os.path.join(output_dir, 'part-%05d.frames' % shard_id)
+    writer = FrameStoreWriter(path, encoding)
+    entries = []
+    for line in lines:
+        try:
+            vid, label, frames = load_func(line, encoding, jpeg_quality)
+            index = writer.add_video(vid, label, frames)
+        except Exception as e:
+            print("Skip {}: {}".format(line, e))
+            continue
+        # absolute keys resolve from any working directory
+        entries.append('{} {}'.format(
+            make_key(os.path.abspath(path), index), label))
+    writer.close()
+    return entries
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with open(args.filelist) as f:
+        lines = [line.strip() for line in f if line.strip() != '']
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    tasks = [(i, lines[start:start + args.shard_size])
+             for i, start in enumerate(range(0, len(lines), args.shard_size))]
+    load_func = load_pkl if args.input_format == 'pkl' else load_mp4
+    mapper = functools.partial(
+        write_shard,
+        load_func=load_func,
+        output_dir=args.output_dir,
+        encoding=args.encoding,
+        jpeg_quality=args.jpeg_quality)
+
+    pool = Pool(processes=args.num_workers)
+    with open(os.path.join(args.output_dir, 'frames.list'), 'w') as f:
+        for entries in pool.imap(mapper, tasks):
+            for entry in entries:
+                f.write(entry + '\n')
+    pool.close()
+    pool.join()
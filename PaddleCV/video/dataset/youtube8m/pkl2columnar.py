@@ -0,0 +1,81 @@
+#  Copyright (c) 2019 PaddlePaddle Authors. All Rights Reserve.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import os
+import sys
+import argparse
+import functools
+from multiprocessing import Pool
+
+# import the module alone, without the paddle readers of the package
+sys.path.insert(0,
+                os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    '../../datareader'))
+from feature_store import write_shard
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# example command line:
+#   python pkl2columnar.py --filelist=train.list --output_dir=columnar/train
+#
+# converts every pkl file of the file list into a shard directory of a
+# columnar feature store, and writes the file list of the shards to
+# <output_dir>/columnar.list.
+
+parser = argparse.ArgumentParser(
+    description='Convert YouTube-8M pkl files into a columnar feature store.')
+parser.add_argument('--filelist', type=str, required=True)
+parser.add_argument('--output_dir', type=str, required=True)
+parser.add_argument('--num_workers', type=int, default=8)
+
+
+def convert(task, output_dir):
+    shard_id, filepath = task
+    with open(filepath, 'rb') as f:
+        if sys.version_info < (3, 0):
+            data = pickle.load(f)
+        else:
+            data = pickle.load(f, encoding='bytes')
+    # keys are bytes when pickled by python 2
+    records = [
+        dict((k.decode('utf-8') if isinstance(k, bytes) else k, v)
+             for k, v in record.items()) for record in data
+    ]
+    if len(records) == 0:
+        print("Skip {}: no videos".format(filepath))
+        return None
+    path = os.path.join(output_dir, 'part-%05d' % shard_id)
+    write_shard(path, records)
+    return path
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with open(args.filelist) as f:
+        lines = [line.strip() for line in f if line.strip() != '']
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    mapper = functools.partial(convert, output_dir=args.output_dir)
+
+    pool = Pool(processes=args.num_workers)
+    with open(os.path.join(args.output_dir, 'columnar.list'), 'w') as f:
+        for path in pool.imap(mapper, enumerate(lines)):
+            if path is not None:
+                f.write(os.path.abspath(path) + '\n')
+    pool.close()
+    pool.join()
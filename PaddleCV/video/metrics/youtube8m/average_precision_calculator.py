@@ -42,21 +42,129 @@ a1 = np.array([random.choice([0, 1]) for _ in xrange(5)])
 p2 = np.array([random.random() for _ in xrange(5)])
 a2 = np.array([random.choice([0, 1]) for _ in xrange(5)])
 
-# interpolated average precision at 10 using 1000 break points
 calculator = average_precision_calculator.AveragePrecisionCalculator(10)
 calculator.accumulate(p1, a1)
 calculator.accumulate(p2, a2)
 ap3 = calculator.peek_ap_at_n()
 ```
+
+Calculators keep their scores in numpy arrays, so parts of the list can be
+accumulated by calculators in different processes and combined with merge.
 """
 
-import heapq
-import random
 import numbers
 
 import numpy
 
 
+class ScoreBuffer(object):
+    """Growable arrays of (group, prediction, actual) triplets.
+
+  Groups are the classes of a mean average precision, or a single group
+  for an average precision. Predictions are kept as float32, actuals as
+  whether they are positive.
+  """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.groups = numpy.empty(capacity, dtype='int32')
+        self.predictions = numpy.empty(capacity, dtype='float32')
+        self.actuals = numpy.empty(capacity, dtype='bool')
+
+    def append(self, groups, predictions, actuals):
+        end = self.size + len(predictions)
+        if end > len(self.predictions):
+            capacity = max(end, 2 * len(self.predictions))
+            for name in ['groups', 'predictions', 'actuals']:
+                array = getattr(self, name)
+                grown = numpy.empty(capacity, dtype=array.dtype)
+                grown[:self.size] = array[:self.size]
+                setattr(self, name, grown)
+        self.groups[self.size:end] = groups
+        self.predictions[self.size:end] = predictions
+        self.actuals[self.size:end] = numpy.asarray(actuals) > 0
+        self.size = end
+
+    def view(self):
+        return (self.groups[:self.size], self.predictions[:self.size],
+                self.actuals[:self.size])
+
+    def keep_top_n(self, n):
+        """Drop all but the n highest predictions of each group."""
+        groups, predictions, actuals = self.view()
+        order = numpy.lexsort((-predictions, groups))
+        keep = numpy.sort(order[_rank_in_group(groups[order]) < n])
+        self.size = 0
+        self.append(groups[keep], predictions[keep], actuals[keep])
+
+    def clear(self):
+        self.size = 0
+
+
+def _rank_in_group(sorted_groups):
+    """0-based position of every element within its run of equal groups."""
+    index = numpy.arange(len(sorted_groups))
+    if len(sorted_groups) == 0:
+        return index
+    starts = numpy.concatenate(
+        [[True], sorted_groups[1:] != sorted_groups[:-1]])
+    return index - numpy.maximum.accumulate(numpy.where(starts, index, 0))
+
+
+def average_precision_at_n(groups,
+                           predictions,
+                           actuals,
+                           num_groups,
+                           total_num_positives=None,
+                           n=None):
+    """Calculate the non-interpolated average precision of every group at once.
+
+  Args:
+    groups: a numpy 1-D int array of the group of every prediction.
+    predictions: a numpy 1-D array storing the sparse prediction scores.
+    actuals: a numpy 1-D array storing the ground truth labels. Any value
+    larger than 0 will be treated as positives, otherwise as negatives.
+    num_groups: the number of groups.
+    total_num_positives: (optionally) a numpy 1-D array of the number of
+    total positives of every group. If not specified, the positives in
+    actuals are counted.
+    n: the top n items of every group to be considered in ap@n.
+
+  Returns:
+    A numpy 1-D array of the average precision at n of every group, 0 for
+    groups without positives.
+  """
+    groups = numpy.asarray(groups)
+    predictions = numpy.asarray(predictions)
+    actuals = numpy.asarray(actuals) > 0
+    if total_num_positives is None:
+        numpos = numpy.bincount(
+            groups[actuals], minlength=num_groups).astype('float64')
+    else:
+        numpos = numpy.asarray(total_num_positives, dtype='float64')
+    if n is not None:
+        numpos = numpy.minimum(numpos, n)
+
+    # shuffle before the stable sort so that ties are ranked randomly,
+    # to avoid overestimating the ap
+    shuffle = numpy.random.RandomState(0).permutation(len(predictions))
+    order = shuffle[numpy.lexsort((-predictions[shuffle], groups[shuffle]))]
+    groups = groups[order]
+    actuals = actuals[order]
+
+    rank = _rank_in_group(groups) + 1
+    # positives ranked so far, counted within every group
+    poscount = numpy.cumsum(actuals)
+    starts = numpy.flatnonzero(rank == 1)
+    before = (poscount - actuals)[starts]
+    poscount = poscount - numpy.repeat(
+        before, numpy.diff(numpy.append(starts, len(rank))))
+    hits = actuals if n is None else actuals & (rank <= n)
+    precision = numpy.where(hits, poscount / rank.astype('float64'), 0.0)
+    ap = numpy.bincount(groups, weights=precision, minlength=num_groups)
+    return numpy.where(numpos > 0, ap / numpy.maximum(numpos, 1), 0.0)
+
+
 class AveragePrecisionCalculator(object):
     """Calculate the average precision and average precision at n."""
 
@@ -77,12 +185,12 @@ class AveragePrecisionCalculator(object):
 
         self._top_n = top_n  # average precision at n
         self._total_positives = 0  # total number of positives have seen
-        self._heap = []  # max heap of (prediction, actual)
+        self._scores = ScoreBuffer()
 
     @property
     def heap_size(self):
-        """Gets the heap size maintained in the class."""
-        return len(self._heap)
+        """Gets the number of predictions maintained in the class."""
+        return self._scores.size
 
     @property
     def num_accumulated_positives(self):
@@ -119,24 +227,27 @@ class AveragePrecisionCalculator(object):
                     "'num_positives' was provided but it wan't a nonzero number."
                 )
 
+        actuals = numpy.asarray(actuals)
         if not num_positives is None:
             self._total_positives += num_positives
         else:
             self._total_positives += numpy.size(numpy.where(actuals > 0))
-        topk = self._top_n
-        heap = self._heap
 
-        for i in range(numpy.size(predictions)):
-            if topk is None or len(heap) < topk:
-                heapq.heappush(heap, (predictions[i], actuals[i]))
-            else:
-                if predictions[i] > heap[0][0]:  # heap[0] is the smallest
-                    heapq.heappop(heap)
-                    heapq.heappush(heap, (predictions[i], actuals[i]))
+        self._scores.append(0, predictions, actuals)
+        # only the top n can count, prune them in batches
+        if self._top_n is not None and self._scores.size > 2 * max(
+                self._top_n, 512):
+            self._scores.keep_top_n(self._top_n)
+
+    def merge(self, other):
+        """Add the predictions accumulated by another calculator, e.g. one
+    evaluating another shard of the data."""
+        self._total_positives += other._total_positives
+        self._scores.append(*other._scores.view())
 
     def clear(self):
         """Clear the accumulated predictions."""
-        self._heap = []
+        self._scores.clear()
         self._total_positives = 0
 
     def peek_ap_at_n(self):
@@ -149,14 +260,15 @@ class AveragePrecisionCalculator(object):
     """
         if self.heap_size <= 0:
             return 0
-        predlists = numpy.array(list(zip(*self._heap)))
-
-        ap = self.ap_at_n(
-            predlists[0],
-            predlists[1],
-            n=self._top_n,
-            total_num_positives=self._total_positives)
-        return ap
+        groups, predictions, actuals = self._scores.view()
+        return float(
+            average_precision_at_n(
+                groups,
+                predictions,
+                actuals,
+                1,
+                total_num_positives=[self._total_positives],
+                n=self._top_n)[0])
 
     @staticmethod
     def ap(predictions, actuals):
@@ -211,47 +323,16 @@ class AveragePrecisionCalculator(object):
                 raise ValueError("n must be 'None' or a positive integer."
                                  " It was '%s'." % n)
 
-        ap = 0.0
-
-        predictions = numpy.array(predictions)
-        actuals = numpy.array(actuals)
-
-        # add a shuffler to avoid overestimating the ap
-        predictions, actuals = AveragePrecisionCalculator._shuffle(predictions,
-                                                                   actuals)
-        sortidx = sorted(
-            range(len(predictions)), key=lambda k: predictions[k], reverse=True)
-
-        if total_num_positives is None:
-            numpos = numpy.size(numpy.where(actuals > 0))
-        else:
-            numpos = total_num_positives
-
-        if numpos == 0:
-            return 0
-
-        if n is not None:
-            numpos = min(numpos, n)
-        delta_recall = 1.0 / numpos
-        poscount = 0.0
-
-        # calculate the ap
-        r = len(sortidx)
-        if n is not None:
-            r = min(r, n)
-        for i in range(r):
-            if actuals[sortidx[i]] > 0:
-                poscount += 1
-                ap += poscount / (i + 1) * delta_recall
-        return ap
-
-    @staticmethod
-    def _shuffle(predictions, actuals):
-        random.seed(0)
-        suffidx = random.sample(range(len(predictions)), len(predictions))
-        predictions = predictions[suffidx]
-        actuals = actuals[suffidx]
-        return predictions, actuals
+        if total_num_positives is not None:
+            total_num_positives = [total_num_positives]
+        return float(
+            average_precision_at_n(
+                numpy.zeros(len(predictions), dtype='int32'),
+                numpy.asarray(predictions),
+                numpy.asarray(actuals),
+                1,
+                total_num_positives=total_num_positives,
+                n=n)[0])
 
     @staticmethod
     def _zero_one_normalize(predictions, epsilon=1e-7):
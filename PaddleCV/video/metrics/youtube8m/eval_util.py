@@ -53,20 +53,17 @@ def calculate_precision_at_equal_recall_rate(predictions, actuals):
   Returns:
     float: The average precision at equal recall rate across the entire batch.
   """
-    aggregated_precision = 0.0
-    num_videos = actuals.shape[0]
-    for row in numpy.arange(num_videos):
-        num_labels = int(numpy.sum(actuals[row]))
-        top_indices = numpy.argpartition(predictions[row],
-                                         -num_labels)[-num_labels:]
-        item_precision = 0.0
-        for label_index in top_indices:
-            if predictions[row][label_index] > 0:
-                item_precision += actuals[row][label_index]
-        item_precision /= top_indices.size
-        aggregated_precision += item_precision
-    aggregated_precision /= num_videos
-    return aggregated_precision
+    num_videos, num_classes = actuals.shape
+    num_labels = numpy.sum(actuals, axis=1).astype('int64')
+    rows = numpy.arange(num_videos)[:, None]
+    ranked = numpy.argsort(-predictions, axis=1)
+    # the num_labels top predictions of every video, a video without labels
+    # has a precision of 0
+    top = numpy.arange(num_classes)[None, :] < num_labels[:, None]
+    hits = top & (predictions[rows, ranked] > 0)
+    item_precision = numpy.sum(
+        actuals[rows, ranked] * hits, axis=1) / numpy.maximum(num_labels, 1)
+    return numpy.average(item_precision)
 
 
 def calculate_gap(predictions, actuals, top_k=20):
@@ -85,10 +82,10 @@ def calculate_gap(predictions, actuals, top_k=20):
     float: The global average precision.
   """
     gap_calculator = ap_calculator.AveragePrecisionCalculator()
-    sparse_predictions, sparse_labels, num_positives = top_k_by_class(
-        predictions, actuals, top_k)
-    gap_calculator.accumulate(
-        flatten(sparse_predictions), flatten(sparse_labels), sum(num_positives))
+    _, sparse_predictions, sparse_labels = top_k_sparse(predictions, actuals,
+                                                        top_k)
+    gap_calculator.accumulate(sparse_predictions, sparse_labels,
+                              numpy.sum(actuals))
     return gap_calculator.peek_ap_at_n()
 
 
@@ -112,24 +109,49 @@ def top_k_by_class(predictions, labels, k=20):
   Raises:
     ValueError: An error occurred when the k is not a positive integer.
   """
-    if k <= 0:
-        raise ValueError("k must be a positive integer.")
-    k = min(k, predictions.shape[1])
     num_classes = predictions.shape[1]
-    prediction_triplets = []
-    for video_index in range(predictions.shape[0]):
-        prediction_triplets.extend(
-            top_k_triplets(predictions[video_index], labels[video_index], k))
-    out_predictions = [[] for v in range(num_classes)]
-    out_labels = [[] for v in range(num_classes)]
-    for triplet in prediction_triplets:
-        out_predictions[triplet[0]].append(triplet[1])
-        out_labels[triplet[0]].append(triplet[2])
-    out_true_positives = [numpy.sum(labels[:, i]) for i in range(num_classes)]
+    class_ids, sparse_predictions, sparse_labels = top_k_sparse(predictions,
+                                                                labels, k)
+    order = numpy.argsort(class_ids, kind='mergesort')
+    splits = numpy.cumsum(numpy.bincount(
+        class_ids, minlength=num_classes))[:-1]
+    out_predictions = [
+        p.tolist() for p in numpy.split(sparse_predictions[order], splits)
+    ]
+    out_labels = [
+        l.tolist() for l in numpy.split(sparse_labels[order], splits)
+    ]
+    out_true_positives = numpy.sum(labels, axis=0).tolist()
 
     return out_predictions, out_labels, out_true_positives
 
 
+def top_k_sparse(predictions, labels, k=20):
+    """Extracts the top k predictions of every video as flat arrays.
+
+  Args:
+    predictions: A numpy matrix containing the outputs of the model.
+      Dimensions are 'batch' x 'num_classes'.
+    labels: A numpy matrix containing the ground truth labels.
+      Dimensions are 'batch' x 'num_classes'.
+    k: the top k entries to preserve in each prediction.
+
+  Returns:
+    A tuple (class_ids, predictions, labels) of numpy 1-D arrays with
+    'batch' x k entries.
+
+  Raises:
+    ValueError: An error occurred when the k is not a positive integer.
+  """
+    if k <= 0:
+        raise ValueError("k must be a positive integer.")
+    k = min(k, predictions.shape[1])
+    rows = numpy.arange(predictions.shape[0])[:, None]
+    class_ids = numpy.argpartition(predictions, -k, axis=1)[:, -k:]
+    return (class_ids.reshape(-1), predictions[rows, class_ids].reshape(-1),
+            labels[rows, class_ids].reshape(-1))
+
+
 def top_k_triplets(predictions, labels, k=20):
     """Get the top_k for a 1-d numpy array. Returns a sparse list of tuples in
   (prediction, class) format"""
@@ -187,13 +209,13 @@ class EvaluationMetrics(object):
         mean_loss = numpy.mean(loss)
 
         # Take the top 20 predictions.
-        sparse_predictions, sparse_labels, num_positives = top_k_by_class(
+        class_ids, sparse_predictions, sparse_labels = top_k_sparse(
             predictions, labels, self.top_k)
-        self.map_calculator.accumulate(sparse_predictions, sparse_labels,
-                                       num_positives)
+        num_positives = numpy.sum(labels, axis=0)
+        self.map_calculator.accumulate_sparse(class_ids, sparse_predictions,
+                                              sparse_labels, num_positives)
         self.global_ap_calculator.accumulate(
-            flatten(sparse_predictions),
-            flatten(sparse_labels), sum(num_positives))
+            sparse_predictions, sparse_labels, numpy.sum(num_positives))
 
         self.num_examples += batch_size
         self.sum_hit_at_one += mean_hit_at_one * batch_size
@@ -235,6 +257,22 @@ class EvaluationMetrics(object):
             "gap": gap
         }
 
+    def merge(self, other):
+        """Add the metrics accumulated by another EvaluationMetrics object.
+
+    The evaluation can be sharded across processes, each accumulating its
+    part of the data, and reduced with merge before calling get.
+
+    Args:
+      other: An EvaluationMetrics object with the same num_class and top_k.
+    """
+        self.sum_hit_at_one += other.sum_hit_at_one
+        self.sum_perr += other.sum_perr
+        self.sum_loss += other.sum_loss
+        self.map_calculator.merge(other.map_calculator)
+        self.global_ap_calculator.merge(other.global_ap_calculator)
+        self.num_examples += other.num_examples
+
     def clear(self):
         """Clear the evaluation metrics and reset the EvaluationMetrics object."""
         self.sum_hit_at_one = 0.0
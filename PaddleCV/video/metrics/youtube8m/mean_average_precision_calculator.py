@@ -42,30 +42,33 @@ from . import average_precision_calculator
 
 class MeanAveragePrecisionCalculator(object):
     """This class is to calculate mean average precision.
+
+  The predictions of all classes are kept in one set of numpy arrays, and
+  the average precision of every class is computed at once.
   """
 
-    def __init__(self, num_class):
+    def __init__(self, num_class, top_n=None):
         """Construct a calculator to calculate the (macro) average precision.
 
     Args:
       num_class: A positive Integer specifying the number of classes.
-      top_n_array: A list of positive integers specifying the top n for each
-      class. The top n in each class will be used to calculate its average
-      precision at n.
-      The size of the array must be num_class.
+      top_n: A positive integer specifying the top n of each class used to
+      calculate its average precision at n, or None to use all provided data
+      points.
 
     Raises:
       ValueError: An error occurred when num_class is not a positive integer;
-      or the top_n_array is not a list of positive integers.
+      or the top_n is not a positive integer.
     """
         if not isinstance(num_class, int) or num_class <= 1:
             raise ValueError("num_class must be a positive integer.")
+        if not ((isinstance(top_n, int) and top_n > 0) or top_n is None):
+            raise ValueError("top_n must be a positive integer or None.")
 
-        self._ap_calculators = []  # member of AveragePrecisionCalculator
         self._num_class = num_class  # total number of classes
-        for i in range(num_class):
-            self._ap_calculators.append(
-                average_precision_calculator.AveragePrecisionCalculator())
+        self._top_n = top_n
+        self._total_positives = numpy.zeros(num_class, dtype='float64')
+        self._scores = average_precision_calculator.ScoreBuffer()
 
     def accumulate(self, predictions, actuals, num_positives=None):
         """Accumulate the predictions and their ground truth labels.
@@ -84,21 +87,57 @@ class MeanAveragePrecisionCalculator(object):
       ValueError: An error occurred when the shape of predictions and actuals
       does not match.
     """
-        if not num_positives:
-            num_positives = [None for i in predictions.shape[1]]
+        lengths = [len(p) for p in predictions]
+        if lengths != [len(a) for a in actuals]:
+            raise ValueError(
+                "the shape of predictions and actuals does not match.")
+        class_ids = numpy.repeat(numpy.arange(len(predictions)), lengths)
+        flat_predictions = numpy.concatenate(
+            [numpy.asarray(p, dtype='float32').reshape(-1)
+             for p in predictions])
+        flat_actuals = numpy.concatenate(
+            [numpy.asarray(a).reshape(-1) for a in actuals])
+        self.accumulate_sparse(class_ids, flat_predictions, flat_actuals,
+                               num_positives)
+
+    def accumulate_sparse(self,
+                          class_ids,
+                          predictions,
+                          actuals,
+                          num_positives=None):
+        """Accumulate predictions given as flat arrays.
 
-        calculators = self._ap_calculators
-        for i in range(len(predictions)):
-            calculators[i].accumulate(predictions[i], actuals[i],
-                                      num_positives[i])
+    Args:
+      class_ids: A numpy 1-D int array of the class of every prediction.
+      predictions: A numpy 1-D array storing the prediction scores.
+      actuals: A numpy 1-D array storing the ground truth labels.
+      num_positives: If provided, a numpy 1-D array of the number of true
+      positives for each class, else they are counted in 'actuals'.
+    """
+        class_ids = numpy.asarray(class_ids)
+        actuals = numpy.asarray(actuals)
+        if num_positives is None:
+            num_positives = numpy.bincount(
+                class_ids[actuals > 0], minlength=self._num_class)
+        self._total_positives += numpy.asarray(num_positives, dtype='float64')
+        self._scores.append(class_ids, predictions, actuals)
+        # only the top n of each class can count, prune them in batches
+        if self._top_n is not None and \
+                self._scores.size > 2 * self._top_n * self._num_class:
+            self._scores.keep_top_n(self._top_n)
+
+    def merge(self, other):
+        """Add the predictions accumulated by another calculator, e.g. one
+    evaluating another shard of the data."""
+        self._total_positives += other._total_positives
+        self._scores.append(*other._scores.view())
 
     def clear(self):
-        for calculator in self._ap_calculators:
-            calculator.clear()
+        self._scores.clear()
+        self._total_positives[:] = 0
 
     def is_empty(self):
-        return ([calculator.heap_size for calculator in self._ap_calculators] ==
-                [0 for _ in range(self._num_class)])
+        return self._scores.size == 0
 
     def peek_map_at_n(self):
         """Peek the non-interpolated mean average precision at n.
@@ -107,8 +146,12 @@ class MeanAveragePrecisionCalculator(object):
       An array of non-interpolated average precision at n (default 0) for each
       class.
     """
-        aps = [
-            self._ap_calculators[i].peek_ap_at_n()
-            for i in range(self._num_class)
-        ]
-        return aps
+        groups, predictions, actuals = self._scores.view()
+        aps = average_precision_calculator.average_precision_at_n(
+            groups,
+            predictions,
+            actuals,
+            self._num_class,
+            total_num_positives=self._total_positives,
+            n=self._top_n)
+        return aps.tolist()
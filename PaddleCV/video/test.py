@@ -100,6 +100,9 @@ def test(args):
         fetch_list = [test_loss.name] + [x.name for x in test_outputs
                                          ] + [test_feeds[-1].name]
 
+    # multi-crop testing feeds the crops of a video as consecutive samples
+    num_crops = test_config.TEST.get('num_crops', 1)
+
     epoch_period = []
     for test_iter, data in enumerate(test_reader()):
         cur_time = time.time()
@@ -114,6 +117,9 @@ def test(args):
             loss = np.array(test_outs[0])
             pred = np.array(test_outs[1])
             label = np.array(test_outs[-1])
+        if num_crops > 1:
+            pred = pred.reshape((-1, num_crops) + pred.shape[1:]).mean(axis=1)
+            label = label[::num_crops]
         test_metrics.accumulate(loss, pred, label)
 
         # metric here
@@ -19,6 +19,7 @@ from __future__ import unicode_literals
 
 import numpy as np
 import os
+import sys
 import random
 import time
 import copy
@@ -26,7 +27,9 @@ import cv2
 import box_utils
 import image_utils
 from pycocotools.coco import COCO
-from data_utils import GeneratorEnqueuer
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from shm_utils.enqueuer import SharedMemoryEnqueuer
 from config import cfg
 
 
@@ -148,13 +151,24 @@ class DataSetReader(object):
                    shuffle=False,
                    mixup_iter=0,
                    random_sizes=[],
-                   image=None):
+                   image=None,
+                   shuffle_seed=None):
+        """Return a batch reader of the given mode.
+
+        The train reader can be called with (shard_id, shard_num) to read only
+        every shard_num-th image from shard_id on. Its shuffle is then seeded
+        with shuffle_seed, so that all the shards shuffle the image list the
+        same way and stay disjoint.
+        """
         assert mode in ['train', 'test', 'infer'], "Unknow mode type!"
         if mode != 'infer':
             assert batch_size is not None, \
                 "batch size connot be None in mode {}".format(mode)
             self._parse_dataset_dir(mode)
             self._parse_dataset_catagory()
+        if mode == 'train':
+            # parsed once, shared by the forked reader processes
+            train_imgs = self._parse_images_by_mode(mode)
 
         def img_reader(img, size, mean, std):
             im_path = img['image']
@@ -221,11 +235,20 @@ class DataSetReader(object):
             mixup_img = imgs[(read_cnt + mixup_idx) % len(imgs)]
             return mixup_img
 
-        def reader():
+        def reader(shard_id=0, shard_num=1):
             if mode == 'train':
-                imgs = self._parse_images_by_mode(mode)
-                if shuffle:
-                    np.random.shuffle(imgs)
+                all_imgs = list(train_imgs)
+                if shuffle_seed is None:
+                    rng = np.random
+                else:
+                    rng = np.random.RandomState(shuffle_seed)
+
+                def get_shard():
+                    if shuffle:
+                        rng.shuffle(all_imgs)
+                    return all_imgs[shard_id::shard_num]
+
+                imgs = get_shard()
                 read_cnt = 0
                 total_iter = 0
                 batch_out = []
@@ -235,8 +258,8 @@ class DataSetReader(object):
                     mixup_img = get_mixup_img(imgs, mixup_iter, total_iter,
                                               read_cnt)
                     read_cnt += 1
-                    if read_cnt % len(imgs) == 0 and shuffle:
-                        np.random.shuffle(imgs)
+                    if read_cnt % len(imgs) == 0:
+                        imgs = get_shard()
                     im, gt_boxes, gt_labels, gt_scores = \
                         img_reader_with_augment(img, img_size, cfg.pixel_means,
                                                 cfg.pixel_stds, mixup_img)
@@ -282,42 +305,46 @@ def train(size=416,
           mixup_iter=0,
           random_sizes=[],
           num_workers=8,
-          max_queue=32,
+          max_queue=16,
           use_multiprocessing=True):
-    generator = dsr.get_reader('train', size, batch_size, shuffle,
-                               int(mixup_iter / num_workers), random_sizes)
-
     if not use_multiprocessing:
-        return generator
-
-    def infinite_reader():
+        return dsr.get_reader('train', size, batch_size, shuffle, mixup_iter,
+                              random_sizes)
+
+    generator = dsr.get_reader(
+        'train',
+        size,
+        batch_size,
+        shuffle,
+        int(mixup_iter / num_workers),
+        random_sizes,
+        shuffle_seed=np.random.randint(0, 2**31 - 1))
+
+    def batch_generator(worker_id, num_workers):
+        # every batch is built by one worker, so all its images have the
+        # same random size
         while True:
-            for data in generator():
-                yield data
+            for batch in generator(worker_id, num_workers):
+                yield tuple(np.stack(field) for field in zip(*batch))
+
+    max_size = max(list(random_sizes) + [size])
+    # image, gt_boxes, gt_labels and gt_scores of a batch
+    batch_bytes = batch_size * (3 * max_size * max_size * 4 + cfg.max_box_num *
+                                (4 * 4 + 4 + 4) + 3 * 64)
 
     def reader():
         cnt = 0
+        enqueuer = SharedMemoryEnqueuer(batch_generator, batch_bytes)
         try:
-            enqueuer = GeneratorEnqueuer(
-                infinite_reader(), use_multiprocessing=use_multiprocessing)
             enqueuer.start(max_queue_size=max_queue, workers=num_workers)
-            generator_out = None
-            while True:
-                while enqueuer.is_running():
-                    if not enqueuer.queue.empty():
-                        generator_out = enqueuer.queue.get()
-                        break
-                    else:
-                        time.sleep(0.02)
-                yield generator_out
+            for ims, gt_boxes, gt_labels, gt_scores in enqueuer.get():
+                yield [[ims[i], gt_boxes[i], gt_labels[i], gt_scores[i]]
+                       for i in range(len(ims))]
                 cnt += 1
                 if cnt >= total_iter:
-                    enqueuer.stop()
                     return
-                generator_out = None
         finally:
-            if enqueuer is not None:
-                enqueuer.stop()
+            enqueuer.stop()
 
     return reader
 
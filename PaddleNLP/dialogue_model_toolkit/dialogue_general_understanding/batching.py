@@ -17,8 +17,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import sys
 import numpy as np
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "../.."))
+from preprocess import padding
+
 
 def mask(batch_tokens, total_token_num, vocab_size, CLS=1, SEP=2, MASK=3):
     """
@@ -159,45 +165,17 @@ def pad_batch_data(insts,
                    return_max_len=False,
                    return_num_token=False):
     """
-    Pad the instances to the max sequence length in batch, and generate the
-    corresponding position data and attention bias.
+    Pad the instances to max_len_in, or to the max sequence length in batch
+    if it is -1, and generate the corresponding position data and input mask.
     """
-    return_list = []
-    max_len = max_len_in if max_len_in != -1 else max(len(inst) for inst in insts)
-    # Any token included in dict can be used to pad, since the paddings' loss
-    # will be masked out by weights and make no effect on parameter gradients.
-
-    inst_data = np.array(
-        [inst + list([pad_idx] * (max_len - len(inst))) for inst in insts
-    ])
-    return_list += [inst_data.astype("int64").reshape([-1, max_len, 1])]
-
-    # position data
-    if return_pos:
-        inst_pos = np.array([
-            list(range(0, len(inst))) + [pad_idx] * (max_len - len(inst))
-            for inst in insts
-        ])
-
-        return_list += [inst_pos.astype("int64").reshape([-1, max_len, 1])]
-
-    if return_input_mask:
-        # This is used to avoid attention on paddings.
-        input_mask_data = np.array([[1] * len(inst) + [0] * 
-                                    (max_len - len(inst)) for inst in insts])
-        input_mask_data = np.expand_dims(input_mask_data, axis=-1)
-        return_list += [input_mask_data.astype("float32")] 
-
-    if return_max_len:
-        return_list += [max_len]
-
-    if return_num_token:
-        num_token = 0
-        for inst in insts:
-            num_token += len(inst)
-        return_list += [num_token]
-
-    return return_list if len(return_list) > 1 else return_list[0]
+    return padding.pad_batch_data(
+        insts,
+        pad_idx=pad_idx,
+        return_pos=return_pos,
+        return_input_mask=return_input_mask,
+        return_max_len=return_max_len,
+        return_num_token=return_num_token,
+        max_len=None if max_len_in == -1 else max_len_in)
 
 
 if __name__ == "__main__":
@@ -45,6 +45,7 @@ data_g.add_arg("data_dir", str, None, "Directory path to training data.")
 data_g.add_arg("vocab_path", str, None, "Vocabulary path.")
 data_g.add_arg("batch_size", int, 256, "Total examples' number in batch for training.")
 data_g.add_arg("random_seed", int, 0, "Random seed.")
+data_g.add_arg("bucket_batch", bool, False, "Whether to batch training examples of similar lengths together.")
 data_g.add_arg("num_labels", int, 2, "label number")
 data_g.add_arg("max_seq_len", int, 512, "Number of words of the longest seqence.")
 data_g.add_arg("train_set", str, None, "Path to training data.")
@@ -166,7 +167,8 @@ def main(args):
         label_map_config=args.label_map_config,
         max_seq_len=args.max_seq_len,
         do_lower_case=args.do_lower_case,
-        random_seed=args.random_seed)
+        random_seed=args.random_seed,
+        bucket_batch=args.bucket_batch)
 
     if not (args.do_train or args.do_val or args.do_infer):
         raise ValueError("For args `do_train`, `do_val` and `do_infer`, at "
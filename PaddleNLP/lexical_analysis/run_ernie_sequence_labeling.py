@@ -57,6 +57,7 @@ data_g = utils.ArgumentGroup(parser, "data", "Data paths, vocab paths and data p
 data_g.add_arg("vocab_path", str, "../LARK/ERNIE/config/vocab.txt", "Vocabulary path.")
 data_g.add_arg("batch_size", int, 3, "Total examples' number in batch for training.")
 data_g.add_arg("random_seed", int, 0, "Random seed.")
+data_g.add_arg("bucket_batch", bool, False, "Whether to batch training examples of similar lengths together.")
 data_g.add_arg("num_labels", int, 57, "label number")
 data_g.add_arg("max_seq_len", int, 512, "Number of words of the longest seqence.")
 data_g.add_arg("train_set", str, "./data/train.tsv", "Path to train data.")
@@ -211,7 +212,8 @@ def main(args):
         max_seq_len=args.max_seq_len,
         do_lower_case=args.do_lower_case,
         in_tokens=False,
-        random_seed=args.random_seed)
+        random_seed=args.random_seed,
+        bucket_batch=args.bucket_batch)
 
     if not (args.do_train or args.do_test or args.do_infer):
         raise ValueError("For args `do_train`, `do_val` and `do_test`, at "
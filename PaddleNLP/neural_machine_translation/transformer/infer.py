@@ -5,6 +5,7 @@ import numpy as np
 import os
 import sys
 sys.path.append("../../models/neural_machine_translation/transformer/")
+sys.path.append("../../")
 from functools import partial
 
 import paddle
@@ -15,6 +16,7 @@ from config import *
 from desc import *
 from model import fast_decode as fast_decoder
 from train import pad_batch_data, prepare_data_generator
+from preprocess.padding import expand_attn_bias
 
 
 def parse_args():
@@ -77,7 +79,15 @@ def parse_args():
         default=None,
         nargs=argparse.REMAINDER)
     args = parser.parse_args()
-    # Append args related to dict
+    merge_infer_cfg(args)
+    return args
+
+
+def merge_infer_cfg(args):
+    """
+    Merge the config options and the sizes and special tokens of the
+    dictionaries into InferTaskConfig and ModelHyperParams.
+    """
     src_dict = reader.DataReader.load_dict(args.src_vocab_fpath)
     trg_dict = reader.DataReader.load_dict(args.trg_vocab_fpath)
     dict_args = [
@@ -86,9 +96,8 @@ def parse_args():
         "eos_idx", str(src_dict[args.special_token[1]]), "unk_idx",
         str(src_dict[args.special_token[2]])
     ]
-    merge_cfg_from_list(args.opts + dict_args,
+    merge_cfg_from_list((args.opts or []) + dict_args,
                         [InferTaskConfig, ModelHyperParams])
-    return args
 
 
 def post_process_seq(seq,
@@ -100,16 +109,43 @@ def post_process_seq(seq,
     Post-process the beam-search decoded sequence. Truncate from the first
     <eos> and remove the <bos> and <eos> tokens currently.
     """
-    eos_pos = len(seq) - 1
-    for i, idx in enumerate(seq):
-        if idx == eos_idx:
-            eos_pos = i
-            break
-    seq = [
-        idx for idx in seq[:eos_pos + 1]
-        if (output_bos or idx != bos_idx) and (output_eos or idx != eos_idx)
-    ]
-    return seq
+    seq = np.asarray(seq)
+    eos_pos = np.flatnonzero(seq == eos_idx)
+    if len(eos_pos):
+        seq = seq[:eos_pos[0] + 1]
+    keep = np.ones(len(seq), dtype=bool)
+    if not output_bos:
+        keep &= seq != bos_idx
+    if not output_eos:
+        keep &= seq != eos_idx
+    return seq[keep].tolist()
+
+
+def split_beam_search_result(seq_ids, seq_scores, n_best):
+    """
+    Split the LoD results of fast_decode into a list of the at most n_best
+    (ids, score) hypotheses of every source sentence.
+
+    How to parse the results:
+      Suppose the lod of seq_ids is:
+        [[0, 3, 6], [0, 12, 24, 40, 54, 67, 82]]
+      then from lod[0]:
+        there are 2 source sentences, beam width is 3.
+      from lod[1]:
+        the first source sentence has 3 hyps; the lengths are 12, 12, 16
+        the second source sentence has 3 hyps; the lengths are 14, 13, 15
+    """
+    sent_lod, hyp_lod = seq_ids.lod()
+    ids = np.array(seq_ids).reshape(-1)
+    scores = np.array(seq_scores).reshape(-1)
+    results = []
+    for i in range(len(sent_lod) - 1):  # for each source sentence
+        start = sent_lod[i]
+        end = min(sent_lod[i + 1], start + n_best)
+        results.append([(ids[hyp_lod[j]:hyp_lod[j + 1]],
+                         scores[hyp_lod[j + 1] - 1])
+                        for j in range(start, end)])  # for each candidate
+    return results
 
 
 def prepare_batch_input(insts, data_input_names, src_pad_idx, bos_idx, n_head,
@@ -121,8 +157,7 @@ def prepare_batch_input(insts, data_input_names, src_pad_idx, bos_idx, n_head,
         [inst[0] for inst in insts], src_pad_idx, n_head, is_target=False)
     # start tokens
     trg_word = np.asarray([[bos_idx]] * len(insts), dtype="int64")
-    trg_src_attn_bias = np.tile(src_slf_attn_bias[:, :, ::src_max_len, :],
-                                [1, 1, 1, 1]).astype("float32")
+    trg_src_attn_bias = expand_attn_bias(src_slf_attn_bias, 1)
     trg_word = trg_word.reshape(-1, 1, 1)
     src_word = src_word.reshape(-1, src_max_len, 1)
     src_pos = src_pos.reshape(-1, src_max_len, 1)
@@ -184,9 +219,10 @@ def py_reader_provider_wrapper(data_reader, place):
     return py_reader_provider
 
 
-def fast_infer(args):
+def load_fast_decoder(place, use_py_reader=False, use_mem_opt=True):
     """
-    Inference by beam search decoder based solely on Fluid operators.
+    Build the inference program of the beam search decoder and load the
+    trained parameters from InferTaskConfig.model_path.
     """
     out_ids, out_scores, pyreader = fast_decoder(
         ModelHyperParams.src_vocab_size,
@@ -208,20 +244,14 @@ def fast_infer(args):
         InferTaskConfig.max_out_len,
         ModelHyperParams.bos_idx,
         ModelHyperParams.eos_idx,
-        use_py_reader=args.use_py_reader)
+        use_py_reader=use_py_reader)
 
     # This is used here to set dropout to the test mode.
     infer_program = fluid.default_main_program().clone(for_test=True)
 
-    if args.use_mem_opt:
+    if use_mem_opt:
         fluid.memory_optimize(infer_program)
 
-    if InferTaskConfig.use_gpu:
-        place = fluid.CUDAPlace(0)
-        dev_count = fluid.core.get_cuda_device_count()
-    else:
-        place = fluid.CPUPlace()
-        dev_count = int(os.environ.get('CPU_NUM', multiprocessing.cpu_count()))
     exe = fluid.Executor(place)
     exe.run(fluid.default_startup_program())
 
@@ -232,6 +262,21 @@ def fast_infer(args):
             var for var in infer_program.list_vars()
             if isinstance(var, fluid.framework.Parameter)
         ])
+    return exe, infer_program, out_ids, out_scores, pyreader
+
+
+def fast_infer(args):
+    """
+    Inference by beam search decoder based solely on Fluid operators.
+    """
+    if InferTaskConfig.use_gpu:
+        place = fluid.CUDAPlace(0)
+        dev_count = fluid.core.get_cuda_device_count()
+    else:
+        place = fluid.CPUPlace()
+        dev_count = int(os.environ.get('CPU_NUM', multiprocessing.cpu_count()))
+    exe, infer_program, out_ids, out_scores, pyreader = load_fast_decoder(
+        place, args.use_py_reader, args.use_mem_opt)
 
     exec_strategy = fluid.ExecutionStrategy()
     # For faster executor
@@ -287,32 +332,13 @@ def fast_infer(args):
             ] if isinstance(
                 seq_ids, paddle.fluid.LoDTensor) else (seq_ids, seq_scores)
             for seq_ids, seq_scores in zip(seq_ids_list, seq_scores_list):
-                # How to parse the results:
-                #   Suppose the lod of seq_ids is:
-                #     [[0, 3, 6], [0, 12, 24, 40, 54, 67, 82]]
-                #   then from lod[0]:
-                #     there are 2 source sentences, beam width is 3.
-                #   from lod[1]:
-                #     the first source sentence has 3 hyps; the lengths are 12, 12, 16
-                #     the second source sentence has 3 hyps; the lengths are 14, 13, 15
-                hyps = [[] for i in range(len(seq_ids.lod()[0]) - 1)]
-                scores = [[] for i in range(len(seq_scores.lod()[0]) - 1)]
-                for i in range(len(seq_ids.lod()[0]) -
-                               1):  # for each source sentence
-                    start = seq_ids.lod()[0][i]
-                    end = seq_ids.lod()[0][i + 1]
-                    for j in range(end - start):  # for each candidate
-                        sub_start = seq_ids.lod()[1][start + j]
-                        sub_end = seq_ids.lod()[1][start + j + 1]
-                        hyps[i].append(" ".join([
+                for hyps in split_beam_search_result(seq_ids, seq_scores,
+                                                     InferTaskConfig.n_best):
+                    for hyp_ids, _ in hyps:
+                        print(" ".join([
                             trg_idx2word[idx]
-                            for idx in post_process_seq(
-                                np.array(seq_ids)[sub_start:sub_end])
+                            for idx in post_process_seq(hyp_ids)
                         ]))
-                        scores[i].append(np.array(seq_scores)[sub_end - 1])
-                        print(hyps[i][-1])
-                        if len(hyps[i]) >= InferTaskConfig.n_best:
-                            break
         except (StopIteration, fluid.core.EOFException):
             # The data pass is over.
             if args.use_py_reader:
@@ -0,0 +1,380 @@
+"""Long-running translation service with the beam search decoder of infer.py.
+
+The inference program of ``fast_decode`` is built and its parameters are
+loaded once. Tokenized source sentences, one per line, are POSTed to
+``http://<host>:<port>/translate``. A batching thread pools the sentences of
+concurrent requests, waiting at most ``max_latency_ms`` for the pool to fill
+up, sorts them by length and translates them in batches of at most
+``batch_size`` sentences, so that sentences of similar lengths share the
+encoder run and the cached keys and values of the decoder.
+
+The translations are streamed back as they are decoded, one JSON object per
+line with the line number ``id``, the ``translation`` and its ``score``,
+followed by a line of the statistics of the request. ``GET /stats`` reports
+the p50/p99 request latency and the sentence and token throughput.
+
+Usage:
+
+.. code-block:: bash
+
+    python -u infer_server.py \\
+      --src_vocab_fpath gen_data/wmt16_ende_data_bpe/vocab_all.bpe.32000 \\
+      --trg_vocab_fpath gen_data/wmt16_ende_data_bpe/vocab_all.bpe.32000 \\
+      --special_token '<s>' '<e>' '<unk>' \\
+      --port 8866 \\
+      model_path trained_models/iter_100000.infer.model \\
+      beam_size 5
+    curl --data-binary @newstest2016.tok.bpe.32000.en http://127.0.0.1:8866/translate
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import ast
+import collections
+import json
+import threading
+import time
+
+import numpy as np
+import paddle.fluid as fluid
+from six.moves import BaseHTTPServer, queue, socketserver
+
+import reader
+from config import *
+from desc import *
+from infer import (load_fast_decoder, merge_infer_cfg, post_process_seq,
+                   prepare_batch_input, split_beam_search_result)
+
+# number of recent requests the latency percentiles are computed over
+STATS_WINDOW = 10000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--src_vocab_fpath",
+        type=str,
+        required=True,
+        help="The path of vocabulary file of source language.")
+    parser.add_argument(
+        "--trg_vocab_fpath",
+        type=str,
+        required=True,
+        help="The path of vocabulary file of target language.")
+    parser.add_argument(
+        "--special_token",
+        type=str,
+        default=["<s>", "<e>", "<unk>"],
+        nargs=3,
+        help="The <bos>, <eos> and <unk> tokens in the dictionary.")
+    parser.add_argument(
+        "--token_delimiter",
+        type=lambda x: str(x.encode().decode("unicode-escape")),
+        default=" ",
+        help="The delimiter used to split tokens in source sentences.")
+    parser.add_argument(
+        "--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument(
+        "--port", type=int, default=8866, help="Port to listen on.")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=50,
+        help="The maximum number of sentences in one run of the decoder.")
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        default=400,
+        help="The maximum number of queued sentences sorted by length and "
+        "split into batches together.")
+    parser.add_argument(
+        "--max_latency_ms",
+        type=float,
+        default=10.0,
+        help="The maximum time to wait for the pool to fill up.")
+    parser.add_argument(
+        "--use_mem_opt",
+        type=ast.literal_eval,
+        default=True,
+        help="The flag indicating whether to use memory optimization.")
+    parser.add_argument(
+        'opts',
+        help='See config.py for all options',
+        default=None,
+        nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    merge_infer_cfg(args)
+    return args
+
+
+class Request(object):
+    def __init__(self, num_sentences):
+        self.arrival = time.time()
+        self.first_result = None
+        self.num_sentences = num_sentences
+        self.remaining = num_sentences
+        self.src_tokens = 0
+        self.trg_tokens = 0
+        # results are put here as soon as their batch is decoded
+        self.results = queue.Queue()
+
+
+class Sentence(object):
+    def __init__(self, request, sent_id, src_ids):
+        self.request = request
+        self.id = sent_id
+        self.src_ids = src_ids
+        self.queued = time.time()
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=STATS_WINDOW)
+        self.first_latencies = collections.deque(maxlen=STATS_WINDOW)
+        self.start = time.time()
+        self.requests = 0
+        self.sentences = 0
+        self.batches = 0
+        self.src_tokens = 0
+        self.trg_tokens = 0
+
+    def record_batch(self, sentences):
+        with self.lock:
+            self.batches += 1
+            self.sentences += len(sentences)
+
+    def record(self, request):
+        """Record a request whose sentences are all translated, and return
+        its own statistics."""
+        latency = time.time() - request.arrival
+        first_latency = request.first_result - request.arrival
+        with self.lock:
+            self.requests += 1
+            self.src_tokens += request.src_tokens
+            self.trg_tokens += request.trg_tokens
+            self.latencies.append(latency)
+            self.first_latencies.append(first_latency)
+        return {
+            'sentences': request.num_sentences,
+            'src_tokens': request.src_tokens,
+            'trg_tokens': request.trg_tokens,
+            'latency_ms': latency * 1000,
+            'first_result_ms': first_latency * 1000,
+        }
+
+    def report(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            first_latencies = np.array(self.first_latencies) * 1000
+            period = time.time() - self.start
+            report = {
+                'requests': self.requests,
+                'sentences': self.sentences,
+                'batches': self.batches,
+                'avg_batch_size': self.sentences / max(self.batches, 1),
+                'sentences_per_sec': self.sentences / period,
+                'src_tokens_per_sec': self.src_tokens / period,
+                'trg_tokens_per_sec': self.trg_tokens / period,
+            }
+        if len(latencies):
+            report['p50_ms'] = float(np.percentile(latencies, 50))
+            report['p99_ms'] = float(np.percentile(latencies, 99))
+            report['first_result_p50_ms'] = float(
+                np.percentile(first_latencies, 50))
+            report['first_result_p99_ms'] = float(
+                np.percentile(first_latencies, 99))
+        return report
+
+
+class Batcher(object):
+    """
+    Pools the queued sentences, sorts them by length and decodes them in
+    batches on one executor.
+    """
+
+    def __init__(self, args):
+        place = fluid.CUDAPlace(0) if InferTaskConfig.use_gpu \
+            else fluid.CPUPlace()
+        self.place = place
+        self.exe, self.program, out_ids, out_scores, _ = load_fast_decoder(
+            place, use_py_reader=False, use_mem_opt=args.use_mem_opt)
+        self.fetch_list = [out_ids.name, out_scores.name]
+        self.data_input_names = (encoder_data_input_fields +
+                                 fast_decoder_data_input_fields)
+        src_dict = reader.DataReader.load_dict(args.src_vocab_fpath)
+        self.converter = reader.Converter(
+            vocab=src_dict,
+            beg=ModelHyperParams.bos_idx,
+            end=ModelHyperParams.eos_idx,
+            unk=ModelHyperParams.unk_idx,
+            delimiter=args.token_delimiter,
+            add_beg=False)
+        self.trg_idx2word = reader.DataReader.load_dict(
+            dict_path=args.trg_vocab_fpath, reverse=True)
+        self.batch_size = args.batch_size
+        self.pool_size = max(args.pool_size, args.batch_size)
+        self.max_latency = args.max_latency_ms / 1000.0
+        self.queue = queue.Queue()
+        self.stats = Stats()
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, lines):
+        """
+        Queue the source sentences of a request, and return the request
+        whose results queue receives their translations.
+        """
+        request = Request(len(lines))
+        max_len = ModelHyperParams.max_length
+        sentences = []
+        for i, line in enumerate(lines):
+            src_ids = self.converter(line.strip())
+            if len(src_ids) > max_len:
+                # keep <eos> when truncating to the longest supported input
+                src_ids = src_ids[:max_len - 1] + src_ids[-1:]
+            request.src_tokens += len(src_ids)
+            sentences.append(Sentence(request, i, src_ids))
+        for sentence in sentences:
+            self.queue.put(sentence)
+        return request
+
+    def _next_pool(self):
+        sentences = [self.queue.get()]
+        deadline = sentences[0].queued + self.max_latency
+        while len(sentences) < self.pool_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                sentences.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return sentences
+
+    def _translate(self, batch):
+        feed = prepare_batch_input(
+            [(s.src_ids, ) for s in batch], self.data_input_names,
+            ModelHyperParams.eos_idx, ModelHyperParams.bos_idx,
+            ModelHyperParams.n_head, ModelHyperParams.d_model, self.place)
+        seq_ids, seq_scores = self.exe.run(self.program,
+                                           feed=feed,
+                                           fetch_list=self.fetch_list,
+                                           return_numpy=False,
+                                           use_program_cache=True)
+        results = []
+        for hyps in split_beam_search_result(seq_ids, seq_scores, 1):
+            hyp_ids, score = hyps[0]
+            trg_ids = post_process_seq(
+                hyp_ids,
+                bos_idx=ModelHyperParams.bos_idx,
+                eos_idx=ModelHyperParams.eos_idx,
+                output_bos=InferTaskConfig.output_bos,
+                output_eos=InferTaskConfig.output_eos)
+            results.append(({
+                'translation':
+                " ".join([self.trg_idx2word[idx] for idx in trg_ids]),
+                'score': float(score)
+            }, len(trg_ids)))
+        return results
+
+    def _loop(self):
+        while True:
+            pool = self._next_pool()
+            # sort by length so that a batch is padded as little as possible
+            pool.sort(key=lambda s: len(s.src_ids))
+            for start in range(0, len(pool), self.batch_size):
+                batch = pool[start:start + self.batch_size]
+                try:
+                    results = self._translate(batch)
+                except Exception as e:
+                    results = [({'error': str(e)}, 0)] * len(batch)
+                self.stats.record_batch(batch)
+                now = time.time()
+                for sentence, (result, num_tokens) in zip(batch, results):
+                    request = sentence.request
+                    if request.first_result is None:
+                        request.first_result = now
+                    request.trg_tokens += num_tokens
+                    request.remaining -= 1
+                    result = dict(result, id=sentence.id)
+                    request.results.put(result)
+                    if request.remaining == 0:
+                        request.results.put({
+                            'stats': self.stats.record(request)
+                        })
+
+
+class InferServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        # for the chunked transfer encoding of the streamed results
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, code, body):
+            body = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._reply(404, {'error': 'not found'})
+            self._reply(200, batcher.stats.report())
+
+        def do_POST(self):
+            if self.path != '/translate':
+                return self._reply(404, {'error': 'not found'})
+            length = int(self.headers.get('Content-Length', 0))
+            lines = self.rfile.read(length).decode('utf-8').splitlines()
+            if not lines:
+                return self._reply(400, {'error': 'no source sentences'})
+            request = batcher.submit(lines)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            # the translations and then the statistics of the request
+            for _ in range(request.num_sentences + 1):
+                result = request.results.get()
+                self._write_chunk(json.dumps(result).encode('utf-8') + b'\n')
+            self._write_chunk(b'')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(args):
+    batcher = Batcher(args)
+    server = InferServer((args.host, args.port), make_handler(batcher))
+    print("Serving {} on http://{}:{}".format(InferTaskConfig.model_path,
+                                              args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats.report()))
+
+
+def main():
+    args = parse_args()
+    serve(args)
+
+
+if __name__ == '__main__':
+    main()
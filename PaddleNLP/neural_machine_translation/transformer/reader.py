@@ -1,10 +1,16 @@
+import argparse
+import array
 import glob
+import json
 import six
 import os
 import tarfile
 
 import numpy as np
 
+CORPUS_CACHE_META = "corpus_meta.json"
+CORPUS_CACHE_VERSION = 1
+
 
 class SortType(object):
     GLOBAL = 'global'
@@ -39,60 +45,229 @@ class ComposedConverter(object):
         ]
 
 
-class SentenceBatchCreator(object):
-    def __init__(self, batch_size):
-        self.batch = []
-        self._batch_size = batch_size
+class TokenIds(object):
+    """
+    The token ids of the sentences of one side of a corpus, kept as a flat
+    int32 array of all the ids and the lengths of the sentences, instead of
+    a list per sentence.
+    """
 
-    def append(self, info):
-        self.batch.append(info)
-        if len(self.batch) == self._batch_size:
-            tmp = self.batch
-            self.batch = []
-            return tmp
+    def __init__(self, ids, lens):
+        self.ids = ids
+        self.lens = np.asarray(lens, dtype="int32")
+        self.offsets = np.zeros(len(self.lens) + 1, dtype="int64")
+        np.cumsum(self.lens, out=self.offsets[1:])
 
+    def __len__(self):
+        return len(self.lens)
 
-class TokenBatchCreator(object):
-    def __init__(self, batch_size):
-        self.batch = []
-        self.max_len = -1
-        self._batch_size = batch_size
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
 
-    def append(self, info):
-        cur_len = info.max_len
-        max_len = max(self.max_len, cur_len)
-        if max_len * (len(self.batch) + 1) > self._batch_size:
-            result = self.batch
-            self.batch = [info]
-            self.max_len = cur_len
-            return result
-        else:
-            self.max_len = max_len
-            self.batch.append(info)
 
+class TokenIdsWriter(object):
+    """
+    Appends the token ids of sentences to in-memory buffers, which are
+    flushed to `<prefix>.ids` every `flush_size` ids if a prefix is given.
+    """
 
-class SampleInfo(object):
-    def __init__(self, i, max_len, min_len):
-        self.i = i
-        self.min_len = min_len
-        self.max_len = max_len
+    def __init__(self, prefix=None, flush_size=1 << 20):
+        self._prefix = prefix
+        self._flush_size = flush_size
+        self._ids = array.array("i")
+        self._lens = array.array("i")
+        self._file = open(prefix + ".ids", "wb") if prefix else None
+
+    def append(self, ids):
+        self._ids.extend(ids)
+        self._lens.append(len(ids))
+        if self._file is not None and len(self._ids) >= self._flush_size:
+            self._ids.tofile(self._file)
+            del self._ids[:]
+
+    def close(self):
+        """
+        Returns the written TokenIds, memory mapped if they are written to
+        files.
+        """
+        lens = np.frombuffer(self._lens, dtype="int32") if len(
+            self._lens) else np.zeros(0, dtype="int32")
+        if self._file is None:
+            ids = np.frombuffer(self._ids, dtype="int32") if len(
+                self._ids) else np.zeros(0, dtype="int32")
+            return TokenIds(ids, lens)
+        self._ids.tofile(self._file)
+        self._file.close()
+        np.save(self._prefix + ".lens.npy", lens)
+        return load_token_ids(self._prefix)
+
+
+def load_token_ids(prefix):
+    ids_fpath = prefix + ".ids"
+    if os.path.getsize(ids_fpath) == 0:
+        ids = np.zeros(0, dtype="int32")
+    else:
+        ids = np.memmap(ids_fpath, dtype="int32", mode="r")
+    return TokenIds(ids, np.load(prefix + ".lens.npy"))
+
+
+def sort_in_pools(idx, lens, pool_size, first_pool=0):
+    """
+    Sort the sample indexes by length in each pool of pool_size samples,
+    ascending and descending alternately to avoid placing short next to
+    long sentences. first_pool is the number of pools sorted before.
+    """
+    idx = idx.copy()
+    for n, i in enumerate(range(0, len(idx), pool_size), first_pool):
+        pool = idx[i:i + pool_size]
+        pool_lens = lens[pool] if n % 2 == 0 else -lens[pool]
+        idx[i:i + pool_size] = pool[np.argsort(pool_lens, kind="mergesort")]
+    return idx
 
 
-class MinMaxFilter(object):
-    def __init__(self, max_len, min_len, underlying_creator):
-        self._min_len = min_len
-        self._max_len = max_len
-        self._creator = underlying_creator
+def split_sentence_batch(idx, batch_size):
+    """
+    Split the sample indexes into batches of batch_size samples. The last
+    one is the remaining, uncompleted batch and may be empty.
+    """
+    return np.split(idx, range(batch_size, len(idx) + 1, batch_size))
 
-    def append(self, info):
-        if info.max_len > self._max_len or info.min_len < self._min_len:
-            return
-        else:
-            return self._creator.append(info)
 
-    @property
-    def batch(self):
-        return self._creator.batch
+def split_token_batch(idx, lens, batch_size):
+    """
+    Split the sample indexes into batches in order, each containing at most
+    batch_size tokens including paddings. The last one is the remaining,
+    uncompleted batch.
+    """
+    starts = []
+    max_len = 0
+    num = 0
+    for i, cur_len in enumerate(lens[idx].tolist()):
+        max_len = max(max_len, cur_len)
+        if max_len * (num + 1) > batch_size and num > 0:
+            starts.append(i)
+            max_len = cur_len
+            num = 0
+        num += 1
+    return np.split(idx, starts)
+
+
+def min_max_lens(src_seq_ids, trg_seq_ids):
+    """
+    The max and min lengths of the source and target sentences of samples,
+    used to sort, filter and batch them.
+    """
+    if trg_seq_ids is None:
+        return src_seq_ids.lens, src_seq_ids.lens
+    return (np.maximum(src_seq_ids.lens, trg_seq_ids.lens),
+            np.minimum(src_seq_ids.lens, trg_seq_ids.lens))
+
+
+def make_converters(src_vocab, trg_vocab, start_mark, end_mark, unk_mark,
+                    token_delimiter):
+    converters = [
+        Converter(
+            vocab=src_vocab,
+            beg=src_vocab[start_mark],
+            end=src_vocab[end_mark],
+            unk=src_vocab[unk_mark],
+            delimiter=token_delimiter,
+            add_beg=False)
+    ]
+    if trg_vocab is not None:
+        converters.append(
+            Converter(
+                vocab=trg_vocab,
+                beg=trg_vocab[start_mark],
+                end=trg_vocab[end_mark],
+                unk=trg_vocab[unk_mark],
+                delimiter=token_delimiter,
+                add_beg=True))
+    return ComposedConverter(converters)
+
+
+def load_lines(fpattern, tar_fname, field_delimiter, only_src):
+    num_fields = 1 if only_src else 2
+    fpaths = glob.glob(fpattern)
+
+    if len(fpaths) == 1 and tarfile.is_tarfile(fpaths[0]):
+        if tar_fname is None:
+            raise Exception("If tar file provided, please set tar_fname.")
+
+        f = tarfile.open(fpaths[0], "r")
+        for line in f.extractfile(tar_fname):
+            if six.PY3:
+                line = line.decode()
+            fields = line.strip("\n").split(field_delimiter)
+            if len(fields) == num_fields:
+                yield fields
+    else:
+        for fpath in fpaths:
+            if not os.path.isfile(fpath):
+                raise IOError("Invalid file: %s" % fpath)
+
+            with open(fpath, "rb") as f:
+                for line in f:
+                    if six.PY3:
+                        line = line.decode()
+                    fields = line.strip("\n").split(field_delimiter)
+                    if len(fields) == num_fields:
+                        yield fields
+
+
+def is_corpus_cache(fpattern):
+    return os.path.isfile(os.path.join(fpattern, CORPUS_CACHE_META))
+
+
+def binarize_corpus(output_dir,
+                    src_vocab_fpath,
+                    trg_vocab_fpath,
+                    fpattern,
+                    tar_fname=None,
+                    field_delimiter="\t",
+                    token_delimiter=" ",
+                    start_mark="<s>",
+                    end_mark="<e>",
+                    unk_mark="<unk>"):
+    """
+    Convert a text corpus to token ids once and write them into output_dir,
+    which can then be passed to DataReader as fpattern. The ids of each side
+    are written as a flat int32 file `<side>.ids` along with the sentence
+    lengths in `<side>.lens.npy`, and are memory mapped by DataReader.
+
+    The arguments are the same as those of DataReader. The same vocabularies
+    and marks must be used to read the cache.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    src_vocab = DataReader.load_dict(src_vocab_fpath)
+    trg_vocab = None if trg_vocab_fpath is None else DataReader.load_dict(
+        trg_vocab_fpath)
+    converters = make_converters(src_vocab, trg_vocab, start_mark, end_mark,
+                                 unk_mark, token_delimiter)
+    sides = ["src"] if trg_vocab is None else ["src", "trg"]
+    writers = [
+        TokenIdsWriter(os.path.join(output_dir, side)) for side in sides
+    ]
+    for line in load_lines(fpattern, tar_fname, field_delimiter,
+                           trg_vocab is None):
+        for writer, ids in zip(writers, converters(line)):
+            writer.append(ids)
+    num_samples = len(writers[0].close())
+    for writer in writers[1:]:
+        writer.close()
+    meta = {
+        "version": CORPUS_CACHE_VERSION,
+        "num_samples": num_samples,
+        "sides": sides,
+        "src_vocab_size": len(src_vocab),
+        "trg_vocab_size": None if trg_vocab is None else len(trg_vocab),
+        "marks": [start_mark, end_mark, unk_mark],
+    }
+    # written last, so that an interrupted conversion is not a valid cache
+    with open(os.path.join(output_dir, CORPUS_CACHE_META), "w") as f:
+        json.dump(meta, f)
+    return num_samples
 
 
 class DataReader(object):
@@ -124,7 +299,9 @@ class DataReader(object):
     :type src_vocab_fpath: basestring
     :param trg_vocab_fpath: The path of vocabulary file of target language.
     :type trg_vocab_fpath: basestring
-    :param fpattern: The pattern to match data files.
+    :param fpattern: The pattern to match data files, or the directory of a
+        corpus cache written by binarize_corpus, which is memory mapped
+        instead of converting the text again.
     :type fpattern: basestring
     :param batch_size: The number of sequences contained in a mini-batch.
         or the maximum number of tokens (include paddings) contained in a
@@ -211,66 +388,49 @@ class DataReader(object):
 
     def load_src_trg_ids(self, end_mark, fpattern, start_mark, tar_fname,
                          unk_mark):
-        converters = [
-            Converter(
-                vocab=self._src_vocab,
-                beg=self._src_vocab[start_mark],
-                end=self._src_vocab[end_mark],
-                unk=self._src_vocab[unk_mark],
-                delimiter=self._token_delimiter,
-                add_beg=False)
-        ]
-        if not self._only_src:
-            converters.append(
-                Converter(
-                    vocab=self._trg_vocab,
-                    beg=self._trg_vocab[start_mark],
-                    end=self._trg_vocab[end_mark],
-                    unk=self._trg_vocab[unk_mark],
-                    delimiter=self._token_delimiter,
-                    add_beg=True))
-
-        converters = ComposedConverter(converters)
-
-        self._src_seq_ids = []
-        self._trg_seq_ids = None if self._only_src else []
-        self._sample_infos = []
-
-        for i, line in enumerate(self._load_lines(fpattern, tar_fname)):
-            src_trg_ids = converters(line)
-            self._src_seq_ids.append(src_trg_ids[0])
-            lens = [len(src_trg_ids[0])]
-            if not self._only_src:
-                self._trg_seq_ids.append(src_trg_ids[1])
-                lens.append(len(src_trg_ids[1]))
-            self._sample_infos.append(SampleInfo(i, max(lens), min(lens)))
+        if is_corpus_cache(fpattern):
+            self._load_corpus_cache(fpattern, [start_mark, end_mark, unk_mark])
+        else:
+            converters = make_converters(
+                self._src_vocab, None if self._only_src else self._trg_vocab,
+                start_mark, end_mark, unk_mark, self._token_delimiter)
+            writers = [TokenIdsWriter()
+                       for _ in range(1 if self._only_src else 2)]
+            for line in self._load_lines(fpattern, tar_fname):
+                for writer, ids in zip(writers, converters(line)):
+                    writer.append(ids)
+            self._src_seq_ids = writers[0].close()
+            self._trg_seq_ids = None if self._only_src else writers[1].close()
+
+        self._max_lens, self._min_lens = min_max_lens(self._src_seq_ids,
+                                                      self._trg_seq_ids)
+
+    def _load_corpus_cache(self, cache_dir, marks):
+        with open(os.path.join(cache_dir, CORPUS_CACHE_META)) as f:
+            meta = json.load(f)
+        if meta["version"] != CORPUS_CACHE_VERSION:
+            raise ValueError("The corpus cache %s has version %d, expected %d."
+                             % (cache_dir, meta["version"],
+                                CORPUS_CACHE_VERSION))
+        # lines are selected by their number of fields, so a cache only
+        # serves readers of the same sides
+        if meta["sides"] != (["src"] if self._only_src else ["src", "trg"]):
+            raise ValueError("The corpus cache %s has sides %s." %
+                             (cache_dir, ", ".join(meta["sides"])))
+        if meta["src_vocab_size"] != len(self._src_vocab) or (
+                not self._only_src and
+                meta["trg_vocab_size"] != len(self._trg_vocab)) or meta[
+                    "marks"] != marks:
+            raise ValueError(
+                "The corpus cache %s was built with different vocabularies "
+                "or marks." % cache_dir)
+        self._src_seq_ids = load_token_ids(os.path.join(cache_dir, "src"))
+        self._trg_seq_ids = None if self._only_src else load_token_ids(
+            os.path.join(cache_dir, "trg"))
 
     def _load_lines(self, fpattern, tar_fname):
-        fpaths = glob.glob(fpattern)
-
-        if len(fpaths) == 1 and tarfile.is_tarfile(fpaths[0]):
-            if tar_fname is None:
-                raise Exception("If tar file provided, please set tar_fname.")
-
-            f = tarfile.open(fpaths[0], "r")
-            for line in f.extractfile(tar_fname):
-                fields = line.strip("\n").split(self._field_delimiter)
-                if (not self._only_src and len(fields) == 2) or (
-                        self._only_src and len(fields) == 1):
-                    yield fields
-        else:
-            for fpath in fpaths:
-                if not os.path.isfile(fpath):
-                    raise IOError("Invalid file: %s" % fpath)
-
-                with open(fpath, "rb") as f:
-                    for line in f:
-                        if six.PY3:
-                            line = line.decode()
-                        fields = line.strip("\n").split(self._field_delimiter)
-                        if (not self._only_src and len(fields) == 2) or (
-                                self._only_src and len(fields) == 1):
-                            yield fields
+        return load_lines(fpattern, tar_fname, self._field_delimiter,
+                          self._only_src)
 
     @staticmethod
     def load_dict(dict_path, reverse=False):
@@ -288,48 +448,317 @@ class DataReader(object):
     def batch_generator(self):
         # global sort or global shuffle
         if self._sort_type == SortType.GLOBAL:
-            infos = sorted(self._sample_infos, key=lambda x: x.max_len)
+            idx = np.argsort(self._max_lens, kind="mergesort")
         else:
+            idx = np.arange(len(self._max_lens))
             if self._shuffle:
-                infos = self._sample_infos
-                self._random.shuffle(infos)
-            else:
-                infos = self._sample_infos
+                self._random.shuffle(idx)
 
             if self._sort_type == SortType.POOL:
-                reverse = True
-                for i in range(0, len(infos), self._pool_size):
-                    # to avoid placing short next to long sentences
-                    reverse = not reverse
-                    infos[i:i + self._pool_size] = sorted(
-                        infos[i:i + self._pool_size],
-                        key=lambda x: x.max_len,
-                        reverse=reverse)
+                idx = sort_in_pools(idx, self._max_lens, self._pool_size)
+
+        batches = self._split_batches(idx, self._max_lens, self._min_lens)
+
+        if self._shuffle_batch:
+            self._random.shuffle(batches)
+
+        for batch_ids in batches:
+            yield self._make_batch(self._src_seq_ids, self._trg_seq_ids,
+                                   batch_ids)
+
+    def _split_batches(self, idx, max_lens, min_lens):
+        # filter by length
+        idx = idx[(max_lens[idx] <= self._max_length) &
+                  (min_lens[idx] >= self._min_length)]
 
         # concat batch
-        batches = []
-        batch_creator = TokenBatchCreator(
-            self._batch_size
-        ) if self._use_token_batch else SentenceBatchCreator(self._batch_size)
-        batch_creator = MinMaxFilter(self._max_length, self._min_length,
-                                     batch_creator)
+        if self._use_token_batch:
+            batches = split_token_batch(idx, max_lens, self._batch_size)
+        else:
+            batches = split_sentence_batch(idx, self._batch_size)
 
-        for info in infos:
-            batch = batch_creator.append(info)
-            if batch is not None:
-                batches.append(batch)
+        if self._clip_last_batch or len(batches[-1]) == 0:
+            batches.pop()
+        return batches
 
-        if not self._clip_last_batch and len(batch_creator.batch) != 0:
-            batches.append(batch_creator.batch)
+    def _make_batch(self, src_seq_ids, trg_seq_ids, batch_ids):
+        if self._only_src:
+            return [[src_seq_ids[i].tolist()] for i in batch_ids]
+        batch = []
+        for i in batch_ids:
+            trg_ids = trg_seq_ids[i].tolist()
+            batch.append((src_seq_ids[i].tolist(), trg_ids[:-1], trg_ids[1:]))
+        return batch
 
-        if self._shuffle_batch:
-            self._random.shuffle(batches)
 
-        for batch in batches:
-            batch_ids = [info.i for info in batch]
+class StreamingDataReader(DataReader):
+    """
+    The streaming data reader reads the data files in rotation instead of
+    loading all data, for corpora larger than memory. Each time pool_size
+    samples are read, converted, shuffled and sorted within the pool, and
+    batched. Only one pool is held in memory, so the sort type can not be
+    'global'.
+
+    The data files matched by fpattern are sharded among trainers: trainer
+    i of n reads the i-th of every n files in name order, so there should be
+    at least as many files as trainers. With shuffle, the file order is
+    shuffled in each lap over the files.
+
+    The files of the trainers hold different numbers of samples, but
+    trainers synchronizing their gradients have to run the same number of
+    steps in a pass, or the ones running out first leave the others
+    blocked. With batches_per_pass, each pass yields exactly that many
+    batches: the laps over the files of a trainer are read as one endless
+    stream, cut into passes of batches_per_pass batches. A trainer with
+    fewer samples thus starts its next lap within a pass, and one with more
+    continues its lap in the next pass, no sample is dropped. It is
+    required with more than one trainer. Without it, a pass is one lap.
+
+    The reader can resume from the position after the last batch it
+    yielded, given by `state`. Samples are shuffled by random states derived
+    from the seed, the lap and the pool, so that a resumed reader produces
+    the same batches as the interrupted one would have.
+
+    The arguments are the same as those of DataReader except:
+
+    :param trainer_id: The id of this trainer, PADDLE_TRAINER_ID by default.
+    :type trainer_id: int
+    :param trainer_num: The number of trainers, PADDLE_TRAINERS_NUM by
+        default.
+    :type trainer_num: int
+    :param batches_per_pass: The number of batches of a pass, the same for
+        all the trainers.
+    :type batches_per_pass: int
+    :param state: A state of a reader of the same data and settings to
+        resume from.
+    :type state: dict
+    """
 
-            if self._only_src:
-                yield [[self._src_seq_ids[idx]] for idx in batch_ids]
-            else:
-                yield [(self._src_seq_ids[idx], self._trg_seq_ids[idx][:-1],
-                        self._trg_seq_ids[idx][1:]) for idx in batch_ids]
+    def __init__(self,
+                 src_vocab_fpath,
+                 trg_vocab_fpath,
+                 fpattern,
+                 batch_size,
+                 pool_size,
+                 sort_type=SortType.POOL,
+                 clip_last_batch=True,
+                 min_length=0,
+                 max_length=100,
+                 shuffle=True,
+                 shuffle_batch=False,
+                 use_token_batch=False,
+                 field_delimiter="\t",
+                 token_delimiter=" ",
+                 start_mark="<s>",
+                 end_mark="<e>",
+                 unk_mark="<unk>",
+                 seed=0,
+                 trainer_id=None,
+                 trainer_num=None,
+                 batches_per_pass=None,
+                 state=None):
+        if sort_type == SortType.GLOBAL:
+            raise ValueError("Global sort is not supported in streaming mode.")
+        if trainer_id is None:
+            trainer_id = int(os.getenv("PADDLE_TRAINER_ID", "0"))
+        if trainer_num is None:
+            trainer_num = max(int(os.getenv("PADDLE_TRAINERS_NUM", "1")), 1)
+        if trainer_num > 1 and batches_per_pass is None:
+            raise ValueError("batches_per_pass is required with %d trainers, "
+                             "so that they run the same number of steps in a "
+                             "pass." % trainer_num)
+        if batches_per_pass is not None and batches_per_pass < 1:
+            raise ValueError("batches_per_pass should be positive.")
+        self._trainer_id = trainer_id
+        self._trainer_num = trainer_num
+        self._batches_per_pass = batches_per_pass
+        self._seed = seed
+        self._state = dict(
+            epoch=0, pool=0, shard=0, offset=0, batch=0) if state is None \
+            else dict(state)
+        # the number of batches of the current pass yielded
+        self._step = self._state.pop("step", 0)
+        super(StreamingDataReader, self).__init__(
+            src_vocab_fpath,
+            trg_vocab_fpath,
+            fpattern,
+            batch_size,
+            pool_size,
+            sort_type=sort_type,
+            clip_last_batch=clip_last_batch,
+            min_length=min_length,
+            max_length=max_length,
+            shuffle=shuffle,
+            shuffle_batch=shuffle_batch,
+            use_token_batch=use_token_batch,
+            field_delimiter=field_delimiter,
+            token_delimiter=token_delimiter,
+            start_mark=start_mark,
+            end_mark=end_mark,
+            unk_mark=unk_mark,
+            seed=seed)
+
+    def load_src_trg_ids(self, end_mark, fpattern, start_mark, tar_fname,
+                         unk_mark):
+        if is_corpus_cache(fpattern):
+            raise ValueError("Corpus caches are memory mapped, please read "
+                             "%s with DataReader." % fpattern)
+        self._converters = make_converters(
+            self._src_vocab, None if self._only_src else self._trg_vocab,
+            start_mark, end_mark, unk_mark, self._token_delimiter)
+        fpaths = sorted(glob.glob(fpattern))
+        self._shards = fpaths[self._trainer_id::self._trainer_num]
+        if not self._shards:
+            raise ValueError("No data file of %s for trainer %d of %d." %
+                             (fpattern, self._trainer_id, self._trainer_num))
+
+    @property
+    def state(self):
+        """
+        The position after the last yielded batch, as a JSON serializable
+        dict: the lap, the number of pools read in the lap, the file and
+        the byte offset the current pool starts at, the number of batches of
+        the pool yielded and the number of batches of the pass yielded.
+        """
+        return dict(self._state, step=self._step)
+
+    def _read_pool(self, shards, shard, offset):
+        """
+        Read and convert at most pool_size samples from the given position,
+        returns their ids and the position after them.
+        """
+        writers = [TokenIdsWriter() for _ in range(1 if self._only_src else 2)]
+        num_fields = len(writers)
+        num = 0
+        while shard < len(shards) and num < self._pool_size:
+            with open(shards[shard], "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    offset += len(line)
+                    if six.PY3:
+                        line = line.decode()
+                    fields = line.strip("\n").split(self._field_delimiter)
+                    if len(fields) != num_fields:
+                        continue
+                    for writer, ids in zip(writers, self._converters(fields)):
+                        writer.append(ids)
+                    num += 1
+                    if num == self._pool_size:
+                        break
+                else:
+                    shard += 1
+                    offset = 0
+        seq_ids = [writer.close() for writer in writers]
+        return seq_ids[0], None if self._only_src else seq_ids[1], shard, offset
+
+    def batch_generator(self):
+        """
+        Yields the batches of one pass, starting from the current state.
+        """
+        if self._batches_per_pass is None:
+            for batch in self._read_lap():
+                yield batch
+            return
+
+        empty_laps = 0
+        while self._step < self._batches_per_pass:
+            num_batches = 0
+            for batch in self._read_lap():
+                num_batches += 1
+                self._step += 1
+                yield batch
+                if self._step == self._batches_per_pass:
+                    break
+            # a lap resumed after its last batch is empty once
+            empty_laps = empty_laps + 1 if num_batches == 0 else 0
+            if empty_laps == 2:
+                raise ValueError("No batch in the data files of trainer %d." %
+                                 self._trainer_id)
+        self._step = 0
+
+    def _read_lap(self):
+        """
+        Yields the batches of the rest of the current lap over the files.
+        """
+        epoch = self._state["epoch"]
+        pool = self._state["pool"]
+        shard = self._state["shard"]
+        offset = self._state["offset"]
+        skip = self._state["batch"]
+        shards = self._shards
+        if self._shuffle:
+            order = np.random.RandomState([self._seed, epoch]).permutation(
+                len(shards))
+            shards = [shards[i] for i in order]
+
+        while shard < len(shards):
+            pool_shard, pool_offset = shard, offset
+            src_seq_ids, trg_seq_ids, shard, offset = self._read_pool(
+                shards, shard, offset)
+            random = np.random.RandomState([self._seed, epoch, pool])
+            max_lens, min_lens = min_max_lens(src_seq_ids, trg_seq_ids)
+            idx = np.arange(len(max_lens))
+            if self._shuffle:
+                random.shuffle(idx)
+            if self._sort_type == SortType.POOL:
+                idx = sort_in_pools(idx, max_lens, len(idx) + 1, pool)
+
+            batches = self._split_batches(idx, max_lens, min_lens)
+            if self._shuffle_batch:
+                random.shuffle(batches)
+
+            for i in range(skip, len(batches)):
+                self._state = dict(
+                    epoch=epoch,
+                    pool=pool,
+                    shard=pool_shard,
+                    offset=pool_offset,
+                    batch=i + 1)
+                yield self._make_batch(src_seq_ids, trg_seq_ids, batches[i])
+            skip = 0
+            pool += 1
+            self._state = dict(
+                epoch=epoch, pool=pool, shard=shard, offset=offset, batch=0)
+
+        self._state = dict(epoch=epoch + 1, pool=0, shard=0, offset=0, batch=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Convert a text corpus into a corpus cache for DataReader.")
+    parser.add_argument("--src_vocab_fpath", type=str, required=True)
+    parser.add_argument("--trg_vocab_fpath", type=str, default=None)
+    parser.add_argument(
+        "--file_pattern",
+        type=str,
+        required=True,
+        help="The pattern to match data files.")
+    parser.add_argument("--tar_fname", type=str, default=None)
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="The directory to write the corpus cache to.")
+    parser.add_argument(
+        "--special_token",
+        type=str,
+        default=["<s>", "<e>", "<unk>"],
+        nargs=3,
+        help="The <bos>, <eos> and <unk> tokens in the dictionary.")
+    parser.add_argument(
+        "--token_delimiter",
+        type=lambda x: str(x.encode().decode("unicode-escape")),
+        default=" ",
+        help="The delimiter used to split tokens in source or target sentences.")
+    args = parser.parse_args()
+    num_samples = binarize_corpus(
+        args.output_dir,
+        args.src_vocab_fpath,
+        args.trg_vocab_fpath,
+        args.file_pattern,
+        tar_fname=args.tar_fname,
+        token_delimiter=args.token_delimiter,
+        start_mark=args.special_token[0],
+        end_mark=args.special_token[1],
+        unk_mark=args.special_token[2])
+    print("Wrote %d samples into %s." % (num_samples, args.output_dir))
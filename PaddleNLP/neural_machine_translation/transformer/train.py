@@ -1,12 +1,14 @@
 import argparse
 import ast
 import copy
+import json
 import logging
 import multiprocessing
 import os
 import six
 import sys
 sys.path.append("../../models/neural_machine_translation/transformer/")
+sys.path.append("../../")
 import time
 
 import numpy as np
@@ -16,6 +18,11 @@ import reader
 from config import *
 from desc import *
 from model import transformer, position_encoding_init
+from preprocess.padding import expand_attn_bias
+from preprocess.padding import pad_attn_batch_data as pad_batch_data
+
+# the state of StreamingDataReader saved in checkpoints
+READER_STATE_FNAME = "reader_state.json"
 
 
 def parse_args():
@@ -34,11 +41,13 @@ def parse_args():
         "--train_file_pattern",
         type=str,
         required=True,
-        help="The pattern to match training data files.")
+        help="The pattern to match training data files, or the directory of "
+        "a corpus cache written by reader.py.")
     parser.add_argument(
         "--val_file_pattern",
         type=str,
-        help="The pattern to match validation data files.")
+        help="The pattern to match validation data files, or the directory "
+        "of a corpus cache written by reader.py.")
     parser.add_argument(
         "--use_token_batch",
         type=ast.literal_eval,
@@ -58,6 +67,22 @@ def parse_args():
         type=int,
         default=200000,
         help="The buffer size to pool data.")
+    parser.add_argument(
+        "--stream",
+        type=ast.literal_eval,
+        default=False,
+        help="The flag indicating whether to stream the training data files "
+        "instead of loading them, holding only pool_size instances in memory. "
+        "The files are sharded among trainers, and training resumed from a "
+        "checkpoint continues reading after the data read before it was saved.")
+    parser.add_argument(
+        "--batches_per_pass",
+        type=int,
+        default=None,
+        help="The number of batches read in a pass with --stream, required "
+        "for distributed training so that all trainers run the same number "
+        "of steps. The files of a trainer are read in laps which continue "
+        "across passes. By default, a pass reads the files once.")
     parser.add_argument(
         "--sort_type",
         default="pool",
@@ -166,63 +191,6 @@ def append_nccl2_prepare(startup_prog, trainer_id, worker_endpoints,
     return nccl_id_var
 
 
-def pad_batch_data(insts,
-                   pad_idx,
-                   n_head,
-                   is_target=False,
-                   is_label=False,
-                   return_attn_bias=True,
-                   return_max_len=True,
-                   return_num_token=False):
-    """
-    Pad the instances to the max sequence length in batch, and generate the
-    corresponding position data and attention bias.
-    """
-    return_list = []
-    max_len = max(len(inst) for inst in insts)
-    # Any token included in dict can be used to pad, since the paddings' loss
-    # will be masked out by weights and make no effect on parameter gradients.
-    inst_data = np.array(
-        [inst + [pad_idx] * (max_len - len(inst)) for inst in insts])
-    return_list += [inst_data.astype("int64").reshape([-1, 1])]
-    if is_label:  # label weight
-        inst_weight = np.array(
-            [[1.] * len(inst) + [0.] * (max_len - len(inst)) for inst in insts])
-        return_list += [inst_weight.astype("float32").reshape([-1, 1])]
-    else:  # position data
-        inst_pos = np.array([
-            list(range(0, len(inst))) + [0] * (max_len - len(inst))
-            for inst in insts
-        ])
-        return_list += [inst_pos.astype("int64").reshape([-1, 1])]
-    if return_attn_bias:
-        if is_target:
-            # This is used to avoid attention on paddings and subsequent
-            # words.
-            slf_attn_bias_data = np.ones((inst_data.shape[0], max_len, max_len))
-            slf_attn_bias_data = np.triu(slf_attn_bias_data,
-                                         1).reshape([-1, 1, max_len, max_len])
-            slf_attn_bias_data = np.tile(slf_attn_bias_data,
-                                         [1, n_head, 1, 1]) * [-1e9]
-        else:
-            # This is used to avoid attention on paddings.
-            slf_attn_bias_data = np.array([[0] * len(inst) + [-1e9] *
-                                           (max_len - len(inst))
-                                           for inst in insts])
-            slf_attn_bias_data = np.tile(
-                slf_attn_bias_data.reshape([-1, 1, 1, max_len]),
-                [1, n_head, max_len, 1])
-        return_list += [slf_attn_bias_data.astype("float32")]
-    if return_max_len:
-        return_list += [max_len]
-    if return_num_token:
-        num_token = 0
-        for inst in insts:
-            num_token += len(inst)
-        return_list += [num_token]
-    return return_list if len(return_list) > 1 else return_list[0]
-
-
 def prepare_batch_input(insts, data_input_names, src_pad_idx, trg_pad_idx,
                         n_head, d_model):
     """
@@ -237,8 +205,7 @@ def prepare_batch_input(insts, data_input_names, src_pad_idx, trg_pad_idx,
     trg_word = trg_word.reshape(-1, trg_max_len, 1)
     trg_pos = trg_pos.reshape(-1, trg_max_len, 1)
 
-    trg_src_attn_bias = np.tile(src_slf_attn_bias[:, :, ::src_max_len, :],
-                                [1, 1, trg_max_len, 1]).astype("float32")
+    trg_src_attn_bias = expand_attn_bias(src_slf_attn_bias, trg_max_len)
 
     lbl_word, lbl_weight, num_token = pad_batch_data(
         [inst[2] for inst in insts],
@@ -259,17 +226,11 @@ def prepare_batch_input(insts, data_input_names, src_pad_idx, trg_pad_idx,
     return data_input_dict, np.asarray([num_token], dtype="float32")
 
 
-def prepare_data_generator(args,
-                           is_test,
-                           count,
-                           pyreader,
-                           py_reader_provider_wrapper,
-                           place=None):
+def data_reader_args(args, is_test, count):
     """
-    Data generator wrapper for DataReader. If use py_reader, set the data
-    provider for py_reader
+    The arguments of DataReader and StreamingDataReader.
     """
-    data_reader = reader.DataReader(
+    return dict(
         fpattern=args.val_file_pattern if is_test else args.train_file_pattern,
         src_vocab_fpath=args.src_vocab_fpath,
         trg_vocab_fpath=args.trg_vocab_fpath,
@@ -285,7 +246,43 @@ def prepare_data_generator(args,
         unk_mark=args.special_token[2],
         # count start and end tokens out
         max_length=ModelHyperParams.max_length - 2,
-        clip_last_batch=False).batch_generator
+        clip_last_batch=False)
+
+
+def save_reader_state(data_reader, dirname):
+    """
+    Save the state of a StreamingDataReader along with a checkpoint.
+    """
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(os.path.join(dirname, READER_STATE_FNAME), "w") as f:
+        json.dump(data_reader.state, f)
+
+
+def load_reader_state(dirname):
+    state_fpath = os.path.join(dirname, READER_STATE_FNAME)
+    if not os.path.exists(state_fpath):
+        return None
+    with open(state_fpath) as f:
+        return json.load(f)
+
+
+def prepare_data_generator(args,
+                           is_test,
+                           count,
+                           pyreader,
+                           py_reader_provider_wrapper,
+                           place=None,
+                           data_reader=None):
+    """
+    Data generator wrapper for DataReader. If use py_reader, set the data
+    provider for py_reader. A DataReader is created from args unless
+    data_reader is given.
+    """
+    if data_reader is None:
+        data_reader = reader.DataReader(
+            **data_reader_args(args, is_test, count))
+    data_reader = data_reader.batch_generator
 
     def stack(data_reader, count, clip_last=True):
         def __impl__():
@@ -483,12 +480,25 @@ def train_loop(exe,
         exe.run(startup_prog)
 
     logging.info("begin reader")
+    stream_reader = None
+    if args.stream:
+        reader_state = None
+        if TrainTaskConfig.ckpt_path:
+            reader_state = load_reader_state(TrainTaskConfig.ckpt_path)
+            logging.info("resume reader from {}".format(reader_state))
+        stream_reader = reader.StreamingDataReader(
+            trainer_id=nccl2_trainer_id if nccl2_num_trainers > 1 else None,
+            trainer_num=nccl2_num_trainers if nccl2_num_trainers > 1 else None,
+            batches_per_pass=args.batches_per_pass,
+            state=reader_state,
+            **data_reader_args(args, False, dev_count))
     train_data = prepare_data_generator(
         args,
         is_test=False,
         count=dev_count,
         pyreader=pyreader,
-        py_reader_provider_wrapper=py_reader_provider_wrapper)
+        py_reader_provider_wrapper=py_reader_provider_wrapper,
+        data_reader=stream_reader)
 
     # For faster executor
     exec_strategy = fluid.ExecutionStrategy()
@@ -579,6 +589,13 @@ def train_loop(exe,
                         exe,
                         os.path.join(TrainTaskConfig.ckpt_dir,
                                      "latest.checkpoint"), train_prog)
+                    if stream_reader is not None:
+                        # with py_reader, the batches queued in it are
+                        # counted as read
+                        save_reader_state(
+                            stream_reader,
+                            os.path.join(TrainTaskConfig.ckpt_dir,
+                                         "latest.checkpoint"))
                     fluid.io.save_params(
                         exe,
                         os.path.join(TrainTaskConfig.model_dir,
@@ -611,6 +628,11 @@ def train_loop(exe,
                 os.path.join(TrainTaskConfig.ckpt_dir,
                              "pass_" + str(pass_id) + ".checkpoint"),
                 train_prog)
+            if stream_reader is not None:
+                save_reader_state(
+                    stream_reader,
+                    os.path.join(TrainTaskConfig.ckpt_dir,
+                                 "pass_" + str(pass_id) + ".checkpoint"))
 
     if args.enable_ce:  # For CE
         print("kpis\ttrain_cost_card%d\t%f" % (dev_count, total_avg_cost))
@@ -24,7 +24,8 @@ class BaseReader(object):
                  max_seq_len=512,
                  do_lower_case=True,
                  in_tokens=False,
-                 random_seed=None):
+                 random_seed=None,
+                 bucket_batch=False):
         self.max_seq_len = max_seq_len
         self.tokenizer = tokenization.FullTokenizer(
             vocab_file=vocab_path, do_lower_case=do_lower_case)
@@ -33,6 +34,8 @@ class BaseReader(object):
         self.cls_id = self.vocab["[CLS]"]
         self.sep_id = self.vocab["[SEP]"]
         self.in_tokens = in_tokens
+        # batch the shuffled records of similar lengths together
+        self.bucket_batch = bucket_batch
 
         np.random.seed(random_seed)
 
@@ -158,14 +161,11 @@ class BaseReader(object):
             qid=qid)
         return record
 
-    def _prepare_batch_data(self, examples, batch_size, phase=None):
-        """generate batch records"""
+    def _batch_records(self, records, batch_size):
+        """split records into batches of batch_size records, or of at most
+        batch_size tokens including paddings if in_tokens"""
         batch_records, max_len = [], 0
-        for index, example in enumerate(examples):
-            if phase == "train":
-                self.current_example = index
-            record = self._convert_example_to_record(example, self.max_seq_len,
-                                                     self.tokenizer)
+        for record in records:
             max_len = max(max_len, len(record.token_ids))
             if self.in_tokens:
                 to_append = (len(batch_records) + 1) * max_len <= batch_size
@@ -174,10 +174,33 @@ class BaseReader(object):
             if to_append:
                 batch_records.append(record)
             else:
-                yield self._pad_batch_records(batch_records)
+                yield batch_records
                 batch_records, max_len = [record], len(record.token_ids)
 
         if batch_records:
+            yield batch_records
+
+    def _prepare_batch_data(self, records, batch_size, phase=None,
+                            bucket=False):
+        """generate batch records, of records of similar lengths if bucket"""
+        if bucket:
+            # The sort is stable, records of the same length keep their
+            # shuffled order. Shuffling the batches then keeps the epoch
+            # random while every batch is padded to similar lengths.
+            batches = list(
+                self._batch_records(
+                    sorted(
+                        records, key=lambda record: len(record.token_ids)),
+                    batch_size))
+            np.random.shuffle(batches)
+        else:
+            batches = self._batch_records(records, batch_size)
+
+        num_records = 0
+        for batch_records in batches:
+            num_records += len(batch_records)
+            if phase == "train":
+                self.current_example = num_records
             yield self._pad_batch_records(batch_records)
 
     def get_num_examples(self, input_file):
@@ -193,6 +216,14 @@ class BaseReader(object):
                        phase=None):
         """return generator which yields batch data for pyreader"""
         examples = self._read_tsv(input_file)
+        # tokenize once for all the epochs
+        records = [
+            self._convert_example_to_record(example, self.max_seq_len,
+                                            self.tokenizer)
+            for example in examples
+        ]
+        # unshuffled batches keep the order of the file for prediction
+        bucket = self.bucket_batch and shuffle
 
         def _wrapper():
             for epoch_index in range(epoch):
@@ -200,10 +231,10 @@ class BaseReader(object):
                     self.current_example = 0
                     self.current_epoch = epoch_index
                 if shuffle:
-                    np.random.shuffle(examples)
+                    np.random.shuffle(records)
 
                 for batch_data in self._prepare_batch_data(
-                        examples, batch_size, phase=phase):
+                        records, batch_size, phase=phase, bucket=bucket):
                     yield batch_data
 
         return _wrapper
@@ -1,13 +1,63 @@
 """
 Mask, padding and batching.
+
+The instances of a batch are padded into preallocated arrays in a few
+vectorized operations. Attention biases are returned as read-only broadcast
+views of [batch_size, 1, 1, max_len] paddings or of a cached causal
+[max_len, max_len] bias, of the full [batch_size, n_head, max_len, max_len]
+shape but without repeating the data for every head. They are copied into
+contiguous tensors only once, when fed.
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import itertools
 import numpy as np
 
+# the bias added to the attention logits of masked positions
+ATTN_BIAS_VALUE = -1e9
+
+_causal_bias_cache = {}
+
+
+def _pad(insts, pad_idx, max_len=None):
+    """
+    Returns the [batch_size, max_len] int64 padded instances, the mask of
+    their tokens and their lengths.
+    """
+    seq_lens = np.array([len(inst) for inst in insts], dtype="int64")
+    if max_len is None:
+        max_len = int(seq_lens.max())
+    mask = np.arange(max_len) < seq_lens[:, np.newaxis]
+    inst_data = np.full(mask.shape, pad_idx, dtype="int64")
+    inst_data[mask] = np.fromiter(
+        itertools.chain.from_iterable(insts),
+        dtype="int64",
+        count=int(seq_lens.sum()))
+    return inst_data, mask, seq_lens
+
+
+def _positions(mask, pad_idx):
+    inst_pos = np.where(mask, np.arange(mask.shape[1]), pad_idx)
+    return inst_pos.astype("int64")
+
+
+def causal_attn_bias(max_len):
+    """
+    The [max_len, max_len] float32 bias avoiding attention on subsequent
+    positions, cached per max_len. It is read-only as it is shared.
+    """
+    bias = _causal_bias_cache.get(max_len)
+    if bias is None:
+        bias = np.triu(
+            np.full(
+                (max_len, max_len), ATTN_BIAS_VALUE, dtype="float32"), 1)
+        bias.flags.writeable = False
+        _causal_bias_cache[max_len] = bias
+    return bias
+
 
 def pad_batch_data(insts,
                    pad_idx=0,
@@ -15,51 +65,96 @@ def pad_batch_data(insts,
                    return_input_mask=False,
                    return_max_len=False,
                    return_num_token=False,
-                   return_seq_lens=False):
+                   return_seq_lens=False,
+                   max_len=None):
     """
     Pad the instances to the max sequence length in batch, and generate the
-    corresponding position data and input mask.
+    corresponding position data and input mask. The instances are padded to
+    max_len instead if it is given.
     """
     return_list = []
-    max_len = max(len(inst) for inst in insts)
     # Any token included in dict can be used to pad, since the paddings' loss
     # will be masked out by weights and make no effect on parameter gradients.
-
-    inst_data = np.array(
-        [inst + list([pad_idx] * (max_len - len(inst))) for inst in insts])
-    return_list += [inst_data.astype("int64").reshape([-1, max_len, 1])]
+    inst_data, mask, seq_lens = _pad(insts, pad_idx, max_len)
+    max_len = inst_data.shape[1]
+    return_list += [inst_data.reshape([-1, max_len, 1])]
 
     # position data
     if return_pos:
-        inst_pos = np.array([
-            list(range(0, len(inst))) + [pad_idx] * (max_len - len(inst))
-            for inst in insts
-        ])
-
-        return_list += [inst_pos.astype("int64").reshape([-1, max_len, 1])]
+        inst_pos = _positions(mask, pad_idx)
+        return_list += [inst_pos.reshape([-1, max_len, 1])]
 
     if return_input_mask:
         # This is used to avoid attention on paddings.
-        input_mask_data = np.array([[1] * len(inst) + [0] *
-                                    (max_len - len(inst)) for inst in insts])
-        input_mask_data = np.expand_dims(input_mask_data, axis=-1)
-        return_list += [input_mask_data.astype("float32")]
+        input_mask_data = mask.astype("float32")[:, :, np.newaxis]
+        return_list += [input_mask_data]
 
     if return_max_len:
         return_list += [max_len]
 
     if return_num_token:
-        num_token = 0
-        for inst in insts:
-            num_token += len(inst)
-        return_list += [num_token]
+        return_list += [int(seq_lens.sum())]
 
     if return_seq_lens:
-        seq_lens = np.array([len(inst) for inst in insts])
-        return_list += [seq_lens.astype("int64").reshape([-1, 1])]
+        return_list += [seq_lens.reshape([-1, 1])]
 
     return return_list if len(return_list) > 1 else return_list[0]
 
 
+def pad_attn_batch_data(insts,
+                        pad_idx,
+                        n_head,
+                        is_target=False,
+                        is_label=False,
+                        return_attn_bias=True,
+                        return_max_len=True,
+                        return_num_token=False):
+    """
+    Pad the instances to the max sequence length in batch, and generate the
+    corresponding position data, or label weights if is_label, and the
+    [batch_size, n_head, max_len, max_len] self attention bias, which
+    avoids attention on subsequent words if is_target and on paddings
+    otherwise. Padded data is flattened to [batch_size * max_len, 1].
+    """
+    return_list = []
+    inst_data, mask, seq_lens = _pad(insts, pad_idx)
+    batch_size, max_len = inst_data.shape
+    return_list += [inst_data.reshape([-1, 1])]
+    if is_label:  # label weight
+        return_list += [mask.astype("float32").reshape([-1, 1])]
+    else:  # position data
+        return_list += [_positions(mask, 0).reshape([-1, 1])]
+    if return_attn_bias:
+        if is_target:
+            # This is used to avoid attention on paddings and subsequent
+            # words.
+            slf_attn_bias_data = causal_attn_bias(max_len)
+        else:
+            # This is used to avoid attention on paddings.
+            slf_attn_bias_data = np.where(mask, 0., ATTN_BIAS_VALUE).astype(
+                "float32").reshape([-1, 1, 1, max_len])
+        return_list += [
+            np.broadcast_to(slf_attn_bias_data,
+                            (batch_size, n_head, max_len, max_len))
+        ]
+    if return_max_len:
+        return_list += [max_len]
+    if return_num_token:
+        return_list += [int(seq_lens.sum())]
+    return return_list if len(return_list) > 1 else return_list[0]
+
+
+def expand_attn_bias(slf_attn_bias, query_len):
+    """
+    Expand the padding self attention bias of the keys returned by
+    pad_attn_batch_data to the [batch_size, n_head, query_len, key_len]
+    bias of queries of length query_len attending to them, as a broadcast
+    view.
+    """
+    batch_size, n_head, _, key_len = slf_attn_bias.shape
+    return np.broadcast_to(slf_attn_bias[:, :, :1, :],
+                           (batch_size, n_head, query_len, key_len))
+
+
 if __name__ == "__main__":
     pass